@@ -51,7 +51,10 @@ config = {
         'token': os.environ.get('WIALON_TOKEN', 'test_token')
     },
     'enable_hourly_polling': os.environ.get('ENABLE_POLLING', 'true').lower() == 'true',
-    'poll_interval_minutes': int(os.environ.get('POLL_INTERVAL', '60'))
+    'poll_interval_minutes': int(os.environ.get('POLL_INTERVAL', '60')),
+    # When the resident processor daemon is running it is woken by NOTIFY,
+    # so request handlers no longer process data inline
+    'processor_daemon_enabled': os.environ.get('PROCESSOR_DAEMON', 'false').lower() == 'true'
 }
 
 # Initialize components
@@ -151,7 +154,8 @@ def refresh_data():
         # Wait for the response (with timeout)
         if response_event.wait(timeout=30):  # 30-second timeout
             # Also process the data
-            fuel_processor.process_new_data()
+            if not config['processor_daemon_enabled']:
+                fuel_processor.process_new_data()
             return jsonify(response_data)
         else:
             # If timeout, return status indicating request is in progress
@@ -508,6 +512,59 @@ def get_dashboard_summary():
         if conn:
             conn.close()
 
+@app.route('/api/metrics/processing', methods=['GET'])
+def get_processing_metrics():
+    """Get per-stage processing metrics and the latest backlog gauges"""
+    minutes = request.args.get('minutes', 60, type=int)
+    
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        
+        # Stage totals over the requested window
+        cursor.execute("""
+            SELECT stage,
+                   COUNT(*) as runs,
+                   SUM(duration_seconds) as total_seconds,
+                   AVG(duration_seconds) as avg_seconds,
+                   MAX(duration_seconds) as max_seconds,
+                   SUM(rows_processed) as rows_processed,
+                   SUM(rows_processed) / NULLIF(SUM(duration_seconds), 0) as rows_per_second,
+                   SUM(queries) as queries
+            FROM fuel_management.processing_stage_metrics
+            WHERE recorded_at > LOCALTIMESTAMP - %s * INTERVAL '1 minute'
+            GROUP BY stage
+            ORDER BY stage
+        """, (minutes,))
+        
+        stages = cursor.fetchall()
+        
+        # Latest backlog sample per raw table
+        cursor.execute("""
+            SELECT DISTINCT ON (source_table)
+                   source_table, unprocessed_rows, oldest_unprocessed_age_seconds, recorded_at
+            FROM fuel_management.processing_backlog_metrics
+            ORDER BY source_table, recorded_at DESC
+        """)
+        
+        backlog = cursor.fetchall()
+        
+        return jsonify({
+            'window_minutes': minutes,
+            'stages': stages,
+            'backlog': backlog
+        })
+    except Exception as e:
+        logger.error(f"Error getting processing metrics: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+
 @app.route('/api/simulate/transaction', methods=['POST'])
 def simulate_transaction():
     """Simulate a fuel transaction (for testing)"""
@@ -524,7 +581,8 @@ def simulate_transaction():
             transaction = simulator.simulate_fuel_transaction()
             
             # Process the new data
-            fuel_processor.process_new_data()
+            if not config['processor_daemon_enabled']:
+                fuel_processor.process_new_data()
             
             return jsonify({
                 'success': True,
@@ -0,0 +1,114 @@
+import logging
+import time
+
+# Sensor kinds and the tokens that identify them in a sensor's parameter or name,
+# checked in order after normalizing to lower_snake_case
+SENSOR_KIND_PATTERNS = (
+    ('fuel_level', ('fuel_level',)),
+    ('fuel_flow', ('fuel_flow', 'flow_meter')),
+    ('temperature', ('temperature',)),
+    ('ignition', ('ignition',)),
+    ('odometer', ('odometer', 'mileage')),
+)
+
+def _normalize(text):
+    """Lower-case a sensor name/parameter and join its words with underscores"""
+    return '_'.join((text or '').lower().replace('-', ' ').split())
+
+def classify_sensor(parameter, name):
+    """Get the kind of a sensor from its Wialon parameter, falling back to its name"""
+    for text in (parameter, name):
+        normalized = _normalize(text)
+        if not normalized:
+            continue
+        for kind, tokens in SENSOR_KIND_PATTERNS:
+            if any(token in normalized for token in tokens):
+                return kind
+    return None
+
+class EventHandlerRegistry:
+    def __init__(self, logger=None, unresolved_ttl_seconds=300):
+        """Initialize an empty registry of batched sensor reading handlers"""
+        self.logger = logger or logging.getLogger('fuel_processor')
+        # Sensors without a kind are re-resolved after this long, in case they
+        # were configured since (or a reference notification was missed)
+        self.unresolved_ttl_seconds = unresolved_ttl_seconds
+        self._handlers = {}        # kind -> handler(conn, readings)
+        self._kind_by_sensor = {}  # (unit_id, sensor_id) -> kind (or None)
+        self._unresolved_at = {}   # (unit_id, sensor_id) -> monotonic time resolved as None
+
+    def register(self, kind, handler):
+        """Register handler(conn, readings) for every reading of a sensor kind"""
+        self._handlers[kind] = handler
+
+    def kind_of(self, unit_id, sensor_id):
+        """Get the resolved kind of a unit's sensor, or None"""
+        return self._kind_by_sensor.get((unit_id, sensor_id))
+
+    def invalidate(self):
+        """Forget resolved sensor kinds, e.g. after sensors were reconfigured"""
+        self._kind_by_sensor = {}
+        self._unresolved_at = {}
+
+    def _is_resolved(self, key):
+        """Whether a sensor's kind is cached and, if it has none, not yet expired"""
+        if key not in self._kind_by_sensor:
+            return False
+        resolved_at = self._unresolved_at.get(key)
+        return resolved_at is None or time.monotonic() - resolved_at < self.unresolved_ttl_seconds
+
+    def _remember(self, key, kind):
+        """Cache a sensor's kind, timestamping sensors that have none"""
+        self._kind_by_sensor[key] = kind
+        if kind is None:
+            self._unresolved_at[key] = time.monotonic()
+        else:
+            self._unresolved_at.pop(key, None)
+
+    def resolve(self, conn, readings):
+        """Resolve the kind of every sensor in readings that has not been seen yet.
+
+        Wialon sensor IDs are per unit, so sensors are keyed by (unit_id, sensor_id).
+        Sensor metadata is loaded from wialon_data.sensors in one query per batch
+        of new sensors; sensors missing there for their unit are classified by
+        the sensor_name stored on the reading. Sensors without a kind are
+        resolved again once unresolved_ttl_seconds have passed.
+        """
+        unresolved = {}
+        for reading in readings:
+            key = (reading[1], reading[3])
+            if key not in unresolved and not self._is_resolved(key):
+                unresolved[key] = reading[4]
+
+        if not unresolved:
+            return
+
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT s.unit_id, s.sensor_id, s.name, s.parameter
+            FROM wialon_data.sensors s
+            JOIN unnest(%s::bigint[], %s::bigint[]) AS k(unit_id, sensor_id)
+            ON s.unit_id = k.unit_id AND s.sensor_id = k.sensor_id
+        """, ([key[0] for key in unresolved], [key[1] for key in unresolved]))
+
+        for unit_id, sensor_id, name, parameter in cursor.fetchall():
+            self._remember((unit_id, sensor_id), classify_sensor(parameter, name))
+            unresolved.pop((unit_id, sensor_id), None)
+
+        for key, sensor_name in unresolved.items():
+            self._remember(key, classify_sensor(None, sensor_name))
+
+    def dispatch(self, conn, readings):
+        """Hand each registered handler the readings of its kind, in their original order"""
+        self.resolve(conn, readings)
+
+        batches = {}
+        for reading in readings:
+            kind = self._kind_by_sensor.get((reading[1], reading[3]))
+            if kind in self._handlers:
+                batches.setdefault(kind, []).append(reading)
+
+        for kind, batch in batches.items():
+            self._handlers[kind](conn, batch)
+
+        return {kind: len(batch) for kind, batch in batches.items()}
@@ -0,0 +1,314 @@
+import logging
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from spatial_index import METERS_PER_DEGREE
+
+def rolling_median(values, window, breaks=None):
+    """Trailing median over window samples, not reaching back past a True in breaks"""
+    values = values.astype(float)
+    n = len(values)
+    if window <= 1 or n == 0:
+        return values
+
+    smoothed = np.empty(n)
+    if n >= window:
+        # partition is noticeably faster than np.median over the window view
+        smoothed[window - 1:] = np.partition(sliding_window_view(values, window), window // 2, axis=1)[:, window // 2]
+
+    starts = np.zeros(n, dtype=bool) if breaks is None else breaks.copy()
+    starts[0] = True
+    segment_start = np.maximum.accumulate(np.where(starts, np.arange(n), 0))
+    available = np.arange(n) - segment_start + 1
+    # Windows short of samples at a series or segment start use the upper median of those available
+    for i in np.flatnonzero(available < window):
+        samples = np.sort(values[segment_start[i]:i + 1])
+        smoothed[i] = samples[len(samples) // 2]
+    return smoothed
+
+def _runs(mask):
+    """Get (start, end) index arrays of the runs of True in a boolean mask, end inclusive"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+
+def detect_fuel_events(times, levels, lats, lons, median_window=5, noise_tolerance=0.5,
+                       refuel_threshold=5.0, drain_threshold=10.0, drain_window=1800.0,
+                       parked_radius=50.0, max_gap=3600.0, smoothing_max_gap=120.0):
+    """Detect refuels and drains in one fuel level series, as (received, drained)
+    tuples of (start, end, amount, closed_at) arrays"""
+    n = len(levels)
+    empty = (np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0), np.empty(0, dtype=np.intp))
+    if n < 2:
+        return empty, empty
+
+    # Sparse readings, e.g. before/after pairs around a refuel, are not smoothed together
+    gaps = np.diff(times)
+    smoothed = rolling_median(levels, median_window, np.concatenate(([True], gaps > smoothing_max_gap)))
+
+    # Refuels: runs of rises above noise_tolerance adding up to refuel_threshold;
+    # step[i] is the change from sample i to sample i + 1
+    step = np.diff(smoothed)
+    rising = (step > noise_tolerance) & (gaps <= max_gap)
+    sparse = gaps > smoothing_max_gap
+    starts, ends = _runs(rising & ~sparse)
+    closed_at = ends + 2
+    # A rise across a smoothing gap compares sparse readings (e.g. the
+    # before/after pair of a refuel); it is a refuel of its own, complete as
+    # soon as its second reading is there
+    single = np.flatnonzero(rising & sparse)
+    if len(single):
+        order = np.argsort(np.concatenate((starts, single)), kind='stable')
+        starts = np.concatenate((starts, single))[order]
+        ends = np.concatenate((ends, single))[order]
+        closed_at = np.concatenate((closed_at, single + 1))[order]
+    amounts = smoothed[ends + 1] - smoothed[starts]
+    keep = amounts >= refuel_threshold
+    received = (starts[keep], ends[keep] + 1, amounts[keep], closed_at[keep])
+
+    # Drains: the level fell by drain_threshold over drain_window while parked;
+    # compare each sample with the first sample of its trailing window
+    window_start = np.searchsorted(times, times - drain_window)
+    drop = smoothed[window_start] - smoothed
+    d_lat = (lats - lats[window_start]) * METERS_PER_DEGREE
+    d_lon = (lons - lons[window_start]) * METERS_PER_DEGREE * np.cos(np.radians(lats))
+    with np.errstate(invalid='ignore'):
+        parked = d_lat * d_lat + d_lon * d_lon <= parked_radius * parked_radius
+    draining = (drop >= drain_threshold) & parked
+    starts, last_flagged = _runs(draining)
+    starts = window_start[starts]
+    # Merge runs whose windows overlap, e.g. when the drop hovers at the threshold
+    if len(starts):
+        first = np.concatenate(([True], starts[1:] > last_flagged[:-1]))
+        last = np.concatenate((first[1:], [True]))
+        starts, last_flagged = starts[first], last_flagged[last]
+    # A run stays flagged until the drop leaves the trailing window, so end it
+    # at its lowest level rather than at its last flagged sample
+    ends = np.array([start + np.argmin(smoothed[start:end + 1]) for start, end in zip(starts, last_flagged)],
+                    dtype=np.intp)
+    drained = (starts, ends, smoothed[starts] - smoothed[ends], last_flagged + 1)
+
+    return received, drained
+
+def detect_dispensations(readings, previous):
+    """Derive 'dispensed' fuel events from flow meter readings sorted by timestamp.
+
+    previous maps (unit_id, sensor_id) to the (value, timestamp) preceding the
+    readings and is advanced to the last reading of each sensor. Any positive
+    increase of the meter within an hour of the previous reading is dispensed fuel.
+    """
+    fuel_events = []
+    for reading in readings:
+        reading_id, unit_id, unit_name, sensor_id, sensor_name, value, timestamp, lat, lon = reading
+        key = (unit_id, sensor_id)
+
+        prev_reading = previous.get(key)
+        if prev_reading and value is not None and prev_reading[0] is not None:
+            prev_value, prev_timestamp = prev_reading
+            time_diff = (timestamp - prev_timestamp).total_seconds()
+            value_diff = value - prev_value
+
+            if time_diff > 0 and time_diff < 3600 and value_diff > 0:
+                fuel_events.append((unit_id, 'dispensed', timestamp, value_diff, lat, lon))
+
+        previous[key] = (value, timestamp)
+    return fuel_events
+
+class FuelLevelDetector:
+    def __init__(self, config, logger=None):
+        """Initialize the refuel/drain detector for fuel level sensors"""
+        self.logger = logger or logging.getLogger('fuel_processor')
+        self.median_window = config.get('fuel_median_window', 5)
+        self.noise_tolerance = config.get('fuel_noise_tolerance_liters', 0.5)
+        self.refuel_threshold = config.get('refuel_threshold_liters', 5)
+        self.drain_threshold = config.get('drain_threshold_liters', 10)
+        self.drain_window = config.get('drain_window_minutes', 30) * 60.0
+        self.parked_radius = config.get('parked_radius_meters', 50)
+        self.max_gap = config.get('fuel_max_gap_seconds', 3600)
+        # Readings further apart than this are not smoothed together
+        self.smoothing_max_gap = config.get('fuel_smoothing_max_gap_seconds', 120)
+        # Upper bound on the samples carried over per sensor between batches
+        self.max_tail_samples = config.get('fuel_detector_tail_samples', 2000)
+        # (unit_id, sensor_id) -> (stamps, levels, lats, lons) of the unsettled tail
+        self._tails = {}
+
+    def detect(self, readings):
+        """Detect refuels and drains in a batch of fuel level readings.
+
+        readings are sensor_readings rows sorted by timestamp. Each sensor's
+        new readings are appended to the tail kept from its previous batch, so
+        events spanning two batches are reported once, when they have ended.
+        Returns fuel_events rows (unit_id, event_type, timestamp, amount,
+        latitude, longitude).
+        """
+        series = {}
+        for reading in readings:
+            if reading[5] is not None:
+                series.setdefault((reading[1], reading[3]), []).append(reading)
+
+        fuel_events = []
+        for key, rows in series.items():
+            fuel_events.extend(self._detect_series(key, rows))
+
+        fuel_events.sort(key=lambda event: event[2])
+        return fuel_events
+
+    def context_seconds(self):
+        """Get how far back a sensor's first batch needs earlier readings as context"""
+        return max(self.drain_window, self.max_gap)
+
+    def cold_keys(self, readings):
+        """Get {(unit_id, sensor_id): first timestamp} of the sensors in readings without a tail"""
+        cold = {}
+        for reading in readings:
+            key = (reading[1], reading[3])
+            if reading[5] is not None and key not in self._tails and key not in cold:
+                cold[key] = reading[6]
+        return cold
+
+    def seed(self, key, rows):
+        """Start a sensor's tail from (timestamp, level, lat, lon) rows preceding its
+        first batch, sorted by timestamp"""
+        rows = [row for row in rows if row[1] is not None][-self.max_tail_samples:]
+        if not rows:
+            return
+        self._tails[key] = (
+            np.array([row[0] for row in rows], dtype='datetime64[us]'),
+            np.array([row[1] for row in rows], dtype=float),
+            np.array([row[2] for row in rows], dtype=float),
+            np.array([row[3] for row in rows], dtype=float),
+        )
+
+    def _detect_series(self, key, rows):
+        """Run detection over one sensor's tail plus its new readings"""
+        stamps = np.array([row[6] for row in rows], dtype='datetime64[us]')
+        levels = np.array([row[5] for row in rows], dtype=float)
+        lats = np.array([row[7] for row in rows], dtype=float)
+        lons = np.array([row[8] for row in rows], dtype=float)
+
+        tail_size = 0
+        tail = self._tails.get(key)
+        if tail is not None:
+            # Drop readings that arrive out of order behind the tail
+            fresh = stamps > tail[0][-1]
+            tail_size = len(tail[0])
+            stamps = np.concatenate((tail[0], stamps[fresh]))
+            levels = np.concatenate((tail[1], levels[fresh]))
+            lats = np.concatenate((tail[2], lats[fresh]))
+            lons = np.concatenate((tail[3], lons[fresh]))
+
+        times = stamps.astype(np.int64) / 1e6
+        n = len(times)
+        received, drained = detect_fuel_events(
+            times, levels, lats, lons, self.median_window, self.noise_tolerance,
+            self.refuel_threshold, self.drain_threshold, self.drain_window,
+            self.parked_radius, self.max_gap, self.smoothing_max_gap
+        )
+
+        # An event is settled once a later sample shows it has ended; report it
+        # only if that sample is new, so it is not reported again from the tail
+        fuel_events = []
+        keep_from = n
+        for event_type, (starts, ends, amounts, closed_at) in (('received', received), ('drained', drained)):
+            settled = closed_at < n
+            report = settled & (closed_at >= tail_size)
+            for end, amount in zip(ends[report], amounts[report]):
+                fuel_events.append((
+                    key[0], event_type, stamps[end].item(), float(amount),
+                    _nan_to_none(lats[end]), _nan_to_none(lons[end])
+                ))
+            if (~settled).any():
+                keep_from = min(keep_from, int(starts[~settled].min()))
+
+        # Keep enough context to smooth and window the next batch, and any open event
+        context_start = min(
+            n - 1 - self.median_window,
+            int(np.searchsorted(times, times[-1] - self.drain_window))
+        )
+        keep_from = max(min(keep_from, context_start) - self.median_window, 0, n - self.max_tail_samples)
+        self._tails[key] = (stamps[keep_from:], levels[keep_from:], lats[keep_from:], lons[keep_from:])
+
+        return fuel_events
+
+    def tracked_keys(self):
+        """Get the (unit_id, sensor_id) keys that have a carried-over tail"""
+        return list(self._tails)
+
+    def forget_units(self, unit_ids):
+        """Drop the carried-over tails of every sensor of the given units"""
+        for key in [key for key in self._tails if key[0] in unit_ids]:
+            del self._tails[key]
+
+    def forget(self, key=None):
+        """Drop the carried-over tail of one (unit_id, sensor_id), or of all sensors"""
+        if key is None:
+            self._tails = {}
+        else:
+            self._tails.pop(key, None)
+
+def _nan_to_none(value):
+    """Convert NaN coordinates back to NULL"""
+    return None if np.isnan(value) else float(value)
+
+def _synthetic_series(rng, days, interval):
+    """Generate a noisy fuel level series with known refuels and drains"""
+    n = int(days * 86400 / interval)
+    times = np.arange(n) * float(interval)
+
+    # Alternate 4 hour driving and parked periods; consume ~15 L/h while driving
+    driving = (times // 14400) % 2 == 0
+    consumption = np.where(driving, 15.0 * interval / 3600, 0.0)
+
+    refuels = rng.choice(np.flatnonzero(~driving), size=days, replace=False)
+    drains = rng.choice(np.flatnonzero(~driving), size=max(days // 10, 1), replace=False)
+    change = -consumption
+    for index in refuels:
+        change[index:index + 6] += 40.0        # 240 L over 3 minutes
+    for index in drains:
+        change[index:index + 40] -= 0.5        # 20 L over 20 minutes
+
+    levels = 400.0 + np.cumsum(change) + rng.normal(0, 0.8, n)
+    # Occasional sloshing spikes
+    spikes = rng.random(n) < 0.002
+    levels[spikes] += rng.normal(0, 15, spikes.sum())
+
+    # Positions move while driving and stay put while parked
+    steps = np.where(driving, 0.0002, 0.0)
+    lats = -9.4438 + np.cumsum(steps * rng.choice((-1, 1), n))
+    lons = 147.1803 + np.cumsum(steps * rng.choice((-1, 1), n))
+    return times, levels, lats, lons, len(refuels), len(drains)
+
+def _benchmark(truck_count, days, interval):
+    """Time the detector over synthetic fleet telemetry"""
+    import time
+
+    rng = np.random.default_rng(42)
+    samples = 0
+    elapsed = 0.0
+    expected = [0, 0]
+    found = [0, 0]
+    for _ in range(truck_count):
+        times, levels, lats, lons, refuels, drains = _synthetic_series(rng, days, interval)
+        started = time.perf_counter()
+        received, drained = detect_fuel_events(times, levels, lats, lons)
+        elapsed += time.perf_counter() - started
+
+        samples += len(times)
+        expected[0] += refuels
+        expected[1] += drains
+        found[0] += len(received[0])
+        found[1] += len(drained[0])
+
+    print(f"Trucks: {truck_count}, days: {days}, interval: {interval} s, samples: {samples}")
+    print(f"Detection: {elapsed:.2f} s ({samples / elapsed:.0f} samples/s)")
+    print(f"Refuels: {found[0]} detected / {expected[0]} injected")
+    print(f"Drains: {found[1]} detected / {expected[1]} injected")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark refuel and drain detection')
+    parser.add_argument('--trucks', type=int, default=500, help='Number of trucks')
+    parser.add_argument('--days', type=int, default=30, help='Days of telemetry per truck')
+    parser.add_argument('--interval', type=int, default=30, help='Seconds between readings')
+    args = parser.parse_args()
+
+    _benchmark(args.trucks, args.days, args.interval)
@@ -1,9 +1,23 @@
 import psycopg2
+from psycopg2.extras import execute_values
 import json
 import logging
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-import math
-from geopy.distance import geodesic
+import multiprocessing
+from event_handlers import EventHandlerRegistry
+from fuel_detection import FuelLevelDetector, detect_dispensations
+from lookup_cache import LookupCache
+from processing_metrics import CountingConnection, ProcessingMetrics
+from transaction_matcher import TransactionMatcher, derived_transaction_id
+
+# First key of the advisory locks taken by processor workers
+PROCESSOR_LOCK_NAMESPACE = 7301
+# Second key of the lock that serializes transaction matching (shards use
+# shard_count * SHARD_LOCK_STRIDE + shard, so layouts of different sizes never share a key)
+MATCHING_LOCK_KEY = -1
+SHARD_LOCK_STRIDE = 65536
 
 class FuelDataProcessor:
     def __init__(self, config):
@@ -11,10 +25,63 @@ class FuelDataProcessor:
         self.db_config = config.get('database', {})
         self.logger = self._setup_logger()
         self.geozone_proximity_threshold = config.get('geozone_proximity_meters', 50)
+        # 'batch' claims chunks of readings and writes results with set-based
+        # statements; 'row' is the original row-at-a-time path, kept for comparison
+        self.processing_mode = config.get('processing_mode', 'batch')
+        self.batch_size = config.get('batch_size', 1000)
+        # 'flag' scans for processed = FALSE; 'watermark' reads rows above a durable
+        # per-table high-water mark in wialon_data.processing_checkpoints
+        self.ingestion_mode = config.get('ingestion_mode', 'flag')
+        # Rows younger than this are left for the next run, so rows from writer
+        # transactions still in flight (lower IDs, not yet visible) are not skipped
+        self.watermark_lag_seconds = config.get('watermark_lag_seconds', 60)
+        # The processed flag is required in flag mode and optional in watermark mode
+        self.mark_processed_rows = self.ingestion_mode == 'flag' or config.get('mark_processed_rows', False)
+        # Units are split into shard_count shards by a hash of unit_id; each run
+        # claims free shards under advisory locks so concurrent processors never
+        # handle the same unit. The deployment's shard_count lives in
+        # wialon_data.processing_shards; a configured value that differs from it
+        # makes the processor refuse to run, and an unset one adopts it.
+        self.configured_shard_count = config.get('shard_count')
+        self.shard_count = None
+        # shard -> generation of this process's last run on it; when another
+        # process has run on a shard since, cached state of its units is stale
+        self._shard_generations = {}
+        self.worker_index = config.get('worker_index', 0)
+        self.max_shards_per_run = config.get('max_shards_per_run')
+        # Last seen (value, timestamp) per (unit_id, sensor_id), bounded LRU
+        self.previous_reading_cache_size = config.get('previous_reading_cache_size', 10000)
+        self._previous_readings = OrderedDict()
+        self._previous_readings_warmed = False
+        # Unit/vehicle/bowser/driver mappings shared by all processing stages
+        self.lookups = LookupCache(
+            config.get('lookup_cache_ttl_seconds', 300),
+            self.logger,
+            default_zone_radius=self.geozone_proximity_threshold
+        )
+        self.transaction_matcher = TransactionMatcher(config, self.lookups, self.logger)
+        # Stage timings, row and query counts and backlog gauges, stored per run
+        # in fuel_management.processing_*_metrics for Grafana
+        self.metrics_enabled = config.get('metrics_enabled', True)
+        self.metrics = ProcessingMetrics(
+            self.logger, config.get('metrics_worker_name'),
+            retention_days=config.get('metrics_retention_days', 30),
+            purge_interval_seconds=config.get('metrics_purge_interval_seconds', 3600)
+        )
+        # Smoothed refuel/drain detection over fuel level series (batch mode)
+        self.fuel_detector = FuelLevelDetector(config, self.logger)
+        # Batched handlers per sensor kind, resolved once per unit sensor
+        self.event_handlers = EventHandlerRegistry(
+            self.logger, config.get('sensor_kind_retry_seconds', 300))
+        self.event_handlers.register('fuel_level', self._handle_fuel_level_batch)
+        self.event_handlers.register('fuel_flow', self._handle_fuel_flow_batch)
         
     def _setup_logger(self):
         """Set up logging for the fuel processor"""
         logger = logging.getLogger('fuel_processor')
+        if logger.handlers:
+            # Set up by an earlier processor in this process
+            return logger
         logger.setLevel(logging.INFO)
         handler = logging.FileHandler('fuel_processor.log')
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -28,65 +95,579 @@ class FuelDataProcessor:
             host=self.db_config.get('host', 'localhost'),
             database=self.db_config.get('database', 'fuel_management'),
             user=self.db_config.get('user', 'fuel_admin'),
-            password=self.db_config.get('password', 'your_password')
+            password=self.db_config.get('password', 'your_password'),
+            # Counts the queries issued per processing stage
+            connection_factory=CountingConnection
         )
     
-    def process_new_data(self):
-        """Process new data from Wialon tables into application tables"""
-        conn = self._get_db_connection()
+    def process_new_data(self, conn=None):
+        """Process new data from Wialon tables into application tables.
+        
+        A long-running caller can pass its own connection, which is left open;
+        otherwise a connection is opened for this run and closed afterwards.
+        Returns True if the run completed without errors.
+        """
+        owns_connection = conn is None
+        if owns_connection:
+            conn = self._get_db_connection()
+        
         try:
-            # Process in this order:
-            self._process_new_sensor_readings(conn)
-            self._process_new_geozone_events(conn)
-            self._process_new_ibutton_events(conn)
-            self._match_transactions(conn)
+            if not self.resolve_shard_count(conn):
+                return False
             
-            conn.commit()
-            self.logger.info("Processed new data successfully")
+            self.lookups.ensure_fresh(conn)
+            warmed_now = not self._previous_readings_warmed
+            if warmed_now:
+                self._warm_previous_readings(conn)
+            
+            shards = self._acquire_shards(conn)
+            if not shards:
+                self.logger.info("All processing shards are held by other workers, skipping run")
+                return True
+            stale = self._claim_shard_generations(conn, shards)
+            # State warmed up in this run was just read from the database
+            if stale and not warmed_now:
+                self._forget_shard_state(conn, stale)
+            
+            try:
+                self.metrics.reset()
+                # Process in this order:
+                for shard in shards:
+                    with self.metrics.stage(conn, 'sensor_readings') as stage:
+                        stage.rows = self._process_new_sensor_readings(conn, shard)
+                    with self.metrics.stage(conn, 'geozone_events') as stage:
+                        stage.rows = self._process_new_geozone_events(conn, shard)
+                    with self.metrics.stage(conn, 'ibutton_events') as stage:
+                        stage.rows = self._process_new_ibutton_events(conn, shard)
+                self._match_transactions(conn)
+                
+                conn.commit()
+                self.logger.info(f"Processed new data successfully (shards {shards})")
+                self._write_metrics(conn)
+                return True
+            finally:
+                conn.rollback()
+                self._release_locks(conn, [self._shard_lock_key(shard) for shard in shards])
         except Exception as e:
-            conn.rollback()
+            if not conn.closed:
+                conn.rollback()
             self.logger.error(f"Error processing data: {str(e)}")
+            return False
         finally:
-            conn.close()
+            if owns_connection:
+                conn.close()
     
-    def _process_new_sensor_readings(self, conn):
-        """Process new sensor readings"""
+    def resolve_shard_count(self, conn):
+        """Load the deployment's shard_count, registering the configured one (or 1)
+        if none is stored yet. Returns False if this process must not run: its
+        configured shard_count differs from the stored one, or the stored one
+        changed since this process adopted it.
+        """
         cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO wialon_data.processing_shards (singleton, shard_count)
+            VALUES (TRUE, %s)
+            ON CONFLICT (singleton) DO NOTHING
+        """, (self.configured_shard_count or 1,))
+        cursor.execute("SELECT shard_count FROM wialon_data.processing_shards")
+        shard_count = cursor.fetchone()[0]
+        conn.commit()
         
-        try:
-            # Get unprocessed sensor readings
+        expected = self.shard_count or self.configured_shard_count
+        if expected is not None and expected != shard_count:
+            self.logger.error(
+                f"shard_count {expected} of this processor differs from the deployment's "
+                f"{shard_count} in wialon_data.processing_shards, refusing to process"
+            )
+            return False
+        
+        self.shard_count = shard_count
+        return True
+    
+    def _shard_lock_key(self, shard):
+        """Second advisory lock key of a shard, distinct for every shard_count"""
+        return self.shard_count * SHARD_LOCK_STRIDE + shard
+    
+    def _acquire_shards(self, conn):
+        """Claim free unit shards with session advisory locks, starting at worker_index"""
+        cursor = conn.cursor()
+        limit = self.max_shards_per_run or self.shard_count
+        shards = []
+        
+        for offset in range(self.shard_count):
+            shard = (self.worker_index + offset) % self.shard_count
+            cursor.execute("SELECT pg_try_advisory_lock(%s, %s)",
+                           (PROCESSOR_LOCK_NAMESPACE, self._shard_lock_key(shard)))
+            if cursor.fetchone()[0]:
+                shards.append(shard)
+                if len(shards) >= limit:
+                    break
+        
+        conn.commit()
+        return shards
+    
+    def _release_locks(self, conn, keys):
+        """Release session advisory locks taken by this processor"""
+        cursor = conn.cursor()
+        for key in keys:
+            cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (PROCESSOR_LOCK_NAMESPACE, key))
+        conn.commit()
+    
+    def _claim_shard_generations(self, conn, shards):
+        """Bump the generation of the held shards; return those another process has
+        run on since this process last did"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO wialon_data.processing_shard_generations AS g (shard_count, shard)
+            SELECT %s, shard FROM unnest(%s::integer[]) AS s(shard)
+            ON CONFLICT (shard_count, shard) DO UPDATE
+            SET generation = g.generation + 1,
+                updated_at = CURRENT_TIMESTAMP
+            RETURNING shard, generation
+        """, (self.shard_count, list(shards)))
+        generations = dict(cursor.fetchall())
+        conn.commit()
+        
+        stale = [shard for shard in shards if self._shard_generations.get(shard) != generations[shard] - 1]
+        self._shard_generations.update(generations)
+        return stale
+    
+    def _forget_shard_state(self, conn, shards):
+        """Drop the cached previous readings and fuel level tails of units in shards
+        another process has run on since this process last did"""
+        unit_ids = {key[0] for key in self._previous_readings}
+        unit_ids.update(key[0] for key in self.fuel_detector.tracked_keys())
+        if not unit_ids:
+            return
+        
+        if self.shard_count <= 1:
+            stale = unit_ids
+        else:
+            cursor = conn.cursor()
             cursor.execute("""
-                SELECT reading_id, unit_id, unit_name, sensor_id, sensor_name, value, timestamp, 
-                       latitude, longitude
-                FROM wialon_data.sensor_readings
-                WHERE processed = FALSE
-                ORDER BY timestamp
-            """)
-            
-            readings = cursor.fetchall()
-            self.logger.info(f"Processing {len(readings)} new sensor readings")
-            
-            for reading in readings:
-                reading_id, unit_id, unit_name, sensor_id, sensor_name, value, timestamp, lat, lon = reading
+                SELECT unit_id FROM unnest(%s::bigint[]) AS u(unit_id)
+                WHERE mod(hashtext(COALESCE(unit_id, 0)::text) & 2147483647, %s) = ANY(%s)
+            """, (list(unit_ids), self.shard_count, list(shards)))
+            stale = {row[0] for row in cursor.fetchall()}
+        
+        for key in [key for key in self._previous_readings if key[0] in stale]:
+            del self._previous_readings[key]
+        self.fuel_detector.forget_units(stale)
+        self.logger.info(f"Shards {list(shards)} were processed elsewhere, dropped cached state of {len(stale)} units")
+    
+    def _shard_filter(self, shard):
+        """SQL condition and parameters restricting a wialon_data table to one unit shard"""
+        if self.shard_count <= 1:
+            return "TRUE", ()
+        return "mod(hashtext(COALESCE(unit_id, 0)::text) & 2147483647, %s) = %s", (self.shard_count, shard)
+    
+    def _checkpoint_key(self, source_table, shard):
+        """Name of the checkpoint row for a source table and shard"""
+        if self.shard_count <= 1:
+            return source_table
+        return f"{source_table}:{shard}/{self.shard_count}"
+    
+    def _process_new_sensor_readings(self, conn, shard=0):
+        """Process new sensor readings"""
+        started = time.monotonic()
+        total = 0
+        
+        try:
+            # Stream unprocessed sensor readings chunk by chunk
+            for readings in self._stream_unprocessed(conn, 'sensor_readings', 'reading_id', """
+                reading_id, unit_id, unit_name, sensor_id, sensor_name, value, timestamp, 
+                latitude, longitude
+            """, shard):
+                if self.ingestion_mode == 'watermark':
+                    # Chunks arrive in ID order; fuel deltas need time order
+                    readings.sort(key=lambda r: r[6])
                 
-                # Determine reading type based on sensor name
-                if 'fuel_level' in sensor_name.lower():
-                    self._process_fuel_level_reading(conn, reading)
-                elif 'fuel_flow' in sensor_name.lower() or 'flow_meter' in sensor_name.lower():
-                    self._process_fuel_flow_reading(conn, reading)
+                if self.processing_mode == 'batch':
+                    self.event_handlers.dispatch(conn, readings)
+                else:
+                    self._process_sensor_reading_rows(conn, readings)
                 
-                # Mark as processed
-                cursor.execute("""
-                    UPDATE wialon_data.sensor_readings
-                    SET processed = TRUE
-                    WHERE reading_id = %s
-                """, (reading_id,))
+                # Commit per chunk so a failure loses at most one chunk of work
+                self._finish_chunk(conn, 'sensor_readings', 'reading_id', readings, shard)
+                conn.commit()
+                total += len(readings)
             
-            conn.commit()
+            self._log_throughput('sensor readings', total, time.monotonic() - started)
+            return total
         except Exception as e:
             self.logger.error(f"Error processing sensor readings: {str(e)}")
             raise
     
+    def _stream_unprocessed(self, conn, source_table, id_column, columns, shard=0):
+        """Stream the not yet processed rows of a wialon_data table shard in chunks"""
+        shard_condition, shard_params = self._shard_filter(shard)
+        
+        if self.ingestion_mode == 'watermark':
+            last_id = self._get_checkpoint(conn, source_table, id_column, shard)
+            # Stop below the first row that is still too young: created_at is not
+            # monotonic in the ID, and the checkpoint must never pass a skipped row
+            query = f"""
+                SELECT {columns}
+                FROM wialon_data.{source_table}
+                WHERE {id_column} > %s
+                AND {id_column} < COALESCE((
+                    SELECT MIN({id_column})
+                    FROM wialon_data.{source_table}
+                    WHERE {id_column} > %s
+                    AND created_at > LOCALTIMESTAMP - %s * INTERVAL '1 second'
+                    AND {shard_condition}
+                ), 9223372036854775807)
+                AND {shard_condition}
+                ORDER BY {id_column}
+            """
+            params = (last_id, last_id, self.watermark_lag_seconds) + shard_params + shard_params
+        else:
+            query = f"""
+                SELECT {columns}
+                FROM wialon_data.{source_table}
+                WHERE processed = FALSE
+                AND {shard_condition}
+                ORDER BY timestamp
+            """
+            params = shard_params
+        
+        return self._stream_rows(conn, f'unprocessed_{source_table}', query, params)
+    
+    def _get_checkpoint(self, conn, source_table, id_column, shard=0):
+        """Get the high-water mark of a source table shard, initializing it on first use"""
+        checkpoint_key = self._checkpoint_key(source_table, shard)
+        shard_condition, shard_params = self._shard_filter(shard)
+        
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT last_id FROM wialon_data.processing_checkpoints
+            WHERE source_table = %s
+        """, (checkpoint_key,))
+        
+        result = cursor.fetchone()
+        if result:
+            return result[0]
+        
+        if not self.mark_processed_rows:
+            # Without processed flags, a new key (e.g. after shard_count was
+            # changed) continues from the table's slowest existing checkpoint
+            # rather than replaying history
+            cursor.execute("""
+                SELECT MIN(last_id) FROM wialon_data.processing_checkpoints
+                WHERE source_table = %s OR source_table LIKE %s
+            """, (source_table, f"{source_table}:%"))
+            result = cursor.fetchone()
+            if result[0] is not None:
+                return self._store_initial_checkpoint(conn, checkpoint_key, result[0])
+        
+        # Start just below the oldest row still flagged unprocessed, so switching
+        # from flag mode neither skips nor replays rows
+        cursor.execute(f"""
+            SELECT COALESCE(MIN({id_column}) - 1,
+                            (SELECT MAX({id_column}) FROM wialon_data.{source_table}),
+                            0)
+            FROM wialon_data.{source_table}
+            WHERE processed = FALSE
+            AND {shard_condition}
+        """, shard_params)
+        return self._store_initial_checkpoint(conn, checkpoint_key, cursor.fetchone()[0])
+    
+    def _store_initial_checkpoint(self, conn, checkpoint_key, last_id):
+        """Create a checkpoint row unless another worker just did"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO wialon_data.processing_checkpoints (source_table, last_id)
+            VALUES (%s, %s)
+            ON CONFLICT (source_table) DO NOTHING
+        """, (checkpoint_key, last_id))
+        conn.commit()
+        
+        self.logger.info(f"Initialized {checkpoint_key} checkpoint at {last_id}")
+        return last_id
+    
+    def _finish_chunk(self, conn, source_table, id_column, rows, shard=0):
+        """Record a processed chunk: flag its rows and/or advance the checkpoint.
+        
+        Runs in the same transaction as the chunk's results, so the derived data
+        and the progress marker are committed together.
+        """
+        if not rows:
+            return
+        
+        cursor = conn.cursor()
+        
+        if self.mark_processed_rows:
+            cursor.execute(f"""
+                UPDATE wialon_data.{source_table}
+                SET processed = TRUE
+                WHERE {id_column} = ANY(%s)
+            """, ([row[0] for row in rows],))
+        
+        if self.ingestion_mode == 'watermark':
+            cursor.execute("""
+                INSERT INTO wialon_data.processing_checkpoints (source_table, last_id, updated_at)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (source_table) DO UPDATE
+                SET last_id = GREATEST(processing_checkpoints.last_id, EXCLUDED.last_id),
+                    updated_at = EXCLUDED.updated_at
+            """, (self._checkpoint_key(source_table, shard), max(row[0] for row in rows), datetime.now()))
+    
+    def _stream_rows(self, conn, name, query, params=None):
+        """Yield the rows of a query in chunks of batch_size from a server-side cursor.
+        
+        The cursor is declared WITH HOLD so that the caller can commit after each
+        chunk without invalidating it; only one chunk is held in memory at a time.
+        """
+        cursor = conn.cursor(name=name, withhold=True)
+        cursor.itersize = self.batch_size
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            try:
+                cursor.close()
+            except psycopg2.Error:
+                # The transaction was aborted; the cursor goes with the connection
+                pass
+    
+    def _process_sensor_reading_rows(self, conn, readings):
+        """Process a chunk of sensor readings one row at a time"""
+        self.event_handlers.resolve(conn, readings)
+        
+        # Load previous readings for all sensors up front, not per row
+        self._prime_previous_readings(conn, [r for r in readings if self.event_handlers.kind_of(r[1], r[3])])
+        
+        for reading in readings:
+            reading_id, unit_id, unit_name, sensor_id, sensor_name, value, timestamp, lat, lon = reading
+            
+            # Determine reading type from the sensor's resolved kind
+            reading_kind = self.event_handlers.kind_of(unit_id, sensor_id)
+            if reading_kind == 'fuel_level':
+                self._process_fuel_level_reading(conn, reading)
+            elif reading_kind == 'fuel_flow':
+                self._process_fuel_flow_reading(conn, reading)
+    
+    def _log_throughput(self, label, row_count, elapsed):
+        """Log rows processed and rows per second for a processing stage"""
+        rate = row_count / elapsed if elapsed > 0 else 0.0
+        self.logger.info(
+            f"Processed {row_count} {label} in {elapsed:.2f}s "
+            f"({rate:.1f} rows/s, mode={self.processing_mode})"
+        )
+    
+    def _handle_fuel_level_batch(self, conn, readings):
+        """Detect fuel receptions and drains and update vehicle status for a batch
+        of fuel level readings"""
+        # Sensors without a tail in memory continue from their stored readings,
+        # so events spanning two runs or processes are still detected
+        cold = self.fuel_detector.cold_keys(readings)
+        for key, rows in self._fetch_fuel_level_context(conn, cold).items():
+            self.fuel_detector.seed(key, rows)
+        
+        fuel_events = self.fuel_detector.detect(readings)
+        self._record_fuel_batch(conn, readings, 'fuel_level', fuel_events)
+    
+    def _fetch_fuel_level_context(self, conn, first_seen):
+        """Get the readings preceding each (unit_id, sensor_id) -> timestamp within the
+        fuel detector's context, oldest first, in one query"""
+        if not first_seen:
+            return {}
+        
+        context = timedelta(seconds=self.fuel_detector.context_seconds())
+        cursor = conn.cursor()
+        rows = execute_values(cursor, f"""
+            SELECT k.unit_id, k.sensor_id, p.timestamp, p.value, p.latitude, p.longitude
+            FROM (VALUES %s) AS k(unit_id, sensor_id, first_timestamp, context_start)
+            CROSS JOIN LATERAL (
+                SELECT timestamp, value, latitude, longitude
+                FROM wialon_data.sensor_readings sr
+                WHERE sr.unit_id = k.unit_id AND sr.sensor_id = k.sensor_id
+                AND sr.timestamp < k.first_timestamp
+                AND sr.timestamp >= k.context_start
+                ORDER BY sr.timestamp DESC
+                LIMIT {int(self.fuel_detector.max_tail_samples)}
+            ) p
+        """, [(unit_id, sensor_id, ts, ts - context) for (unit_id, sensor_id), ts in first_seen.items()],
+            template='(%s::bigint, %s::bigint, %s::timestamp, %s::timestamp)', fetch=True)
+        
+        context = {}
+        for unit_id, sensor_id, timestamp, value, lat, lon in sorted(rows, key=lambda row: row[2]):
+            context.setdefault((unit_id, sensor_id), []).append((timestamp, value, lat, lon))
+        return context
+    
+    def _handle_fuel_flow_batch(self, conn, readings):
+        """Detect dispensations and update bowser status for a batch of flow meter readings"""
+        previous = self._prime_previous_readings(conn, readings)
+        fuel_events = detect_dispensations(readings, previous)
+        self._record_fuel_batch(conn, readings, 'fuel_flow', fuel_events)
+    
+    def _record_fuel_batch(self, conn, readings, reading_kind, fuel_events):
+        """Write the fuel events derived from a batch of readings and the newest
+        status per unit with a handful of bulk statements"""
+        cursor = conn.cursor()
+        
+        latest_status = {}
+        for reading in readings:
+            reading_id, unit_id, unit_name, sensor_id, sensor_name, value, timestamp, lat, lon = reading
+            self._remember_reading(unit_id, sensor_id, value, timestamp)
+            # Only the newest reading per unit matters for its status row
+            latest = latest_status.get(unit_id)
+            if not latest or latest[4] <= timestamp:
+                latest_status[unit_id] = (unit_id, value, lat, lon, timestamp)
+        
+        if fuel_events:
+            execute_values(cursor, """
+                INSERT INTO fuel_management.fuel_events
+                (unit_id, event_type, timestamp, amount, latitude, longitude)
+                VALUES %s
+            """, fuel_events)
+            self.logger.info(f"Recorded {len(fuel_events)} fuel events from {len(readings)} sensor readings")
+        
+        self._write_status_batch(conn, reading_kind, latest_status)
+    
+    def _warm_previous_readings(self, conn):
+        """Load the latest processed reading per sensor into the previous-reading cache"""
+        if self.ingestion_mode == 'watermark':
+            processed_condition = """reading_id <= COALESCE((
+                SELECT MIN(last_id) FROM wialon_data.processing_checkpoints
+                WHERE source_table = 'sensor_readings'
+                OR source_table LIKE 'sensor_readings:%%'), 0)"""
+        else:
+            processed_condition = "processed = TRUE"
+        
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT unit_id, sensor_id, value, timestamp
+            FROM (
+                SELECT DISTINCT ON (unit_id, sensor_id) unit_id, sensor_id, value, timestamp
+                FROM wialon_data.sensor_readings
+                WHERE {processed_condition}
+                ORDER BY unit_id, sensor_id, timestamp DESC
+            ) latest
+            ORDER BY timestamp DESC
+            LIMIT %s
+        """, (self.previous_reading_cache_size,))
+        
+        # Oldest first, so the most recently active sensors end up most recently used
+        for unit_id, sensor_id, value, timestamp in reversed(cursor.fetchall()):
+            self._remember_reading(unit_id, sensor_id, value, timestamp)
+        
+        self._previous_readings_warmed = True
+        self.logger.info(f"Warmed previous-reading cache with {len(self._previous_readings)} sensors")
+    
+    def _remember_reading(self, unit_id, sensor_id, value, timestamp):
+        """Record the latest reading for a sensor, evicting the least recently used"""
+        key = (unit_id, sensor_id)
+        cached = self._previous_readings.get(key)
+        if cached and cached[1] > timestamp:
+            return
+        
+        self._previous_readings[key] = (value, timestamp)
+        self._previous_readings.move_to_end(key)
+        while len(self._previous_readings) > self.previous_reading_cache_size:
+            self._previous_readings.popitem(last=False)
+    
+    def _previous_reading(self, unit_id, sensor_id, timestamp):
+        """Get the cached reading preceding timestamp, or None"""
+        cached = self._previous_readings.get((unit_id, sensor_id))
+        if cached and cached[1] < timestamp:
+            self._previous_readings.move_to_end((unit_id, sensor_id))
+            return cached
+        return None
+    
+    def _prime_previous_readings(self, conn, readings):
+        """Get the reading preceding a chunk for each (unit_id, sensor_id).
+        
+        Served from the cache where possible; sensors that are not cached, or whose
+        cached reading is not older than the chunk (late data), are fetched together
+        in a single query.
+        """
+        first_seen = {}
+        for reading in readings:
+            key = (reading[1], reading[3])
+            if key not in first_seen:
+                first_seen[key] = reading[6]
+        
+        previous = {}
+        misses = {}
+        for key, first_timestamp in first_seen.items():
+            cached = self._previous_readings.get(key)
+            if cached and cached[1] < first_timestamp:
+                previous[key] = cached
+            else:
+                misses[key] = first_timestamp
+        
+        previous.update(self._fetch_previous_readings(conn, misses))
+        for (unit_id, sensor_id), (value, timestamp) in previous.items():
+            self._remember_reading(unit_id, sensor_id, value, timestamp)
+        return previous
+    
+    def _fetch_previous_readings(self, conn, first_seen):
+        """Get the reading preceding each (unit_id, sensor_id) -> timestamp in one query"""
+        if not first_seen:
+            return {}
+        
+        cursor = conn.cursor()
+        rows = execute_values(cursor, """
+            SELECT k.unit_id, k.sensor_id, p.value, p.timestamp
+            FROM (VALUES %s) AS k(unit_id, sensor_id, first_timestamp)
+            CROSS JOIN LATERAL (
+                SELECT value, timestamp
+                FROM wialon_data.sensor_readings sr
+                WHERE sr.unit_id = k.unit_id AND sr.sensor_id = k.sensor_id
+                AND sr.timestamp < k.first_timestamp
+                ORDER BY sr.timestamp DESC
+                LIMIT 1
+            ) p
+        """, [(unit_id, sensor_id, ts) for (unit_id, sensor_id), ts in first_seen.items()],
+            template='(%s::bigint, %s::bigint, %s::timestamp)', fetch=True)
+        
+        return {(unit_id, sensor_id): (value, ts) for unit_id, sensor_id, value, ts in rows}
+    
+    def _lookup(self, conn, lookup, key):
+        """Look up a reference mapping, reloading the lookup cache on a miss of a new key"""
+        value = lookup(key)
+        if value is None and self.lookups.reload_on_miss(conn, (lookup.__name__, key)):
+            value = lookup(key)
+        return value
+    
+    def _write_status_batch(self, conn, reading_kind, latest):
+        """Write the latest vehicle (fuel level) or bowser (fuel flow) status per unit"""
+        if not latest:
+            return
+        
+        if reading_kind == 'fuel_level':
+            status_table, value_column, lookup = 'vehicle_status', 'fuel_level', self.lookups.vehicle_id
+        else:
+            status_table, value_column, lookup = 'bowser_status', 'total_dispensed', self.lookups.bowser_id
+        
+        # Only units registered as vehicles/bowsers get a status row
+        rows = [row for unit_id, row in latest.items() if self._lookup(conn, lookup, unit_id)]
+        if not rows:
+            return
+        
+        cursor = conn.cursor()
+        
+        # One upsert for the whole batch; a row never moves a unit's status back
+        # in time, so late or replayed readings cannot overwrite newer state
+        execute_values(cursor, f"""
+            INSERT INTO fuel_management.{status_table} AS s
+            (unit_id, {value_column}, latitude, longitude, timestamp)
+            VALUES %s
+            ON CONFLICT (unit_id) DO UPDATE
+            SET {value_column} = EXCLUDED.{value_column},
+                latitude = EXCLUDED.latitude,
+                longitude = EXCLUDED.longitude,
+                timestamp = EXCLUDED.timestamp,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE s.timestamp IS NULL OR EXCLUDED.timestamp > s.timestamp
+        """, rows, template='(%s::bigint, %s::double precision, %s::double precision, '
+                             '%s::double precision, %s::timestamp)')
+    
     def _process_fuel_level_reading(self, conn, reading):
         """Process a fuel level sensor reading"""
         reading_id, unit_id, unit_name, sensor_id, sensor_name, value, timestamp, lat, lon = reading
@@ -94,15 +675,8 @@ class FuelDataProcessor:
         
         try:
             # Get previous reading to detect significant changes
-            cursor.execute("""
-                SELECT value, timestamp
-                FROM wialon_data.sensor_readings
-                WHERE unit_id = %s AND sensor_id = %s AND timestamp < %s
-                ORDER BY timestamp DESC
-                LIMIT 1
-            """, (unit_id, sensor_id, timestamp))
-            
-            prev_reading = cursor.fetchone()
+            prev_reading = self._previous_reading(unit_id, sensor_id, timestamp)
+            self._remember_reading(unit_id, sensor_id, value, timestamp)
             
             if prev_reading:
                 prev_value, prev_timestamp = prev_reading
@@ -122,33 +696,8 @@ class FuelDataProcessor:
                     event_id = cursor.fetchone()[0]
                     self.logger.info(f"Recorded fuel reception event {event_id} for unit {unit_id}: {value_diff} liters")
             
-            # Find the vehicle ID from the unit ID
-            cursor.execute("""
-                SELECT vehicle_id FROM fuel_management.vehicles
-                WHERE wialon_unit_id = %s
-            """, (unit_id,))
-            
-            vehicle_result = cursor.fetchone()
-            if vehicle_result:
-                vehicle_id = vehicle_result[0]
-                
-                # Update vehicle status
-                cursor.execute("""
-                    UPDATE fuel_management.vehicle_status
-                    SET fuel_level = %s,
-                        latitude = %s,
-                        longitude = %s,
-                        timestamp = %s
-                    WHERE unit_id = %s
-                """, (value, lat, lon, timestamp, unit_id))
-                
-                if cursor.rowcount == 0:
-                    # Insert new status if not exists
-                    cursor.execute("""
-                        INSERT INTO fuel_management.vehicle_status
-                        (unit_id, fuel_level, latitude, longitude, timestamp)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """, (unit_id, value, lat, lon, timestamp))
+            # Update vehicle status (skipped for units that are not vehicles)
+            self._write_status_batch(conn, 'fuel_level', {unit_id: (unit_id, value, lat, lon, timestamp)})
         
         except Exception as e:
             self.logger.error(f"Error processing fuel level reading: {str(e)}")
@@ -161,15 +710,8 @@ class FuelDataProcessor:
         
         try:
             # Get previous reading to calculate flow
-            cursor.execute("""
-                SELECT value, timestamp
-                FROM wialon_data.sensor_readings
-                WHERE unit_id = %s AND sensor_id = %s AND timestamp < %s
-                ORDER BY timestamp DESC
-                LIMIT 1
-            """, (unit_id, sensor_id, timestamp))
-            
-            prev_reading = cursor.fetchone()
+            prev_reading = self._previous_reading(unit_id, sensor_id, timestamp)
+            self._remember_reading(unit_id, sensor_id, value, timestamp)
             
             if prev_reading:
                 prev_value, prev_timestamp = prev_reading
@@ -189,390 +731,269 @@ class FuelDataProcessor:
                     event_id = cursor.fetchone()[0]
                     self.logger.info(f"Recorded fuel dispensation event {event_id} for bowser {unit_id}: {value_diff} liters")
             
-            # Find the bowser ID from the unit ID
-            cursor.execute("""
-                SELECT bowser_id FROM fuel_management.bowsers
-                WHERE wialon_unit_id = %s
-            """, (unit_id,))
-            
-            bowser_result = cursor.fetchone()
-            if bowser_result:
-                bowser_id = bowser_result[0]
-                
-                # Update bowser status
-                cursor.execute("""
-                    UPDATE fuel_management.bowser_status
-                    SET total_dispensed = %s,
-                        latitude = %s,
-                        longitude = %s,
-                        timestamp = %s
-                    WHERE unit_id = %s
-                """, (value, lat, lon, timestamp, unit_id))
-                
-                if cursor.rowcount == 0:
-                    # Insert new status if not exists
-                    cursor.execute("""
-                        INSERT INTO fuel_management.bowser_status
-                        (unit_id, total_dispensed, latitude, longitude, timestamp)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """, (unit_id, value, lat, lon, timestamp))
+            # Update bowser status (skipped for units that are not bowsers)
+            self._write_status_batch(conn, 'fuel_flow', {unit_id: (unit_id, value, lat, lon, timestamp)})
         
         except Exception as e:
             self.logger.error(f"Error processing fuel flow reading: {str(e)}")
             raise
     
-    def _process_new_geozone_events(self, conn):
+    def _process_new_geozone_events(self, conn, shard=0):
         """Process new geozone events"""
-        cursor = conn.cursor()
+        started = time.monotonic()
+        total = 0
         
         try:
-            # Get unprocessed geozone events
-            cursor.execute("""
-                SELECT event_id, unit_id, geozone_id, event_type, timestamp, 
-                       latitude, longitude
-                FROM wialon_data.geozone_events
-                WHERE processed = FALSE
-                ORDER BY timestamp
-            """)
+            # Stream unprocessed geozone events chunk by chunk
+            for events in self._stream_unprocessed(conn, 'geozone_events', 'event_id', """
+                event_id, unit_id, geozone_id, event_type, timestamp, 
+                latitude, longitude
+            """, shard):
+                self._process_geozone_event_rows(conn, events)
+                self._finish_chunk(conn, 'geozone_events', 'event_id', events, shard)
+                conn.commit()
+                total += len(events)
             
-            events = cursor.fetchall()
-            self.logger.info(f"Processing {len(events)} new geozone events")
-            
-            for event in events:
-                event_id, unit_id, geozone_id, event_type, timestamp, lat, lon = event
-                
-                # Find the vehicle ID from the unit ID
-                cursor.execute("""
-                    SELECT vehicle_id FROM fuel_management.vehicles
-                    WHERE wialon_unit_id = %s
-                """, (unit_id,))
-                
-                vehicle_result = cursor.fetchone()
-                if not vehicle_result:
-                    # Mark as processed even if we couldn't find a vehicle
-                    cursor.execute("""
-                        UPDATE wialon_data.geozone_events
-                        SET processed = TRUE
-                        WHERE event_id = %s
-                    """, (event_id,))
-                    continue
-                
-                vehicle_id = vehicle_result[0]
-                
-                # Check if this geozone is associated with a bowser
-                cursor.execute("""
-                    SELECT bowser_id FROM fuel_management.bowsers
-                    WHERE geozone_id = %s
-                """, (geozone_id,))
-                
-                bowser_result = cursor.fetchone()
-                if bowser_result:
-                    bowser_id = bowser_result[0]
-                    
-                    # Record vehicle proximity to bowser
-                    cursor.execute("""
-                        INSERT INTO fuel_management.vehicle_bowser_proximity
-                        (vehicle_id, bowser_id, event_type, timestamp, latitude, longitude)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """, (vehicle_id, bowser_id, event_type, timestamp, lat, lon))
-                    
-                    self.logger.info(f"Recorded proximity event: Vehicle {vehicle_id} {event_type} bowser {bowser_id} geozone")
-                
-                # Mark as processed
-                cursor.execute("""
-                    UPDATE wialon_data.geozone_events
-                    SET processed = TRUE
-                    WHERE event_id = %s
-                """, (event_id,))
-            
-            conn.commit()
+            self._log_throughput('geozone events', total, time.monotonic() - started)
+            return total
         except Exception as e:
             self.logger.error(f"Error processing geozone events: {str(e)}")
             raise
     
-    def _process_new_ibutton_events(self, conn):
-        """Process new iButton events"""
+    def _process_geozone_event_rows(self, conn, events):
+        """Process a chunk of geozone events"""
         cursor = conn.cursor()
         
-        try:
-            # Get unprocessed iButton events
-            cursor.execute("""
-                SELECT event_id, unit_id, ibutton_code, timestamp, 
-                       latitude, longitude
-                FROM wialon_data.ibutton_events
-                WHERE processed = FALSE
-                ORDER BY timestamp
-            """)
+        for event in events:
+            event_id, unit_id, geozone_id, event_type, timestamp, lat, lon = event
             
-            events = cursor.fetchall()
-            self.logger.info(f"Processing {len(events)} new iButton events")
+            # Find the vehicle ID from the unit ID
+            vehicle_id = self._lookup(conn, self.lookups.vehicle_id, unit_id)
+            if not vehicle_id:
+                # Skipped, but still marked as processed with the rest of the chunk
+                continue
             
-            for event in events:
-                event_id, unit_id, ibutton_code, timestamp, lat, lon = event
-                
-                # Find the vehicle ID from the unit ID
-                cursor.execute("""
-                    SELECT vehicle_id FROM fuel_management.vehicles
-                    WHERE wialon_unit_id = %s
-                """, (unit_id,))
-                
-                vehicle_result = cursor.fetchone()
-                if not vehicle_result:
-                    # Mark as processed even if we couldn't find a vehicle
-                    cursor.execute("""
-                        UPDATE wialon_data.ibutton_events
-                        SET processed = TRUE
-                        WHERE event_id = %s
-                    """, (event_id,))
-                    continue
-                
-                vehicle_id = vehicle_result[0]
-                
-                # Look up driver by iButton code
+            # Check if this geozone is associated with a bowser
+            bowser_id = self._lookup(conn, self.lookups.bowser_for_geozone, geozone_id)
+            if bowser_id:
+                # Record vehicle proximity to bowser
                 cursor.execute("""
-                    SELECT driver_id, name FROM fuel_management.drivers
-                    WHERE ibutton_code = %s
-                """, (ibutton_code,))
+                    INSERT INTO fuel_management.vehicle_bowser_proximity
+                    (vehicle_id, bowser_id, event_type, timestamp, latitude, longitude)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                """, (vehicle_id, bowser_id, event_type, timestamp, lat, lon))
                 
-                driver_result = cursor.fetchone()
-                if driver_result:
-                    driver_id, driver_name = driver_result
-                    
-                    # Record authentication event
-                    cursor.execute("""
-                        INSERT INTO fuel_management.authentication_events
-                        (driver_id, vehicle_id, ibutton_code, timestamp, latitude, longitude)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                        RETURNING event_id
-                    """, (driver_id, vehicle_id, ibutton_code, timestamp, lat, lon))
-                    
-                    auth_event_id = cursor.fetchone()[0]
-                    self.logger.info(f"Recorded authentication event {auth_event_id}: Driver {driver_name} on vehicle {vehicle_id}")
-                    
-                    # Check if vehicle is near a bowser
-                    self._check_and_initiate_transaction(conn, driver_id, vehicle_id, timestamp, lat, lon)
-                else:
-                    self.logger.warning(f"Unknown iButton code: {ibutton_code}")
-                
-                # Mark as processed
-                cursor.execute("""
-                    UPDATE wialon_data.ibutton_events
-                    SET processed = TRUE
-                    WHERE event_id = %s
-                """, (event_id,))
+                self.logger.info(f"Recorded proximity event: Vehicle {vehicle_id} {event_type} bowser {bowser_id} geozone")
+    
+    def _process_new_ibutton_events(self, conn, shard=0):
+        """Process new iButton events"""
+        started = time.monotonic()
+        total = 0
+        
+        try:
+            # Stream unprocessed iButton events chunk by chunk
+            for events in self._stream_unprocessed(conn, 'ibutton_events', 'event_id', """
+                event_id, unit_id, ibutton_code, timestamp, 
+                latitude, longitude
+            """, shard):
+                self._process_ibutton_event_rows(conn, events)
+                self._finish_chunk(conn, 'ibutton_events', 'event_id', events, shard)
+                conn.commit()
+                total += len(events)
             
-            conn.commit()
+            self._log_throughput('iButton events', total, time.monotonic() - started)
+            return total
         except Exception as e:
             self.logger.error(f"Error processing iButton events: {str(e)}")
             raise
     
-    def _check_and_initiate_transaction(self, conn, driver_id, vehicle_id, timestamp, lat, lon):
-        """Check if vehicle is near a bowser and initiate transaction if so"""
+    def _process_ibutton_event_rows(self, conn, events):
+        """Process a chunk of iButton events"""
         cursor = conn.cursor()
         
-        try:
-            # Get all bowser locations
-            cursor.execute("""
-                SELECT b.bowser_id, b.name, g.center_latitude, g.center_longitude, g.radius
-                FROM fuel_management.bowsers b
-                JOIN wialon_data.geozones g ON b.geozone_id = g.geozone_id
-                WHERE b.active = TRUE
-            """)
+        for event in events:
+            event_id, unit_id, ibutton_code, timestamp, lat, lon = event
             
-            bowsers = cursor.fetchall()
+            # Find the vehicle ID from the unit ID
+            vehicle_id = self._lookup(conn, self.lookups.vehicle_id, unit_id)
+            if not vehicle_id:
+                # Skipped, but still marked as processed with the rest of the chunk
+                continue
             
-            for bowser in bowsers:
-                bowser_id, name, bowser_lat, bowser_lon, radius = bowser
+            # Look up driver by iButton code
+            driver_result = self._lookup(conn, self.lookups.driver, ibutton_code)
+            if driver_result:
+                driver_id, driver_name = driver_result
                 
-                # Calculate distance between vehicle and bowser
-                if lat and lon and bowser_lat and bowser_lon:
-                    distance = geodesic((lat, lon), (bowser_lat, bowser_lon)).meters
-                    
-                    # If within proximity threshold
-                    if distance <= (radius or self.geozone_proximity_threshold):
-                        # Check if there's already a pending transaction
-                        cursor.execute("""
-                            SELECT transaction_id FROM fuel_management.transactions
-                            WHERE driver_id = %s AND vehicle_id = %s AND bowser_id = %s
-                            AND status = 'pending'
-                            AND timestamp > %s
-                        """, (driver_id, vehicle_id, bowser_id, timestamp - timedelta(hours=1)))
-                        
-                        if cursor.fetchone():
-                            # Already have a pending transaction
-                            continue
-                        
-                        # Initiate a pending transaction
-                        import uuid
-                        transaction_id = str(uuid.uuid4())
-                        
-                        cursor.execute("""
-                            INSERT INTO fuel_management.transactions
-                            (transaction_id, driver_id, vehicle_id, bowser_id, timestamp, status)
-                            VALUES (%s, %s, %s, %s, %s, 'pending')
-                            RETURNING transaction_id
-                        """, (transaction_id, driver_id, vehicle_id, bowser_id, timestamp))
-                        
-                        transaction_id = cursor.fetchone()[0]
-                        self.logger.info(f"Initiated transaction {transaction_id}: Driver {driver_id}, Vehicle {vehicle_id}, Bowser {bowser_id}")
-                        
-                        # Return after finding the first match
-                        return transaction_id
-            
-            return None
-        except Exception as e:
-            self.logger.error(f"Error checking bowser proximity: {str(e)}")
-            raise
+                # Record authentication event
+                cursor.execute("""
+                    INSERT INTO fuel_management.authentication_events
+                    (driver_id, vehicle_id, ibutton_code, timestamp, latitude, longitude)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    RETURNING event_id
+                """, (driver_id, vehicle_id, ibutton_code, timestamp, lat, lon))
+                
+                auth_event_id = cursor.fetchone()[0]
+                self.logger.info(f"Recorded authentication event {auth_event_id}: Driver {driver_name} on vehicle {vehicle_id}")
+                
+                # Check if vehicle is near a bowser
+                self._check_and_initiate_transaction(conn, driver_id, vehicle_id, timestamp, lat, lon)
+            else:
+                self.logger.warning(f"Unknown iButton code: {ibutton_code}")
     
-    def _match_transactions(self, conn):
-        """Match dispensation events with transactions and vehicle fuel level changes"""
+    def _check_and_initiate_transaction(self, conn, driver_id, vehicle_id, timestamp, lat, lon):
+        """Check if vehicle is near a bowser and initiate transaction if so"""
         cursor = conn.cursor()
         
         try:
-            # Get pending transactions
-            cursor.execute("""
-                SELECT transaction_id, driver_id, vehicle_id, bowser_id, timestamp
-                FROM fuel_management.transactions
-                WHERE status = 'pending'
-                ORDER BY timestamp
-            """)
+            if not lat or not lon:
+                return None
             
-            transactions = cursor.fetchall()
-            self.logger.info(f"Processing {len(transactions)} pending transactions")
-            
-            for transaction in transactions:
-                transaction_id, driver_id, vehicle_id, bowser_id, timestamp = transaction
-                
-                # Get the bowser's Wialon unit ID
+            # Bowser zones containing the vehicle, from the in-memory spatial index
+            for bowser_id in self.lookups.bowsers_near(lat, lon):
+                # Check if there's already a pending transaction
                 cursor.execute("""
-                    SELECT wialon_unit_id FROM fuel_management.bowsers
-                    WHERE bowser_id = %s
-                """, (bowser_id,))
+                    SELECT transaction_id FROM fuel_management.transactions
+                    WHERE driver_id = %s AND vehicle_id = %s AND bowser_id = %s
+                    AND status = 'pending'
+                    AND timestamp > %s
+                """, (driver_id, vehicle_id, bowser_id, timestamp - timedelta(hours=1)))
                 
-                bowser_unit_result = cursor.fetchone()
-                if not bowser_unit_result:
+                if cursor.fetchone():
+                    # Already have a pending transaction
                     continue
                 
-                bowser_unit_id = bowser_unit_result[0]
+                # Initiate a pending transaction; the ID is derived from the
+                # authentication, so a re-delivered event cannot create a duplicate
+                transaction_id = derived_transaction_id(driver_id, vehicle_id, bowser_id, timestamp)
                 
-                # Look for dispensation events from this bowser shortly after the transaction was initiated
                 cursor.execute("""
-                    SELECT event_id, amount, timestamp
-                    FROM fuel_management.fuel_events
-                    WHERE unit_id = %s 
-                    AND event_type = 'dispensed'
-                    AND timestamp BETWEEN %s AND %s
-                    AND transaction_id IS NULL
-                    ORDER BY timestamp
-                    LIMIT 1
-                """, (bowser_unit_id, timestamp, timestamp + timedelta(minutes=30)))
+                    INSERT INTO fuel_management.transactions
+                    (transaction_id, driver_id, vehicle_id, bowser_id, timestamp, status, verification_method)
+                    VALUES (%s, %s, %s, %s, %s, 'pending', 'ibutton')
+                    ON CONFLICT (transaction_id) DO NOTHING
+                    RETURNING transaction_id
+                """, (transaction_id, driver_id, vehicle_id, bowser_id, timestamp))
                 
-                dispensation = cursor.fetchone()
+                if cursor.fetchone() is None:
+                    return transaction_id
                 
-                if dispensation:
-                    dispensation_id, dispensed_amount, dispensation_time = dispensation
-                    
-                    # Update the dispensation event with the transaction ID
-                    cursor.execute("""
-                        UPDATE fuel_management.fuel_events
-                        SET transaction_id = %s
-                        WHERE event_id = %s
-                    """, (transaction_id, dispensation_id))
-                    
-                    # Get the vehicle's Wialon unit ID
-                    cursor.execute("""
-                        SELECT wialon_unit_id FROM fuel_management.vehicles
-                        WHERE vehicle_id = %s
-                    """, (vehicle_id,))
-                    
-                    vehicle_unit_result = cursor.fetchone()
-                    if not vehicle_unit_result:
-                        continue
-                    
-                    vehicle_unit_id = vehicle_unit_result[0]
-                    
-                    # Look for corresponding fuel reception in the vehicle
-                    cursor.execute("""
-                        SELECT event_id, amount, timestamp
-                        FROM fuel_management.fuel_events
-                        WHERE unit_id = %s 
-                        AND event_type = 'received'
-                        AND timestamp BETWEEN %s AND %s
-                        AND transaction_id IS NULL
-                        ORDER BY timestamp
-                        LIMIT 1
-                    """, (vehicle_unit_id, dispensation_time, dispensation_time + timedelta(minutes=30)))
-                    
-                    reception = cursor.fetchone()
-                    
-                    if reception:
-                        reception_id, received_amount, reception_time = reception
-                        
-                        # Update the reception event with the transaction ID
-                        cursor.execute("""
-                            UPDATE fuel_management.fuel_events
-                            SET transaction_id = %s
-                            WHERE event_id = %s
-                        """, (transaction_id, reception_id))
-                        
-                        # Calculate discrepancy
-                        discrepancy = dispensed_amount - received_amount
-                        discrepancy_percentage = (discrepancy / dispensed_amount * 100) if dispensed_amount > 0 else 0
-                        
-                        # Determine status based on discrepancy
-                        status = 'completed'
-                        if abs(discrepancy_percentage) > 5:  # 5% threshold
-                            status = 'discrepancy'
-                        
-                        # Update transaction
-                        cursor.execute("""
-                            UPDATE fuel_management.transactions
-                            SET dispensed_amount = %s,
-                                received_amount = %s,
-                                discrepancy = %s,
-                                discrepancy_percentage = %s,
-                                status = %s
-                            WHERE transaction_id = %s
-                        """, (
-                            dispensed_amount,
-                            received_amount,
-                            discrepancy,
-                            discrepancy_percentage,
-                            status,
-                            transaction_id
-                        ))
-                        
-                        self.logger.info(f"Matched transaction {transaction_id}: Dispensed {dispensed_amount}, Received {received_amount}, Status: {status}")
-                    else:
-                        # Update transaction with just the dispensed amount
-                        cursor.execute("""
-                            UPDATE fuel_management.transactions
-                            SET dispensed_amount = %s,
-                                status = 'partial'
-                            WHERE transaction_id = %s
-                        """, (dispensed_amount, transaction_id))
-                        
-                        self.logger.info(f"Partially matched transaction {transaction_id}: Dispensed {dispensed_amount}, no reception event found")
+                self.logger.info(f"Initiated transaction {transaction_id}: Driver {driver_id}, Vehicle {vehicle_id}, Bowser {bowser_id}")
                 
-                # Check if the transaction has been pending for too long
-                elapsed_time = datetime.now() - timestamp
-                if elapsed_time > timedelta(hours=1):
-                    # Update status to timed out
-                    cursor.execute("""
-                        UPDATE fuel_management.transactions
-                        SET status = 'timed_out'
-                        WHERE transaction_id = %s
-                        AND status = 'pending'
-                    """, (transaction_id,))
-                    
-                    self.logger.info(f"Transaction {transaction_id} timed out")
+                # Return after finding the first match
+                return transaction_id
             
+            return None
+        except Exception as e:
+            self.logger.error(f"Error checking bowser proximity: {str(e)}")
+            raise
+    
+    def _match_transactions(self, conn):
+        """Match dispensation events with transactions and vehicle fuel level changes,
+        then time out the pending transactions that can no longer match"""
+        def match_and_sweep():
+            with self.metrics.stage(conn, 'matching') as stage:
+                stage.rows = self.transaction_matcher.match(conn)['pending']
+            with self.metrics.stage(conn, 'timeout_sweep') as stage:
+                stage.rows = self.transaction_matcher.sweep_timeouts(conn)
+        
+        self._with_matching_lock(conn, match_and_sweep)
+    
+    def sweep_transaction_timeouts(self, conn):
+        """Run the transaction timeout sweep on its own, e.g. from a timer.
+        
+        Returns the number of transactions timed out, or None if matching was
+        running in another worker.
+        """
+        def sweep():
+            with self.metrics.stage(conn, 'timeout_sweep') as stage:
+                stage.rows = self.transaction_matcher.sweep_timeouts(conn)
+            return stage.rows
+        
+        self.metrics.reset()
+        timed_out = self._with_matching_lock(conn, sweep)
+        if timed_out is not None:
+            self._write_metrics(conn)
+        return timed_out
+    
+    def _write_metrics(self, conn):
+        """Store the run's stage metrics and the current backlog for monitoring,
+        and delete samples past their retention period.
+        
+        Runs after every processing run and timeout sweep timer. Failures are
+        logged and never fail the processing run itself.
+        """
+        if not self.metrics_enabled:
+            return
+        
+        try:
+            self.metrics.measure_backlog(conn, self.ingestion_mode)
+            self.metrics.flush(conn)
+            self.metrics.purge(conn)
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            self.logger.warning(f"Could not write processing metrics: {str(e)}")
+    
+    def _with_matching_lock(self, conn, work):
+        """Run work() and commit while holding the transaction matching lock"""
+        cursor = conn.cursor()
+        
+        # Matching spans all units, so only one worker at a time may run it
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (PROCESSOR_LOCK_NAMESPACE, MATCHING_LOCK_KEY))
+        if not cursor.fetchone()[0]:
+            self.logger.info("Transaction matching is running in another worker, skipping")
+            return None
+        
+        try:
+            result = work()
             conn.commit()
+            return result
         except Exception as e:
             self.logger.error(f"Error matching transactions: {str(e)}")
             raise
+        finally:
+            conn.rollback()
+            self._release_locks(conn, [MATCHING_LOCK_KEY])
+
+def _run_worker(config, worker_index):
+    """Entry point of one worker process in process_in_parallel"""
+    FuelDataProcessor(dict(config, worker_index=worker_index)).process_new_data()
+
+def process_in_parallel(config, workers):
+    """Run one processing pass with several worker processes.
+    
+    Each worker claims up to shard_count / workers unit shards, so all units of
+    a shard (and their ordering) stay with a single process. The deployment's
+    shard_count is never changed here; there are at most shard_count workers.
+    Returns False if the configured shard_count does not match the deployment's.
+    """
+    processor = FuelDataProcessor(config)
+    conn = processor._get_db_connection()
+    try:
+        if not processor.resolve_shard_count(conn):
+            return False
+    finally:
+        conn.close()
+    
+    shard_count = processor.shard_count
+    if workers > shard_count:
+        processor.logger.warning(f"Only {shard_count} shards, running {shard_count} workers instead of {workers}")
+        workers = shard_count
+    shards_per_worker = -(-shard_count // workers)
+    worker_config = dict(config, shard_count=shard_count, max_shards_per_run=shards_per_worker)
+    
+    with multiprocessing.Pool(workers) as pool:
+        pool.starmap(_run_worker, [(worker_config, i * shards_per_worker) for i in range(workers)])
+    return True
 
 if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Fuel data processor')
+    parser.add_argument('--workers', type=int, default=1, help='Number of parallel worker processes')
+    args = parser.parse_args()
+    
     # Example configuration
     config = {
         'database': {
@@ -581,9 +1002,26 @@ if __name__ == "__main__":
             'user': 'fuel_admin',
             'password': 'your_password'
         },
-        'geozone_proximity_meters': 50
+        'geozone_proximity_meters': 50,
+        'processing_mode': 'batch',
+        'batch_size': 1000,
+        'previous_reading_cache_size': 10000,
+        'lookup_cache_ttl_seconds': 300,
+        'dispense_match_window_minutes': 30,
+        'reception_match_window_minutes': 30,
+        'discrepancy_threshold_percent': 5,
+        'transaction_timeout_minutes': 60,
+        'refuel_threshold_liters': 5,
+        'drain_threshold_liters': 10,
+        'drain_window_minutes': 30,
+        'parked_radius_meters': 50,
+        'ingestion_mode': 'flag',
+        'watermark_lag_seconds': 60
     }
     
     # Create and run the processor
-    processor = FuelDataProcessor(config)
-    processor.process_new_data()
\ No newline at end of file
+    if args.workers > 1:
+        process_in_parallel(config, args.workers)
+    else:
+        processor = FuelDataProcessor(config)
+        processor.process_new_data()
\ No newline at end of file
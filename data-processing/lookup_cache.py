@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from spatial_index import BowserZoneIndex
+
+class LookupCache:
+    def __init__(self, ttl_seconds=300, logger=None, default_zone_radius=50):
+        """Initialize the cache of unit/vehicle/bowser/driver mappings"""
+        self.ttl_seconds = ttl_seconds
+        self.default_zone_radius = default_zone_radius
+        self.logger = logger or logging.getLogger('fuel_processor')
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._reloaded_on_miss = False
+        self._missed = set()  # keys still missing after a reload, until the TTL or invalidate()
+        # Set while reference changes invalidate the cache through NOTIFY (the
+        # processor daemon), which makes reloading on a miss unnecessary
+        self.notify_invalidation = False
+
+        self.vehicle_by_unit = {}    # wialon_unit_id -> vehicle_id
+        self.unit_by_vehicle = {}    # vehicle_id -> wialon_unit_id
+        self.bowser_by_unit = {}     # wialon_unit_id -> bowser_id
+        self.unit_by_bowser = {}     # bowser_id -> wialon_unit_id
+        self.bowser_by_geozone = {}  # geozone_id -> bowser_id
+        self.driver_by_ibutton = {}  # ibutton_code -> (driver_id, name)
+        self.bowser_zones = BowserZoneIndex(default_radius=default_zone_radius)
+
+    def invalidate(self):
+        """Force a reload on the next ensure_fresh() call"""
+        with self._lock:
+            self._loaded_at = None
+
+    def is_stale(self):
+        """Check whether the cache has expired or was never loaded"""
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl_seconds
+
+    def ensure_fresh(self, conn):
+        """Reload the mappings if the TTL has expired or the cache was invalidated.
+
+        Called at the start of each processing run; also allows one more
+        reload_on_miss() for the run. Keys that missed are retried once the
+        mappings are reloaded this way.
+        """
+        self._reloaded_on_miss = False
+        if self.is_stale():
+            self.refresh(conn)
+            self._missed = set()
+
+    def reload_on_miss(self, conn, key):
+        """Reload the mappings after a lookup miss of key, once per run; return whether it reloaded.
+
+        Vehicles, drivers or iButtons added within the TTL would otherwise
+        fail their lookup and be skipped for good. Keys that already missed
+        do not reload again until the TTL expires or the cache is invalidated,
+        and nothing is reloaded while NOTIFY invalidation is active.
+        """
+        if self.notify_invalidation or key in self._missed:
+            return False
+        self._missed.add(key)
+        if self._reloaded_on_miss:
+            return False
+        self._reloaded_on_miss = True
+        self.logger.info("Lookup miss, reloading lookup cache")
+        self.refresh(conn)
+        return True
+
+    def refresh(self, conn):
+        """Reload all mappings from the reference tables"""
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            SELECT vehicle_id, wialon_unit_id FROM fuel_management.vehicles
+        """)
+        vehicles = cursor.fetchall()
+
+        cursor.execute("""
+            SELECT bowser_id, wialon_unit_id, geozone_id FROM fuel_management.bowsers
+        """)
+        bowsers = cursor.fetchall()
+
+        cursor.execute("""
+            SELECT driver_id, name, ibutton_code FROM fuel_management.drivers
+            WHERE ibutton_code IS NOT NULL
+        """)
+        drivers = cursor.fetchall()
+
+        # Geozones of active bowsers, rebuilt into the spatial index with the mappings
+        cursor.execute("""
+            SELECT b.bowser_id, g.center_latitude, g.center_longitude, g.radius
+            FROM fuel_management.bowsers b
+            JOIN wialon_data.geozones g ON b.geozone_id = g.geozone_id
+            WHERE b.active = TRUE
+        """)
+        bowser_zones = BowserZoneIndex(cursor.fetchall(), default_radius=self.default_zone_radius)
+
+        with self._lock:
+            self.vehicle_by_unit = {unit_id: vehicle_id for vehicle_id, unit_id in vehicles if unit_id is not None}
+            self.unit_by_vehicle = {vehicle_id: unit_id for vehicle_id, unit_id in vehicles}
+            self.bowser_by_unit = {unit_id: bowser_id for bowser_id, unit_id, _ in bowsers if unit_id is not None}
+            self.unit_by_bowser = {bowser_id: unit_id for bowser_id, unit_id, _ in bowsers}
+            self.bowser_by_geozone = {geozone_id: bowser_id for bowser_id, _, geozone_id in bowsers if geozone_id is not None}
+            self.driver_by_ibutton = {code: (driver_id, name) for driver_id, name, code in drivers}
+            self.bowser_zones = bowser_zones
+            self._loaded_at = time.monotonic()
+
+        self.logger.info(
+            f"Loaded lookup cache: {len(vehicles)} vehicles, {len(bowsers)} bowsers, "
+            f"{len(drivers)} drivers, {bowser_zones.zone_count} bowser zones"
+        )
+
+    def vehicle_id(self, unit_id):
+        """Get the vehicle ID for a Wialon unit, or None"""
+        return self.vehicle_by_unit.get(unit_id)
+
+    def bowser_id(self, unit_id):
+        """Get the bowser ID for a Wialon unit, or None"""
+        return self.bowser_by_unit.get(unit_id)
+
+    def vehicle_unit_id(self, vehicle_id):
+        """Get the Wialon unit ID of a vehicle, or None"""
+        return self.unit_by_vehicle.get(vehicle_id)
+
+    def bowser_unit_id(self, bowser_id):
+        """Get the Wialon unit ID of a bowser, or None"""
+        return self.unit_by_bowser.get(bowser_id)
+
+    def bowser_for_geozone(self, geozone_id):
+        """Get the bowser ID associated with a geozone, or None"""
+        return self.bowser_by_geozone.get(geozone_id)
+
+    def bowsers_near(self, lat, lon):
+        """Get the IDs of active bowsers whose geozone contains the point, nearest first"""
+        return self.bowser_zones.zones_containing(lat, lon)
+
+    def driver(self, ibutton_code):
+        """Get (driver_id, name) for an iButton code, or None"""
+        return self.driver_by_ibutton.get(ibutton_code)
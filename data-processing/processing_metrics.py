@@ -0,0 +1,155 @@
+import logging
+import os
+import socket
+import time
+from contextlib import contextmanager
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+
+# Raw tables whose unprocessed rows make up the processing backlog
+BACKLOG_TABLES = (
+    ('sensor_readings', 'reading_id'),
+    ('geozone_events', 'event_id'),
+    ('ibutton_events', 'event_id'),
+)
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor that counts the statements it sends on its connection"""
+
+    def execute(self, query, vars=None):
+        self.connection.query_count += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        self.connection.query_count += 1
+        return super().executemany(query, vars_list)
+
+class CountingConnection(psycopg2.extensions.connection):
+    """Connection whose cursors count statements in query_count.
+
+    Pass as connection_factory to psycopg2.connect(). execute_values() issues
+    one statement per page, and each page is counted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.query_count = 0
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', CountingCursor)
+        return super().cursor(*args, **kwargs)
+
+class StageSample:
+    def __init__(self):
+        """Rows handled by a stage; set by the code running the stage"""
+        self.rows = 0
+
+class ProcessingMetrics:
+    def __init__(self, logger=None, worker=None, retention_days=30, purge_interval_seconds=3600):
+        """Initialize per-run stage metrics and backlog gauges of the processor"""
+        self.logger = logger or logging.getLogger('fuel_processor')
+        self.worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+        # Stored samples older than this are deleted, at most once per purge
+        # interval; None keeps them forever
+        self.retention_days = retention_days
+        self.purge_interval_seconds = purge_interval_seconds
+        self._purged_at = None
+        # stage -> [duration_seconds, rows, queries] of the current run
+        self.stages = {}
+        # source_table -> (unprocessed_rows, oldest_unprocessed_age_seconds)
+        self.backlog = {}
+
+    def reset(self):
+        """Start a new run"""
+        self.stages = {}
+        self.backlog = {}
+
+    @contextmanager
+    def stage(self, conn, name):
+        """Time a processing stage and count its queries; set .rows on the yielded sample.
+
+        A stage that runs several times in one run (e.g. once per shard) is
+        summed into a single sample.
+        """
+        sample = StageSample()
+        queries_before = getattr(conn, 'query_count', None)
+        started = time.monotonic()
+        try:
+            yield sample
+        finally:
+            elapsed = time.monotonic() - started
+            queries_after = getattr(conn, 'query_count', None)
+            queries = queries_after - queries_before if queries_before is not None else None
+
+            totals = self.stages.setdefault(name, [0.0, 0, 0 if queries is not None else None])
+            totals[0] += elapsed
+            totals[1] += sample.rows
+            if queries is not None:
+                totals[2] += queries
+
+    def measure_backlog(self, conn, ingestion_mode='flag'):
+        """Count the unprocessed rows of each raw table and the age of the oldest one"""
+        cursor = conn.cursor()
+        for table, id_column in BACKLOG_TABLES:
+            if ingestion_mode == 'watermark':
+                # Rows above the lowest checkpoint of the table's shards
+                condition = f"""{id_column} > COALESCE((
+                    SELECT MIN(last_id) FROM wialon_data.processing_checkpoints
+                    WHERE source_table = '{table}' OR source_table LIKE '{table}:%%'), 0)"""
+            else:
+                condition = "processed = FALSE"
+
+            cursor.execute(f"""
+                SELECT COUNT(*), EXTRACT(EPOCH FROM LOCALTIMESTAMP - MIN(timestamp))
+                FROM wialon_data.{table}
+                WHERE {condition}
+            """)
+            count, oldest_age = cursor.fetchone()
+            self.backlog[table] = (count, float(oldest_age) if oldest_age is not None else None)
+
+    def flush(self, conn):
+        """Write the current run's stage samples and backlog gauges and log a summary"""
+        cursor = conn.cursor()
+
+        if self.stages:
+            execute_values(cursor, """
+                INSERT INTO fuel_management.processing_stage_metrics
+                (worker, stage, duration_seconds, rows_processed, queries)
+                VALUES %s
+            """, [(self.worker, name, duration, rows, queries)
+                  for name, (duration, rows, queries) in self.stages.items()])
+
+        if self.backlog:
+            execute_values(cursor, """
+                INSERT INTO fuel_management.processing_backlog_metrics
+                (source_table, unprocessed_rows, oldest_unprocessed_age_seconds)
+                VALUES %s
+            """, [(table, count, age) for table, (count, age) in self.backlog.items()])
+
+        for name, (duration, rows, queries) in self.stages.items():
+            self.logger.info(f"Stage {name}: {duration:.3f} s, {rows} rows, {queries} queries")
+        for table, (count, age) in self.backlog.items():
+            age_text = f"{age:.0f} s" if age is not None else "n/a"
+            self.logger.info(f"Backlog {table}: {count} unprocessed rows, oldest {age_text}")
+
+    def purge(self, conn):
+        """Delete stored samples older than the retention period, at most once per
+        purge interval; return the number of rows deleted"""
+        if self.retention_days is None:
+            return 0
+        if self._purged_at is not None and time.monotonic() - self._purged_at < self.purge_interval_seconds:
+            return 0
+
+        cursor = conn.cursor()
+        deleted = 0
+        for table in ('processing_stage_metrics', 'processing_backlog_metrics'):
+            cursor.execute(f"""
+                DELETE FROM fuel_management.{table}
+                WHERE recorded_at < LOCALTIMESTAMP - %s * INTERVAL '1 day'
+            """, (self.retention_days,))
+            deleted += cursor.rowcount
+        self._purged_at = time.monotonic()
+
+        if deleted:
+            self.logger.info(f"Purged {deleted} processing metric rows older than {self.retention_days} days")
+        return deleted
@@ -0,0 +1,165 @@
+import select
+import signal
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+from fuel_processor import FuelDataProcessor
+
+# Channels notified by the triggers in database/schema.sql
+NEW_DATA_CHANNEL = 'wialon_data_new'
+REFERENCE_CHANNEL = 'fuel_management_reference'
+
+class FuelProcessorDaemon:
+    def __init__(self, config):
+        """Initialize the resident processor daemon"""
+        self.processor = FuelDataProcessor(config)
+        self.logger = self.processor.logger
+        # Fallback poll in case a notification is missed (e.g. across a reconnect)
+        self.poll_interval = config.get('daemon_poll_interval_seconds', 60)
+        # Short pause after a notification so a burst of inserts is handled in one run
+        self.debounce_seconds = config.get('daemon_debounce_seconds', 0.2)
+        self.reconnect_delay = config.get('daemon_reconnect_seconds', 5)
+        # Pending transactions are timed out on this timer even when no data arrives
+        self.sweep_interval = config.get('timeout_sweep_interval_seconds', 60)
+        # In watermark mode rows younger than the lag are left for a later run, so
+        # the daemon uses a short lag and runs again once it has passed
+        if self.processor.ingestion_mode == 'watermark':
+            self.processor.watermark_lag_seconds = config.get('daemon_watermark_lag_seconds', 2)
+        self.work_conn = None
+        self.listen_conn = None
+        self._stop_event = threading.Event()
+
+    def _connect(self):
+        """Open the warm work connection and the LISTEN connection"""
+        self.work_conn = self.processor._get_db_connection()
+
+        self.listen_conn = self.processor._get_db_connection()
+        self.listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self.listen_conn.cursor()
+        cursor.execute(f"LISTEN {NEW_DATA_CHANNEL}")
+        cursor.execute(f"LISTEN {REFERENCE_CHANNEL}")
+
+        # Reference changes made while disconnected were not notified; from now
+        # on they are, so lookup misses need not reload the cache
+        self.processor.lookups.invalidate()
+        self.processor.event_handlers.invalidate()
+        self.processor.lookups.notify_invalidation = True
+
+        self.logger.info("Processor daemon connected and listening for new data")
+
+    def _disconnect(self):
+        """Close both connections, ignoring errors from broken ones"""
+        for conn in (self.work_conn, self.listen_conn):
+            if conn is not None and not conn.closed:
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+        self.work_conn = None
+        self.listen_conn = None
+        self.processor.lookups.notify_invalidation = False
+
+    def _wait_for_notifications(self, timeout):
+        """Wait up to timeout seconds; return (new_data, reference_changed)"""
+        new_data = reference_changed = False
+
+        # Wake at least once a second so a stop request is noticed promptly
+        readable, _, _ = select.select([self.listen_conn], [], [], min(timeout, 1.0))
+        if readable:
+            self.listen_conn.poll()
+
+        while self.listen_conn.notifies:
+            notification = self.listen_conn.notifies.pop(0)
+            if notification.channel == REFERENCE_CHANNEL:
+                reference_changed = True
+            else:
+                new_data = True
+
+        return new_data, reference_changed
+
+    def run(self):
+        """Run until stop() is called or SIGTERM/SIGINT is received"""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._handle_signal)
+            signal.signal(signal.SIGINT, self._handle_signal)
+
+        self.logger.info("Processor daemon started")
+        while not self._stop_event.is_set():
+            try:
+                self._connect()
+                # Catch up on anything stored while the daemon was down
+                self._run_processor()
+                self._serve()
+            except psycopg2.Error as e:
+                self.logger.error(f"Processor daemon database error: {str(e)}")
+                self._stop_event.wait(self.reconnect_delay)
+            finally:
+                self._disconnect()
+
+        self.logger.info("Processor daemon stopped")
+
+    def _serve(self):
+        """Process new data whenever notified, or when the poll interval elapses,
+        and sweep transaction timeouts when the sweep interval elapses"""
+        next_poll = time.monotonic() + self.poll_interval
+        next_sweep = time.monotonic() + self.sweep_interval
+
+        while not self._stop_event.is_set():
+            timeout = max(min(next_poll, next_sweep) - time.monotonic(), 0)
+            new_data, reference_changed = self._wait_for_notifications(timeout)
+
+            if new_data:
+                self._stop_event.wait(self.debounce_seconds)
+                # Notifications that arrived during the debounce are covered by this run
+                _, reference_changed_since = self._wait_for_notifications(0)
+                reference_changed = reference_changed or reference_changed_since
+
+            if reference_changed:
+                self.processor.lookups.invalidate()
+                self.processor.event_handlers.invalidate()
+
+            if new_data or time.monotonic() >= next_poll:
+                # A processing run also sweeps timeouts
+                self._run_processor()
+                next_poll = time.monotonic() + self.poll_interval
+                next_sweep = time.monotonic() + self.sweep_interval
+                if new_data and self.processor.ingestion_mode == 'watermark':
+                    # Notified rows still within the lag are picked up by a follow-up run
+                    next_poll = min(next_poll, time.monotonic() + self.processor.watermark_lag_seconds)
+            elif time.monotonic() >= next_sweep:
+                self.processor.sweep_transaction_timeouts(self.work_conn)
+                next_sweep = time.monotonic() + self.sweep_interval
+
+    def _run_processor(self):
+        """Process new data on the warm connection"""
+        if self.work_conn is None or self.work_conn.closed:
+            self.work_conn = self.processor._get_db_connection()
+
+        self.processor.process_new_data(self.work_conn)
+
+    def _handle_signal(self, signum, frame):
+        """Request a graceful shutdown from a signal handler"""
+        self.logger.info(f"Processor daemon received signal {signum}, shutting down")
+        self.stop()
+
+    def stop(self):
+        """Stop after the current processing run finishes"""
+        self._stop_event.set()
+
+if __name__ == "__main__":
+    # Example configuration
+    config = {
+        'database': {
+            'host': 'localhost',
+            'database': 'fuel_management',
+            'user': 'fuel_admin',
+            'password': 'your_password'
+        },
+        'geozone_proximity_meters': 50,
+        'daemon_poll_interval_seconds': 60,
+        'daemon_debounce_seconds': 0.2,
+        'timeout_sweep_interval_seconds': 60
+    }
+
+    FuelProcessorDaemon(config).run()
@@ -0,0 +1,570 @@
+import multiprocessing
+from collections import Counter
+from datetime import datetime, timedelta
+from psycopg2.extras import execute_values
+from event_handlers import EventHandlerRegistry
+from fuel_detection import FuelLevelDetector, detect_dispensations
+from fuel_processor import FuelDataProcessor, PROCESSOR_LOCK_NAMESPACE, MATCHING_LOCK_KEY
+from transaction_matcher import EventTimeline, match_pending_transactions, derived_transaction_id
+
+# Transactions the processor derives from iButton authentications; rows without a
+# verification method predate the 'ibutton' tag. Other transactions (e.g.
+# simulated ones) are never touched by a replay.
+REPLAYED_TRANSACTIONS = "(t.verification_method = 'ibutton' OR t.verification_method IS NULL)"
+DERIVED_EVENT_TYPES = ('dispensed', 'received', 'drained')
+
+def split_range(start, end, slice_hours):
+    """Split [start, end) into consecutive slices of at most slice_hours"""
+    slices = []
+    step = timedelta(hours=slice_hours)
+    slice_start = start
+    while slice_start < end:
+        slice_end = min(slice_start + step, end)
+        slices.append((slice_start, slice_end))
+        slice_start = slice_end
+    return slices
+
+# The HistoricalReplay of a worker process of HistoricalReplay.run()
+_worker_replay = None
+
+def _init_worker(config):
+    """Build the replay used by all slices of one worker process"""
+    global _worker_replay
+    _worker_replay = HistoricalReplay(config)
+
+def _derive_slice(slice_start, slice_end):
+    """Entry point of one slice in a worker process of HistoricalReplay.run()"""
+    return _worker_replay.derive_slice(slice_start, slice_end)
+
+class HistoricalReplay:
+    def __init__(self, config):
+        """Initialize a replay of the derived fuel_management tables from raw Wialon data"""
+        self.config = config
+        self.processor = FuelDataProcessor(config)
+        self.logger = self.processor.logger
+        self.lookups = self.processor.lookups
+        self.matcher = self.processor.transaction_matcher
+        # Raw data read around each slice so smoothing, drain windows and flow
+        # deltas at the slice edges see the same history as an unsliced run
+        self.context = timedelta(minutes=config.get('replay_context_minutes', 120))
+        # An authentication does not start a new transaction while the same
+        # driver/vehicle/bowser has one pending that was initiated within this
+        # long before it, as in FuelDataProcessor._check_and_initiate_transaction
+        self.initiation_window = timedelta(hours=1)
+
+    def run(self, start, end, workers=4, slice_hours=24, dry_run=False):
+        """Rebuild fuel_events, transactions, authentication_events and
+        vehicle_bowser_proximity for [start, end).
+
+        Slices are derived in parallel by a process pool; transactions are then
+        initiated and matched globally and the old rows are replaced with the new ones in a
+        single database transaction. With dry_run the replacement is skipped
+        and a diff against the current rows is returned instead.
+        """
+        slices = split_range(start, end, slice_hours)
+        self.logger.info(f"Replaying {start} - {end} in {len(slices)} slices with {workers} workers")
+
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self.config,)) as pool:
+            results = pool.starmap(_derive_slice, slices)
+
+        derived = {'fuel_events': [], 'initiations': [], 'authentications': [], 'proximity': []}
+        for result in results:
+            for table, rows in result.items():
+                derived[table].extend(rows)
+
+        conn = self.processor._get_db_connection()
+        try:
+            if not self.processor.resolve_shard_count(conn):
+                raise ValueError("shard_count does not match the deployment's, see wialon_data.processing_shards")
+            if not dry_run:
+                # Before anything is read, so no processor run can change the rows
+                # the replacement is based on
+                self._lock_processors(conn)
+            self._check_processed(conn, start, end)
+            self.lookups.refresh(conn)
+            boundary_assignments = self._match(conn, start, end, derived)
+
+            if dry_run:
+                diff = self._diff(conn, start, end, derived)
+                conn.rollback()
+                return diff
+
+            self._swap(conn, start, end, derived, boundary_assignments)
+            conn.commit()
+            self.logger.info(
+                f"Replayed {start} - {end}: {len(derived['fuel_events'])} fuel events, "
+                f"{len(derived['transactions'])} transactions, {len(derived['authentications'])} "
+                f"authentications, {len(derived['proximity'])} proximity events"
+            )
+            return None
+        except Exception as e:
+            conn.rollback()
+            self.logger.error(f"Error replaying {start} - {end}: {str(e)}")
+            raise
+        finally:
+            conn.close()
+
+    def _lock_processors(self, conn):
+        """Wait for running processors and keep new runs out until the transaction ends;
+        the processors take these keys with pg_try_advisory_lock and skip if held"""
+        cursor = conn.cursor()
+        shard_keys = [self.processor._shard_lock_key(shard) for shard in range(self.processor.shard_count)]
+        for key in shard_keys + [MATCHING_LOCK_KEY]:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", (PROCESSOR_LOCK_NAMESPACE, key))
+
+    def _check_processed(self, conn, start, end):
+        """Refuse to replay a range the live processor has not finished with.
+
+        Raw rows still waiting to be processed would be derived a second time by
+        the processor after the replay. Only checked in flag mode; in watermark
+        mode the range should end before the processor's lag window.
+        """
+        if self.processor.ingestion_mode != 'flag':
+            return
+
+        cursor = conn.cursor()
+        for table in ('sensor_readings', 'geozone_events', 'ibutton_events'):
+            cursor.execute(f"""
+                SELECT EXISTS (
+                    SELECT 1 FROM wialon_data.{table}
+                    WHERE processed = FALSE AND timestamp >= %s AND timestamp < %s
+                )
+            """, (start, end))
+            if cursor.fetchone()[0]:
+                raise ValueError(f"wialon_data.{table} has unprocessed rows in the replay range")
+
+    def derive_slice(self, start, end):
+        """Derive the rows of every replayed table for [start, end) in memory"""
+        conn = self.processor._get_db_connection()
+        try:
+            self.lookups.refresh(conn)
+            derived = {
+                'fuel_events': self._derive_fuel_events(conn, start, end),
+                'proximity': self._derive_proximity(conn, start, end),
+            }
+            derived['authentications'], derived['initiations'] = self._derive_authentications(conn, start, end)
+            conn.rollback()
+
+            self.logger.info(
+                f"Derived slice {start} - {end}: {len(derived['fuel_events'])} fuel events, "
+                f"{len(derived['initiations'])} authentications at a bowser"
+            )
+            return derived
+        finally:
+            conn.close()
+
+    def _derive_fuel_events(self, conn, start, end):
+        """Detect fuel events from the slice's sensor readings plus context on both sides"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT reading_id, unit_id, unit_name, sensor_id, sensor_name, value, timestamp,
+                   latitude, longitude
+            FROM wialon_data.sensor_readings
+            WHERE timestamp >= %s AND timestamp < %s
+            ORDER BY timestamp, reading_id
+        """, (start - self.context, end + self.context))
+        readings = cursor.fetchall()
+
+        registry = EventHandlerRegistry(self.logger)
+        registry.resolve(conn, readings)
+
+        fuel_events = FuelLevelDetector(self.config, self.logger).detect(
+            [r for r in readings if registry.kind_of(r[1], r[3]) == 'fuel_level']
+        )
+        fuel_events.extend(detect_dispensations(
+            [r for r in readings if registry.kind_of(r[1], r[3]) == 'fuel_flow'], {}
+        ))
+
+        # Events in the context belong to the neighbouring slices
+        return [event for event in fuel_events if start <= event[2] < end]
+
+    def _derive_proximity(self, conn, start, end):
+        """Derive vehicle_bowser_proximity rows from the slice's geozone events"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT unit_id, geozone_id, event_type, timestamp, latitude, longitude
+            FROM wialon_data.geozone_events
+            WHERE timestamp >= %s AND timestamp < %s
+            ORDER BY timestamp, event_id
+        """, (start, end))
+
+        proximity = []
+        for unit_id, geozone_id, event_type, timestamp, lat, lon in cursor.fetchall():
+            vehicle_id = self.lookups.vehicle_id(unit_id)
+            bowser_id = self.lookups.bowser_for_geozone(geozone_id)
+            if vehicle_id and bowser_id:
+                proximity.append((vehicle_id, bowser_id, event_type, timestamp, lat, lon))
+        return proximity
+
+    def _derive_authentications(self, conn, start, end):
+        """Derive authentication_events rows and the authentications that may
+        initiate a transaction, as (driver_id, vehicle_id, bowser_ids nearest
+        first, timestamp), from the slice's iButton events"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT unit_id, ibutton_code, timestamp, latitude, longitude
+            FROM wialon_data.ibutton_events
+            WHERE timestamp >= %s AND timestamp < %s
+            ORDER BY timestamp, event_id
+        """, (start, end))
+
+        authentications = []
+        initiations = []
+        for unit_id, ibutton_code, timestamp, lat, lon in cursor.fetchall():
+            vehicle_id = self.lookups.vehicle_id(unit_id)
+            driver = self.lookups.driver(ibutton_code)
+            if not vehicle_id or not driver:
+                continue
+
+            driver_id = driver[0]
+            authentications.append((driver_id, vehicle_id, ibutton_code, timestamp, lat, lon))
+
+            if not lat or not lon:
+                continue
+            bowser_ids = tuple(self.lookups.bowsers_near(lat, lon))
+            if bowser_ids:
+                initiations.append((driver_id, vehicle_id, bowser_ids, timestamp))
+
+        return authentications, initiations
+
+    def _load_recent_transactions(self, conn, start, end):
+        """Get the transactions the replay keeps that new authentications may find
+        pending, as {(driver_id, vehicle_id, bowser_id): [(timestamp, pending_until)]};
+        pending_until is None for transactions still pending"""
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT t.driver_id, t.vehicle_id, t.bowser_id, t.timestamp, t.status,
+                   (SELECT MIN(fe.timestamp) FROM fuel_management.fuel_events fe
+                    WHERE fe.transaction_id = t.transaction_id AND fe.event_type = 'dispensed')
+            FROM fuel_management.transactions t
+            WHERE t.timestamp >= %(window_start)s AND t.timestamp < %(end)s
+            AND NOT (t.timestamp >= %(start)s AND {REPLAYED_TRANSACTIONS})
+        """, {'window_start': start - self.initiation_window, 'start': start, 'end': end})
+
+        recent = {}
+        for driver_id, vehicle_id, bowser_id, timestamp, status, dispensation_time in cursor.fetchall():
+            if dispensation_time is not None:
+                pending_until = dispensation_time
+            elif status == 'pending':
+                pending_until = None
+            elif status == 'timed_out':
+                pending_until = timestamp + self.matcher.timeout
+            else:
+                pending_until = timestamp
+            recent.setdefault((driver_id, vehicle_id, bowser_id), []).append((timestamp, pending_until))
+        return recent
+
+    def _match(self, conn, start, end, derived):
+        """Initiate the replayed transactions and match them against the replayed fuel events.
+
+        Fuel events in the range that belong to transactions outside it keep
+        that assignment. Existing events just after the range are matchable too,
+        so transactions near the end see the same events as in a live run.
+        Replaces derived['fuel_events'] with rows carrying their match results,
+        sets derived['transactions'] to the matched transactions and returns
+        (event_id, transaction_id) assignments for the events after the range.
+        """
+        cursor = conn.cursor()
+
+        cursor.execute(f"""
+            SELECT fe.unit_id, fe.event_type, fe.timestamp, fe.transaction_id
+            FROM fuel_management.fuel_events fe
+            JOIN fuel_management.transactions t ON t.transaction_id = fe.transaction_id
+            WHERE fe.timestamp >= %(start)s AND fe.timestamp < %(end)s
+            AND NOT (t.timestamp >= %(start)s AND t.timestamp < %(end)s AND {REPLAYED_TRANSACTIONS})
+        """, {'start': start, 'end': end})
+        external = {(unit_id, event_type, timestamp): transaction_id
+                    for unit_id, event_type, timestamp, transaction_id in cursor.fetchall()}
+
+        cursor.execute(f"""
+            SELECT fe.event_id, fe.unit_id, fe.event_type, fe.amount, fe.timestamp
+            FROM fuel_management.fuel_events fe
+            LEFT JOIN fuel_management.transactions t ON t.transaction_id = fe.transaction_id
+            WHERE fe.timestamp >= %(end)s AND fe.timestamp < %(end)s + %(window)s
+            AND fe.event_type IN ('dispensed', 'received')
+            AND (fe.transaction_id IS NULL
+                 OR (t.timestamp >= %(start)s AND t.timestamp < %(end)s AND {REPLAYED_TRANSACTIONS}))
+        """, {'start': start, 'end': end, 'window': self.matcher.dispense_window + self.matcher.reception_window})
+        boundary_events = cursor.fetchall()
+
+        # Timeline IDs: index into fuel_events for replayed events, -event_id for
+        # existing events after the range
+        fuel_events = [list(event) + [None] for event in derived['fuel_events']]
+        by_unit = {'dispensed': {}, 'received': {}}
+        for index, (unit_id, event_type, timestamp, amount, lat, lon, _) in enumerate(fuel_events):
+            transaction_id = external.get((unit_id, event_type, timestamp))
+            if transaction_id:
+                fuel_events[index][6] = transaction_id
+            elif event_type in by_unit:
+                by_unit[event_type].setdefault(unit_id, []).append((index, amount, timestamp))
+        for event_id, unit_id, event_type, amount, timestamp in boundary_events:
+            by_unit[event_type].setdefault(unit_id, []).append((-event_id, amount, timestamp))
+
+        dispensed = {unit_id: EventTimeline(events) for unit_id, events in by_unit['dispensed'].items()}
+        received = {unit_id: EventTimeline(events) for unit_id, events in by_unit['received'].items()}
+        boundary_times = {event_id: timestamp for event_id, _, _, _, timestamp in boundary_events}
+        recent = self._load_recent_transactions(conn, start, end)
+        now = datetime.now()
+
+        # Initiate and match in time order, so each authentication sees whether
+        # earlier transactions were still pending when it happened; matching one
+        # transaction at a time takes the same events as matching them all at once
+        transactions = []
+        boundary_assignments = []
+        for driver_id, vehicle_id, bowser_ids, timestamp in sorted(derived['initiations'], key=lambda i: i[3]):
+            for bowser_id in bowser_ids:
+                key = (driver_id, vehicle_id, bowser_id)
+                if any(initiated > timestamp - self.initiation_window
+                       and (pending_until is None or pending_until > timestamp)
+                       for initiated, pending_until in recent.get(key, ())):
+                    continue
+
+                transaction = (derived_transaction_id(driver_id, vehicle_id, bowser_id, timestamp),
+                               driver_id, vehicle_id, bowser_id, timestamp)
+                event_assignments, transaction_updates, _ = match_pending_transactions(
+                    [transaction], dispensed, received,
+                    self.lookups.bowser_unit_id, self.lookups.vehicle_unit_id,
+                    self.matcher.dispense_window, self.matcher.reception_window,
+                    self.matcher.discrepancy_threshold, self.matcher.timeout, now
+                )
+
+                # Pending until its dispensation is there, or until it times out
+                pending_until = None
+                for event_id, transaction_id in event_assignments:
+                    if event_id < 0:
+                        boundary_assignments.append((-event_id, transaction_id))
+                        event_time = boundary_times[-event_id]
+                    else:
+                        fuel_events[event_id][6] = transaction_id
+                        event_time = fuel_events[event_id][2]
+                    if pending_until is None:
+                        pending_until = event_time
+                update = transaction_updates[0][1:] if transaction_updates else (None, None, None, None, 'pending')
+                if update[-1] == 'timed_out':
+                    pending_until = timestamp + self.matcher.timeout
+
+                recent.setdefault(key, []).append((timestamp, pending_until))
+                transactions.append(transaction + tuple(update))
+                break
+
+        derived['fuel_events'] = [tuple(event) for event in fuel_events]
+        derived['transactions'] = transactions
+        return boundary_assignments
+
+    def _swap(self, conn, start, end, derived, boundary_assignments):
+        """Replace the range's derived rows in the current database transaction,
+        which holds the processor locks"""
+        cursor = conn.cursor()
+        range_params = {'start': start, 'end': end}
+
+        # Replayed transactions keep the ID of the existing row with the same
+        # natural key, so random legacy IDs and references to them (e.g. from
+        # odometer_readings) stay valid; only the differences are inserted or deleted
+        cursor.execute(f"""
+            SELECT t.transaction_id, t.driver_id, t.vehicle_id, t.bowser_id, t.timestamp
+            FROM fuel_management.transactions t
+            WHERE t.timestamp >= %(start)s AND t.timestamp < %(end)s AND {REPLAYED_TRANSACTIONS}
+            ORDER BY t.created_at, t.transaction_id
+        """, range_params)
+        existing = {}
+        for transaction_id, driver_id, vehicle_id, bowser_id, timestamp in cursor.fetchall():
+            existing.setdefault((driver_id, vehicle_id, bowser_id, timestamp), transaction_id)
+        ids = {t[0]: existing.get(tuple(t[1:5]), t[0]) for t in derived['transactions']}
+        transactions = [(ids[t[0]],) + tuple(t[1:]) for t in derived['transactions']]
+        kept = set(existing.values()) & set(ids.values())
+        fuel_events = [tuple(event[:6]) + (ids.get(event[6], event[6]),) for event in derived['fuel_events']]
+        boundary_assignments = [(event_id, ids.get(transaction_id, transaction_id))
+                                for event_id, transaction_id in boundary_assignments]
+
+        # Events outside the range lose their match to a replayed transaction
+        cursor.execute(f"""
+            UPDATE fuel_management.fuel_events
+            SET transaction_id = NULL
+            WHERE transaction_id IN (
+                SELECT t.transaction_id FROM fuel_management.transactions t
+                WHERE t.timestamp >= %(start)s AND t.timestamp < %(end)s AND {REPLAYED_TRANSACTIONS}
+            )
+            AND NOT (timestamp >= %(start)s AND timestamp < %(end)s)
+        """, range_params)
+
+        cursor.execute("""
+            DELETE FROM fuel_management.fuel_events
+            WHERE timestamp >= %(start)s AND timestamp < %(end)s
+            AND event_type IN %(event_types)s
+        """, dict(range_params, event_types=DERIVED_EVENT_TYPES))
+        cursor.execute(f"""
+            DELETE FROM fuel_management.transactions t
+            WHERE t.timestamp >= %(start)s AND t.timestamp < %(end)s AND {REPLAYED_TRANSACTIONS}
+            AND NOT (t.transaction_id = ANY(%(kept)s::varchar[]))
+        """, dict(range_params, kept=list(kept)))
+        cursor.execute("""
+            DELETE FROM fuel_management.authentication_events
+            WHERE timestamp >= %(start)s AND timestamp < %(end)s
+        """, range_params)
+        cursor.execute("""
+            DELETE FROM fuel_management.vehicle_bowser_proximity
+            WHERE timestamp >= %(start)s AND timestamp < %(end)s
+        """, range_params)
+
+        execute_values(cursor, """
+            UPDATE fuel_management.transactions AS t
+            SET dispensed_amount = v.dispensed_amount,
+                received_amount = v.received_amount,
+                discrepancy = v.discrepancy,
+                discrepancy_percentage = v.discrepancy_percentage,
+                status = v.status
+            FROM (VALUES %s) AS v(transaction_id, dispensed_amount, received_amount,
+                                  discrepancy, discrepancy_percentage, status)
+            WHERE t.transaction_id = v.transaction_id
+        """, [(t[0],) + t[5:] for t in transactions if t[0] in kept],
+            template='(%s::varchar, %s::double precision, %s::double precision, '
+                     '%s::double precision, %s::double precision, %s::varchar)', page_size=1000)
+        execute_values(cursor, """
+            INSERT INTO fuel_management.transactions
+            (transaction_id, driver_id, vehicle_id, bowser_id, timestamp, dispensed_amount,
+             received_amount, discrepancy, discrepancy_percentage, status, verification_method)
+            VALUES %s
+        """, [t for t in transactions if t[0] not in kept],
+            template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'ibutton')", page_size=1000)
+        execute_values(cursor, """
+            INSERT INTO fuel_management.fuel_events
+            (unit_id, event_type, timestamp, amount, latitude, longitude, transaction_id)
+            VALUES %s
+        """, fuel_events, page_size=1000)
+        execute_values(cursor, """
+            INSERT INTO fuel_management.authentication_events
+            (driver_id, vehicle_id, ibutton_code, timestamp, latitude, longitude)
+            VALUES %s
+        """, derived['authentications'], page_size=1000)
+        execute_values(cursor, """
+            INSERT INTO fuel_management.vehicle_bowser_proximity
+            (vehicle_id, bowser_id, event_type, timestamp, latitude, longitude)
+            VALUES %s
+        """, derived['proximity'], page_size=1000)
+
+        if boundary_assignments:
+            execute_values(cursor, """
+                UPDATE fuel_management.fuel_events AS fe
+                SET transaction_id = v.transaction_id
+                FROM (VALUES %s) AS v(event_id, transaction_id)
+                WHERE fe.event_id = v.event_id
+            """, boundary_assignments, template='(%s::integer, %s::varchar)')
+
+    def _diff(self, conn, start, end, derived):
+        """Compare the replayed rows with the current rows of the range.
+
+        Rows are compared by content rather than by ID (fuel event IDs are
+        serial and older transactions have random IDs). Returns a dict per
+        table with the current and replayed row counts and the rows only in
+        one of them; transactions also count status changes.
+        """
+        cursor = conn.cursor()
+        range_params = {'start': start, 'end': end}
+
+        cursor.execute("""
+            SELECT unit_id, event_type, timestamp, amount
+            FROM fuel_management.fuel_events
+            WHERE timestamp >= %(start)s AND timestamp < %(end)s
+            AND event_type IN %(event_types)s
+        """, dict(range_params, event_types=DERIVED_EVENT_TYPES))
+        current_events = [(u, t, ts, _round(a)) for u, t, ts, a in cursor.fetchall()]
+        replayed_events = [(u, t, ts, _round(a)) for u, t, ts, a, _, _, _ in derived['fuel_events']]
+
+        cursor.execute(f"""
+            SELECT t.driver_id, t.vehicle_id, t.bowser_id, t.timestamp, t.status
+            FROM fuel_management.transactions t
+            WHERE t.timestamp >= %(start)s AND t.timestamp < %(end)s AND {REPLAYED_TRANSACTIONS}
+        """, range_params)
+        current_status = {row[:4]: row[4] for row in cursor.fetchall()}
+        replayed_status = {row[1:5]: row[9] for row in derived['transactions']}
+
+        cursor.execute("""
+            SELECT driver_id, vehicle_id, ibutton_code, timestamp
+            FROM fuel_management.authentication_events
+            WHERE timestamp >= %(start)s AND timestamp < %(end)s
+        """, range_params)
+        current_authentications = cursor.fetchall()
+        replayed_authentications = [row[:4] for row in derived['authentications']]
+
+        cursor.execute("""
+            SELECT vehicle_id, bowser_id, event_type, timestamp
+            FROM fuel_management.vehicle_bowser_proximity
+            WHERE timestamp >= %(start)s AND timestamp < %(end)s
+        """, range_params)
+        current_proximity = cursor.fetchall()
+        replayed_proximity = [row[:4] for row in derived['proximity']]
+
+        diff = {
+            'fuel_events': _multiset_diff(current_events, replayed_events),
+            'transactions': _multiset_diff(current_status.keys(), replayed_status.keys()),
+            'authentication_events': _multiset_diff(current_authentications, replayed_authentications),
+            'vehicle_bowser_proximity': _multiset_diff(current_proximity, replayed_proximity),
+        }
+        diff['transactions']['status_changes'] = Counter(
+            (current_status[key], replayed_status[key])
+            for key in current_status.keys() & replayed_status.keys()
+            if current_status[key] != replayed_status[key]
+        )
+        return diff
+
+def _round(amount):
+    """Round an amount for comparison, so float noise is not reported as a change"""
+    return None if amount is None else round(amount, 2)
+
+def _multiset_diff(current, replayed):
+    """Count the rows only in current (removed) and only in replayed (added)"""
+    current = Counter(current)
+    replayed = Counter(replayed)
+    return {
+        'current': sum(current.values()),
+        'replayed': sum(replayed.values()),
+        'removed': list((current - replayed).elements()),
+        'added': list((replayed - current).elements()),
+    }
+
+def print_diff(diff, limit=10):
+    """Print a dry-run diff, with up to limit example rows per side"""
+    for table, changes in diff.items():
+        print(f"{table}: {changes['current']} current, {changes['replayed']} replayed, "
+              f"{len(changes['removed'])} removed, {len(changes['added'])} added")
+        for label in ('removed', 'added'):
+            for row in changes[label][:limit]:
+                print(f"  {label}: {row}")
+        for (before, after), count in sorted(changes.get('status_changes', {}).items()):
+            print(f"  status {before} -> {after}: {count}")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Rebuild derived fuel management tables from raw Wialon data')
+    parser.add_argument('start', type=datetime.fromisoformat, help='Start of the range (inclusive), ISO format')
+    parser.add_argument('end', type=datetime.fromisoformat, help='End of the range (exclusive), ISO format')
+    parser.add_argument('--workers', type=int, default=4, help='Worker processes deriving slices')
+    parser.add_argument('--slice-hours', type=int, default=24, help='Hours of raw data per slice')
+    parser.add_argument('--dry-run', action='store_true', help='Print a diff instead of replacing rows')
+    args = parser.parse_args()
+
+    # Example configuration
+    config = {
+        'database': {
+            'host': 'localhost',
+            'database': 'fuel_management',
+            'user': 'fuel_admin',
+            'password': 'your_password'
+        },
+        'geozone_proximity_meters': 50,
+        'dispense_match_window_minutes': 30,
+        'reception_match_window_minutes': 30,
+        'discrepancy_threshold_percent': 5,
+        'transaction_timeout_minutes': 60,
+        'refuel_threshold_liters': 5,
+        'drain_threshold_liters': 10,
+        'drain_window_minutes': 30,
+        'parked_radius_meters': 50,
+        'replay_context_minutes': 120
+    }
+
+    replay = HistoricalReplay(config)
+    diff = replay.run(args.start, args.end, args.workers, args.slice_hours, args.dry_run)
+    if diff is not None:
+        print_diff(diff)
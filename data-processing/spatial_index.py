@@ -0,0 +1,139 @@
+import math
+from geopy.distance import geodesic
+
+# Meters per degree of latitude (and of longitude at the equator)
+METERS_PER_DEGREE = 111320.0
+
+class BowserZoneIndex:
+    def __init__(self, zones=None, cell_degrees=0.01, default_radius=50):
+        """Build a uniform lat/lon grid over circular bowser geozones.
+
+        zones is an iterable of (bowser_id, center_latitude, center_longitude, radius).
+        Each zone is registered in every grid cell its bounding box overlaps, so a
+        point lookup only has to inspect the zones of a single cell.
+        """
+        self.cell_degrees = cell_degrees
+        self.default_radius = default_radius
+        self.cells = {}
+        self.zone_count = 0
+
+        for zone in zones or []:
+            self.add_zone(*zone)
+
+    def _cell(self, lat, lon):
+        """Get the grid cell containing a point"""
+        return (int(math.floor(lat / self.cell_degrees)), int(math.floor(lon / self.cell_degrees)))
+
+    def add_zone(self, bowser_id, center_lat, center_lon, radius):
+        """Register a circular zone in every cell its bounding box overlaps"""
+        if not center_lat or not center_lon:
+            return
+
+        radius = radius or self.default_radius
+        lat_margin = radius / METERS_PER_DEGREE
+        lon_margin = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(center_lat)), 1e-6))
+
+        min_row, min_col = self._cell(center_lat - lat_margin, center_lon - lon_margin)
+        max_row, max_col = self._cell(center_lat + lat_margin, center_lon + lon_margin)
+
+        zone = (bowser_id, center_lat, center_lon, radius)
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                self.cells.setdefault((row, col), []).append(zone)
+
+        self.zone_count += 1
+
+    def zones_containing(self, lat, lon):
+        """Get the IDs of the bowsers whose zone contains the point, nearest first.
+
+        Candidates from the point's grid cell are classified with a cheap
+        equirectangular distance; the exact geodesic is only computed for points
+        close to a zone boundary.
+        """
+        candidates = self.cells.get(self._cell(lat, lon))
+        if not candidates:
+            return []
+
+        cos_lat = math.cos(math.radians(lat))
+        matches = []
+        for bowser_id, center_lat, center_lon, radius in candidates:
+            d_lat = (center_lat - lat) * METERS_PER_DEGREE
+            d_lon = (center_lon - lon) * METERS_PER_DEGREE * cos_lat
+            approx_sq = d_lat * d_lat + d_lon * d_lon
+
+            # 1% slack covers the equirectangular error at geozone scales, so only
+            # points in the band around the boundary need the exact geodesic check
+            if approx_sq > (radius * 1.01) ** 2:
+                continue
+            if approx_sq < (radius * 0.99) ** 2:
+                matches.append((math.sqrt(approx_sq), bowser_id))
+                continue
+
+            distance = geodesic((lat, lon), (center_lat, center_lon)).meters
+            if distance <= radius:
+                matches.append((distance, bowser_id))
+
+        matches.sort(key=lambda match: match[0])
+        return [bowser_id for _, bowser_id in matches]
+
+def _benchmark(bowser_count, event_count, linear_sample):
+    """Compare the grid index against a linear geodesic scan"""
+    import random
+    import time
+
+    random.seed(42)
+
+    # Bowsers spread over roughly 100 x 100 km around Port Moresby
+    zones = [
+        (f"B{i+1}", -9.4438 + (random.random() - 0.5), 147.1803 + (random.random() - 0.5), 50)
+        for i in range(bowser_count)
+    ]
+
+    # Half the authentications happen at a bowser, the rest anywhere in the area
+    events = []
+    for _ in range(event_count):
+        if random.random() < 0.5:
+            _, zone_lat, zone_lon, _ = random.choice(zones)
+            events.append((zone_lat + (random.random() - 0.5) * 0.0006,
+                           zone_lon + (random.random() - 0.5) * 0.0006))
+        else:
+            events.append((-9.4438 + (random.random() - 0.5), 147.1803 + (random.random() - 0.5)))
+
+    started = time.perf_counter()
+    index = BowserZoneIndex(zones)
+    build_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    indexed_hits = sum(1 for lat, lon in events if index.zones_containing(lat, lon))
+    index_time = time.perf_counter() - started
+
+    # A full linear scan of every event is far too slow, so time a sample
+    sample = events[:linear_sample]
+    started = time.perf_counter()
+    linear_hits = 0
+    for lat, lon in sample:
+        for _, zone_lat, zone_lon, radius in zones:
+            if geodesic((lat, lon), (zone_lat, zone_lon)).meters <= radius:
+                linear_hits += 1
+                break
+    linear_time = time.perf_counter() - started
+    sample_hits = sum(1 for lat, lon in sample if index.zones_containing(lat, lon))
+
+    linear_per_event = linear_time / max(len(sample), 1)
+    print(f"Bowsers: {bowser_count}, auth events: {event_count}")
+    print(f"Index build: {build_time * 1000:.1f} ms ({len(index.cells)} cells)")
+    print(f"Indexed lookups: {index_time:.2f} s ({event_count / index_time:.0f} events/s, {indexed_hits} in a zone)")
+    print(f"Linear scan: {linear_per_event * 1000:.2f} ms/event over {len(sample)} events, "
+          f"~{linear_per_event * event_count:.0f} s extrapolated to {event_count}")
+    print(f"Sample agreement: linear {linear_hits}, indexed {sample_hits}")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the bowser geozone index')
+    parser.add_argument('--bowsers', type=int, default=1000, help='Number of bowser geozones')
+    parser.add_argument('--events', type=int, default=100000, help='Number of authentication events')
+    parser.add_argument('--linear-sample', type=int, default=200, help='Events timed for the linear scan')
+    args = parser.parse_args()
+
+    _benchmark(args.bowsers, args.events, args.linear_sample)
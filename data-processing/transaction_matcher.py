@@ -0,0 +1,253 @@
+import logging
+import uuid
+from bisect import bisect_left
+from datetime import timedelta
+from psycopg2.extras import execute_values
+
+# Namespace of the deterministic IDs of transactions initiated from iButton events
+TRANSACTION_ID_NAMESPACE = uuid.UUID('5d0c6f1e-3b7a-4c52-9a41-2f8e6b1d7c90')
+
+# Pending transaction t still has an unassigned dispensation of its bowser in
+# its match window; shared by the matching pass and the timeout sweep
+CANDIDATE_DISPENSATION = """
+    EXISTS (
+        SELECT 1
+        FROM fuel_management.bowsers b
+        JOIN fuel_management.fuel_events fe ON fe.unit_id = b.wialon_unit_id
+        WHERE b.bowser_id = t.bowser_id
+        AND fe.event_type = 'dispensed'
+        AND fe.transaction_id IS NULL
+        AND fe.timestamp BETWEEN t.timestamp AND t.timestamp + %(dispense_window)s * INTERVAL '1 minute'
+    )
+"""
+
+def derived_transaction_id(driver_id, vehicle_id, bowser_id, timestamp):
+    """Deterministic ID of the transaction initiated by an authentication, so the
+    live processor and a replay of the same raw data produce the same IDs"""
+    return str(uuid.uuid5(TRANSACTION_ID_NAMESPACE, f"{driver_id}|{vehicle_id}|{bowser_id}|{timestamp.isoformat()}"))
+
+class EventTimeline:
+    def __init__(self, events):
+        """Unassigned fuel events of one unit, as (event_id, amount, timestamp), sorted by time"""
+        self.events = sorted(events, key=lambda event: (event[2], event[0]))
+        self.times = [event[2] for event in self.events]
+        # _next[i] points at the first untaken event at or after i (path-compressed)
+        self._next = list(range(len(self.events) + 1))
+
+    def _first_untaken(self, index):
+        """Find the first untaken event at or after index"""
+        root = index
+        while self._next[root] != root:
+            root = self._next[root]
+        while self._next[index] != root:
+            self._next[index], index = root, self._next[index]
+        return root
+
+    def take_first(self, start, end):
+        """Take the earliest untaken event with start <= timestamp <= end, or None"""
+        index = self._first_untaken(bisect_left(self.times, start))
+        if index < len(self.events) and self.times[index] <= end:
+            self._next[index] = index + 1
+            return self.events[index]
+        return None
+
+def match_pending_transactions(transactions, dispensed, received, bowser_unit_id, vehicle_unit_id,
+                               dispense_window, reception_window, discrepancy_threshold,
+                               timeout=None, now=None):
+    """Match pending transactions to unassigned dispense and reception events in memory.
+
+    transactions are (transaction_id, driver_id, vehicle_id, bowser_id, timestamp);
+    dispensed and received map a unit ID to its EventTimeline. Transactions are
+    visited in time order and each takes the earliest free event in its window,
+    so every timeline is consumed front to back. Unmatched transactions older
+    than timeout are timed out when a timeout is given; the live matcher leaves
+    that to the set-based sweep in TransactionMatcher.sweep_timeouts().
+
+    Returns (event_assignments, transaction_updates, matches) where
+    event_assignments are (event_id, transaction_id), transaction_updates are
+    (transaction_id, dispensed, received, discrepancy, discrepancy_percentage, status)
+    and matches describe each matched transaction for logging.
+    """
+    event_assignments = []
+    transaction_updates = []
+    matches = []
+
+    for transaction_id, driver_id, vehicle_id, bowser_id, timestamp in sorted(transactions, key=lambda t: t[4]):
+        bowser_unit = bowser_unit_id(bowser_id)
+        if not bowser_unit:
+            continue
+
+        timeline = dispensed.get(bowser_unit)
+        dispensation = timeline.take_first(timestamp, timestamp + dispense_window) if timeline else None
+
+        if dispensation:
+            dispensation_id, dispensed_amount, dispensation_time = dispensation
+            event_assignments.append((dispensation_id, transaction_id))
+
+            vehicle_unit = vehicle_unit_id(vehicle_id)
+            if not vehicle_unit:
+                continue
+
+            timeline = received.get(vehicle_unit)
+            reception = timeline.take_first(dispensation_time, dispensation_time + reception_window) if timeline else None
+
+            if reception:
+                reception_id, received_amount, reception_time = reception
+                event_assignments.append((reception_id, transaction_id))
+
+                # Calculate discrepancy
+                discrepancy = dispensed_amount - received_amount
+                discrepancy_percentage = (discrepancy / dispensed_amount * 100) if dispensed_amount > 0 else 0
+
+                status = 'completed'
+                if abs(discrepancy_percentage) > discrepancy_threshold:
+                    status = 'discrepancy'
+
+                transaction_updates.append((
+                    transaction_id, dispensed_amount, received_amount,
+                    discrepancy, discrepancy_percentage, status
+                ))
+                matches.append((transaction_id, dispensed_amount, received_amount, status))
+            else:
+                # Just the dispensed amount, no reception event yet
+                transaction_updates.append((transaction_id, dispensed_amount, None, None, None, 'partial'))
+                matches.append((transaction_id, dispensed_amount, None, 'partial'))
+
+        elif timeout is not None and now - timestamp > timeout:
+            transaction_updates.append((transaction_id, None, None, None, None, 'timed_out'))
+
+    return event_assignments, transaction_updates, matches
+
+class TransactionMatcher:
+    def __init__(self, config, lookups, logger=None):
+        """Initialize the transaction matcher"""
+        self.lookups = lookups
+        self.logger = logger or logging.getLogger('fuel_processor')
+        self.dispense_window = timedelta(minutes=config.get('dispense_match_window_minutes', 30))
+        self.reception_window = timedelta(minutes=config.get('reception_match_window_minutes', 30))
+        self.discrepancy_threshold = config.get('discrepancy_threshold_percent', 5)
+        self.timeout = timedelta(minutes=config.get('transaction_timeout_minutes', 60))
+        # Timed-out transactions per sweep, for monitoring
+        self.last_sweep_timed_out = 0
+        self.total_timed_out = 0
+    
+    def _window_params(self):
+        """Get the query parameters of CANDIDATE_DISPENSATION and the sweep"""
+        return {
+            'dispense_window': self.dispense_window.total_seconds() / 60,
+            'timeout': self.timeout.total_seconds() / 60
+        }
+
+    def match(self, conn):
+        """Match the pending transactions that have a candidate dispensation in one
+        pass and write the results in bulk"""
+        cursor = conn.cursor()
+
+        # Only pending transactions that could still match; the rest wait for
+        # their dispensation to arrive or for the timeout sweep
+        cursor.execute(f"""
+            SELECT t.transaction_id, t.driver_id, t.vehicle_id, t.bowser_id, t.timestamp
+            FROM fuel_management.transactions t
+            WHERE t.status = 'pending'
+            AND {CANDIDATE_DISPENSATION}
+            ORDER BY t.timestamp
+        """, self._window_params())
+
+        transactions = cursor.fetchall()
+        self.logger.info(f"Processing {len(transactions)} matchable pending transactions")
+        if not transactions:
+            return {'pending': 0, 'matched': 0}
+
+        dispensed, received = self._load_events(conn, transactions)
+
+        event_assignments, transaction_updates, matches = match_pending_transactions(
+            transactions, dispensed, received,
+            self.lookups.bowser_unit_id, self.lookups.vehicle_unit_id,
+            self.dispense_window, self.reception_window, self.discrepancy_threshold
+        )
+
+        self._write_results(conn, event_assignments, transaction_updates)
+
+        for transaction_id, dispensed_amount, received_amount, status in matches:
+            if status == 'partial':
+                self.logger.info(f"Partially matched transaction {transaction_id}: Dispensed {dispensed_amount}, no reception event found")
+            else:
+                self.logger.info(f"Matched transaction {transaction_id}: Dispensed {dispensed_amount}, Received {received_amount}, Status: {status}")
+
+        return {'pending': len(transactions), 'matched': len(matches)}
+
+    def sweep_timeouts(self, conn):
+        """Time out every pending transaction past the timeout in one statement.
+
+        Transactions that still have an unassigned dispensation in their window
+        are left for the matching pass, so running the sweep before matching
+        never times out a transaction that could match. Returns the number of
+        transactions timed out.
+        """
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            UPDATE fuel_management.transactions t
+            SET status = 'timed_out'
+            WHERE t.status = 'pending'
+            AND t.timestamp < LOCALTIMESTAMP - %(timeout)s * INTERVAL '1 minute'
+            AND NOT {CANDIDATE_DISPENSATION}
+        """, self._window_params())
+
+        timed_out = cursor.rowcount
+        self.last_sweep_timed_out = timed_out
+        self.total_timed_out += timed_out
+        self.logger.info(f"Timeout sweep: {timed_out} transactions timed out ({self.total_timed_out} since start)")
+        return timed_out
+
+    def _load_events(self, conn, transactions):
+        """Load every unassigned dispense/reception event the transactions could match"""
+        bowser_units = {self.lookups.bowser_unit_id(t[3]) for t in transactions} - {None}
+        vehicle_units = {self.lookups.vehicle_unit_id(t[2]) for t in transactions} - {None}
+
+        window_start = min(t[4] for t in transactions)
+        window_end = max(t[4] for t in transactions) + self.dispense_window + self.reception_window
+
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT event_id, unit_id, event_type, amount, timestamp
+            FROM fuel_management.fuel_events
+            WHERE transaction_id IS NULL
+            AND timestamp BETWEEN %s AND %s
+            AND ((event_type = 'dispensed' AND unit_id = ANY(%s))
+                 OR (event_type = 'received' AND unit_id = ANY(%s)))
+        """, (window_start, window_end, list(bowser_units), list(vehicle_units)))
+
+        by_unit = {'dispensed': {}, 'received': {}}
+        for event_id, unit_id, event_type, amount, timestamp in cursor.fetchall():
+            by_unit[event_type].setdefault(unit_id, []).append((event_id, amount, timestamp))
+
+        dispensed = {unit_id: EventTimeline(events) for unit_id, events in by_unit['dispensed'].items()}
+        received = {unit_id: EventTimeline(events) for unit_id, events in by_unit['received'].items()}
+        return dispensed, received
+
+    def _write_results(self, conn, event_assignments, transaction_updates):
+        """Write event assignments and transaction status updates in two statements"""
+        cursor = conn.cursor()
+
+        if event_assignments:
+            execute_values(cursor, """
+                UPDATE fuel_management.fuel_events AS fe
+                SET transaction_id = v.transaction_id
+                FROM (VALUES %s) AS v(event_id, transaction_id)
+                WHERE fe.event_id = v.event_id
+            """, event_assignments, template='(%s::integer, %s::varchar)')
+
+        if transaction_updates:
+            execute_values(cursor, """
+                UPDATE fuel_management.transactions AS t
+                SET dispensed_amount = COALESCE(v.dispensed_amount, t.dispensed_amount),
+                    received_amount = COALESCE(v.received_amount, t.received_amount),
+                    discrepancy = COALESCE(v.discrepancy, t.discrepancy),
+                    discrepancy_percentage = COALESCE(v.discrepancy_percentage, t.discrepancy_percentage),
+                    status = v.status
+                FROM (VALUES %s) AS v(transaction_id, dispensed_amount, received_amount,
+                                      discrepancy, discrepancy_percentage, status)
+                WHERE t.transaction_id = v.transaction_id
+                AND t.status = 'pending'
+            """, transaction_updates, template='(%s::varchar, %s::double precision, %s::double precision, '
+                                               '%s::double precision, %s::double precision, %s::varchar)')
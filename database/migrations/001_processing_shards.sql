@@ -0,0 +1,14 @@
+-- Shared unit shard layout for processor workers (see database/schema.sql).
+-- Processors register their configured shard_count (or 1) on first run and
+-- refuse to run when theirs differs. To keep an existing sharded layout,
+-- uncomment and set the INSERT to the shard_count in use before starting any
+-- processor.
+
+CREATE TABLE IF NOT EXISTS wialon_data.processing_shards (
+    singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+    shard_count INTEGER NOT NULL CHECK (shard_count > 0),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- INSERT INTO wialon_data.processing_shards (singleton, shard_count) VALUES (TRUE, 8)
+-- ON CONFLICT (singleton) DO NOTHING;
@@ -0,0 +1,18 @@
+-- Unique natural key on sensor readings (see database/schema.sql).
+-- Readings collected twice before the key existed are removed first, keeping
+-- the earliest stored copy (lowest reading_id), since the unique index cannot
+-- be built over duplicates. Stop the collectors while this runs.
+
+BEGIN;
+
+DELETE FROM wialon_data.sensor_readings a
+USING wialon_data.sensor_readings b
+WHERE a.unit_id = b.unit_id
+AND a.sensor_id = b.sensor_id
+AND a.timestamp = b.timestamp
+AND a.reading_id > b.reading_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sensor_readings_natural_key
+    ON wialon_data.sensor_readings(unit_id, sensor_id, timestamp);
+
+COMMIT;
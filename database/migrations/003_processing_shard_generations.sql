@@ -0,0 +1,11 @@
+-- Per-shard processing generations (see database/schema.sql). Processors
+-- compare them with the generation of their own last run to detect cached
+-- state made stale by another processor.
+
+CREATE TABLE IF NOT EXISTS wialon_data.processing_shard_generations (
+    shard_count INTEGER NOT NULL,
+    shard INTEGER NOT NULL,
+    generation BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (shard_count, shard)
+);
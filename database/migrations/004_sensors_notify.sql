@@ -0,0 +1,22 @@
+-- Notify processors when sensors are added or reconfigured, so their cached
+-- sensor kinds are reset (see database/schema.sql). The collector re-upserts
+-- unchanged sensors (e.g. after a restart), so only new sensors and changed
+-- metadata notify.
+
+CREATE OR REPLACE FUNCTION fuel_management.notify_reference_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('fuel_management_reference', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sensors_insert_notify ON wialon_data.sensors;
+CREATE TRIGGER sensors_insert_notify AFTER INSERT ON wialon_data.sensors
+    FOR EACH ROW EXECUTE FUNCTION fuel_management.notify_reference_change();
+
+DROP TRIGGER IF EXISTS sensors_update_notify ON wialon_data.sensors;
+CREATE TRIGGER sensors_update_notify AFTER UPDATE ON wialon_data.sensors
+    FOR EACH ROW
+    WHEN (OLD.unit_id IS DISTINCT FROM NEW.unit_id OR OLD.name IS DISTINCT FROM NEW.name
+          OR OLD.parameter IS DISTINCT FROM NEW.parameter)
+    EXECUTE FUNCTION fuel_management.notify_reference_change();
@@ -0,0 +1,12 @@
+-- Watermark checkpoints for incremental ingestion and the partial indexes
+-- over unprocessed raw rows (see database/schema.sql).
+
+CREATE TABLE IF NOT EXISTS wialon_data.processing_checkpoints (
+    source_table VARCHAR(100) PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_sensor_readings_unprocessed ON wialon_data.sensor_readings(timestamp) WHERE processed = FALSE;
+CREATE INDEX IF NOT EXISTS idx_geozone_events_unprocessed ON wialon_data.geozone_events(timestamp) WHERE processed = FALSE;
+CREATE INDEX IF NOT EXISTS idx_ibutton_events_unprocessed ON wialon_data.ibutton_events(timestamp) WHERE processed = FALSE;
@@ -0,0 +1,40 @@
+-- NOTIFY triggers for the processor daemon (see database/schema.sql): new raw
+-- Wialon data on wialon_data_new, reference data changes on
+-- fuel_management_reference.
+
+CREATE OR REPLACE FUNCTION wialon_data.notify_new_data() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('wialon_data_new', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sensor_readings_notify ON wialon_data.sensor_readings;
+CREATE TRIGGER sensor_readings_notify AFTER INSERT ON wialon_data.sensor_readings
+    FOR EACH STATEMENT EXECUTE FUNCTION wialon_data.notify_new_data();
+DROP TRIGGER IF EXISTS geozone_events_notify ON wialon_data.geozone_events;
+CREATE TRIGGER geozone_events_notify AFTER INSERT ON wialon_data.geozone_events
+    FOR EACH STATEMENT EXECUTE FUNCTION wialon_data.notify_new_data();
+DROP TRIGGER IF EXISTS ibutton_events_notify ON wialon_data.ibutton_events;
+CREATE TRIGGER ibutton_events_notify AFTER INSERT ON wialon_data.ibutton_events
+    FOR EACH STATEMENT EXECUTE FUNCTION wialon_data.notify_new_data();
+
+CREATE OR REPLACE FUNCTION fuel_management.notify_reference_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('fuel_management_reference', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS vehicles_notify ON fuel_management.vehicles;
+CREATE TRIGGER vehicles_notify AFTER INSERT OR UPDATE OR DELETE ON fuel_management.vehicles
+    FOR EACH STATEMENT EXECUTE FUNCTION fuel_management.notify_reference_change();
+DROP TRIGGER IF EXISTS bowsers_notify ON fuel_management.bowsers;
+CREATE TRIGGER bowsers_notify AFTER INSERT OR UPDATE OR DELETE ON fuel_management.bowsers
+    FOR EACH STATEMENT EXECUTE FUNCTION fuel_management.notify_reference_change();
+DROP TRIGGER IF EXISTS drivers_notify ON fuel_management.drivers;
+CREATE TRIGGER drivers_notify AFTER INSERT OR UPDATE OR DELETE ON fuel_management.drivers
+    FOR EACH STATEMENT EXECUTE FUNCTION fuel_management.notify_reference_change();
+DROP TRIGGER IF EXISTS geozones_notify ON wialon_data.geozones;
+CREATE TRIGGER geozones_notify AFTER INSERT OR UPDATE OR DELETE ON wialon_data.geozones
+    FOR EACH STATEMENT EXECUTE FUNCTION fuel_management.notify_reference_change();
@@ -0,0 +1,5 @@
+-- Partial indexes for transaction matching and timeout sweeps (see
+-- database/schema.sql).
+
+CREATE INDEX IF NOT EXISTS idx_transactions_pending ON fuel_management.transactions(bowser_id, timestamp) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_fuel_events_unassigned ON fuel_management.fuel_events(unit_id, event_type, timestamp) WHERE transaction_id IS NULL;
@@ -0,0 +1,22 @@
+-- Processing stage timings and backlog gauges, charted in Grafana (see
+-- database/schema.sql).
+
+CREATE TABLE IF NOT EXISTS fuel_management.processing_stage_metrics (
+    metric_id BIGSERIAL PRIMARY KEY,
+    recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    worker VARCHAR(100),
+    stage VARCHAR(50) NOT NULL,  -- 'sensor_readings', 'geozone_events', 'ibutton_events', 'matching', 'timeout_sweep'
+    duration_seconds DOUBLE PRECISION NOT NULL,
+    rows_processed INTEGER NOT NULL,
+    queries INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_processing_stage_metrics_recorded_at ON fuel_management.processing_stage_metrics(recorded_at);
+
+CREATE TABLE IF NOT EXISTS fuel_management.processing_backlog_metrics (
+    metric_id BIGSERIAL PRIMARY KEY,
+    recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    source_table VARCHAR(100) NOT NULL,
+    unprocessed_rows BIGINT NOT NULL,
+    oldest_unprocessed_age_seconds DOUBLE PRECISION
+);
+CREATE INDEX IF NOT EXISTS idx_processing_backlog_metrics_recorded_at ON fuel_management.processing_backlog_metrics(recorded_at);
@@ -0,0 +1,8 @@
+-- Per-unit collection cursors for incremental Wialon message collection (see
+-- database/schema.sql).
+
+CREATE TABLE IF NOT EXISTS wialon_data.collection_cursors (
+    unit_id BIGINT PRIMARY KEY REFERENCES wialon_data.units(unit_id),
+    last_message_time TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
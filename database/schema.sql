@@ -48,6 +48,9 @@ CREATE TABLE wialon_data.sensor_readings (
 CREATE INDEX idx_sensor_readings_timestamp ON wialon_data.sensor_readings(timestamp);
 CREATE INDEX idx_sensor_readings_unit_id ON wialon_data.sensor_readings(unit_id);
 CREATE INDEX idx_sensor_readings_sensor_id ON wialon_data.sensor_readings(sensor_id);
+CREATE INDEX idx_sensor_readings_unprocessed ON wialon_data.sensor_readings(timestamp) WHERE processed = FALSE;
+-- Natural key: a sensor has one reading per message, so overlapping collection windows are deduplicated
+CREATE UNIQUE INDEX idx_sensor_readings_natural_key ON wialon_data.sensor_readings(unit_id, sensor_id, timestamp);
 
 -- Geozones table
 CREATE TABLE wialon_data.geozones (
@@ -76,6 +79,7 @@ CREATE TABLE wialon_data.geozone_events (
     processed BOOLEAN DEFAULT FALSE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+CREATE INDEX idx_geozone_events_unprocessed ON wialon_data.geozone_events(timestamp) WHERE processed = FALSE;
 
 -- iButton events table
 CREATE TABLE wialon_data.ibutton_events (
@@ -88,6 +92,39 @@ CREATE TABLE wialon_data.ibutton_events (
     processed BOOLEAN DEFAULT FALSE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+CREATE INDEX idx_ibutton_events_unprocessed ON wialon_data.ibutton_events(timestamp) WHERE processed = FALSE;
+
+-- Processing checkpoints (high-water mark per source table for incremental ingestion)
+CREATE TABLE wialon_data.processing_checkpoints (
+    source_table VARCHAR(100) PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Unit shard layout shared by all processor workers; change shard_count only
+-- while every processor is stopped
+CREATE TABLE wialon_data.processing_shards (
+    singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+    shard_count INTEGER NOT NULL CHECK (shard_count > 0),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Bumped by every processing run per shard, so a processor can tell whether
+-- another one handled the shard since its own last run
+CREATE TABLE wialon_data.processing_shard_generations (
+    shard_count INTEGER NOT NULL,
+    shard INTEGER NOT NULL,
+    generation BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (shard_count, shard)
+);
+
+-- Collection cursors (timestamp of the last message collected per unit)
+CREATE TABLE wialon_data.collection_cursors (
+    unit_id BIGINT PRIMARY KEY REFERENCES wialon_data.units(unit_id),
+    last_message_time TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
 
 -- Fuel Management schema tables
 CREATE TABLE fuel_management.drivers (
@@ -170,7 +207,7 @@ CREATE TABLE fuel_management.transactions (
 CREATE TABLE fuel_management.fuel_events (
     event_id SERIAL PRIMARY KEY,
     unit_id BIGINT NOT NULL,
-    event_type VARCHAR(20) NOT NULL,  -- 'dispensed' or 'received'
+    event_type VARCHAR(20) NOT NULL,  -- 'dispensed', 'received' or 'drained'
     timestamp TIMESTAMP NOT NULL,
     amount DOUBLE PRECISION,
     latitude DOUBLE PRECISION,
@@ -179,6 +216,11 @@ CREATE TABLE fuel_management.fuel_events (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Pending transactions, scanned by every matching pass and timeout sweep
+CREATE INDEX idx_transactions_pending ON fuel_management.transactions(bowser_id, timestamp) WHERE status = 'pending';
+-- Unassigned fuel events, probed for candidate dispensations of pending transactions
+CREATE INDEX idx_fuel_events_unassigned ON fuel_management.fuel_events(unit_id, event_type, timestamp) WHERE transaction_id IS NULL;
+
 CREATE TABLE fuel_management.authentication_events (
     event_id SERIAL PRIMARY KEY,
     driver_id VARCHAR(50),
@@ -211,4 +253,69 @@ CREATE TABLE fuel_management.odometer_readings (
     verification_photo TEXT,
     transaction_id VARCHAR(50),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
\ No newline at end of file
+);
+
+-- Processing metrics (one row per stage per processor run, charted in Grafana)
+CREATE TABLE fuel_management.processing_stage_metrics (
+    metric_id BIGSERIAL PRIMARY KEY,
+    recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    worker VARCHAR(100),
+    stage VARCHAR(50) NOT NULL,  -- 'sensor_readings', 'geozone_events', 'ibutton_events', 'matching', 'timeout_sweep'
+    duration_seconds DOUBLE PRECISION NOT NULL,
+    rows_processed INTEGER NOT NULL,
+    queries INTEGER
+);
+CREATE INDEX idx_processing_stage_metrics_recorded_at ON fuel_management.processing_stage_metrics(recorded_at);
+
+-- Processing backlog gauges (unprocessed raw rows, sampled after each processor run)
+CREATE TABLE fuel_management.processing_backlog_metrics (
+    metric_id BIGSERIAL PRIMARY KEY,
+    recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    source_table VARCHAR(100) NOT NULL,
+    unprocessed_rows BIGINT NOT NULL,
+    oldest_unprocessed_age_seconds DOUBLE PRECISION
+);
+CREATE INDEX idx_processing_backlog_metrics_recorded_at ON fuel_management.processing_backlog_metrics(recorded_at);
+
+-- Notify the processor daemon when new raw Wialon data is stored
+CREATE OR REPLACE FUNCTION wialon_data.notify_new_data() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('wialon_data_new', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER sensor_readings_notify AFTER INSERT ON wialon_data.sensor_readings
+    FOR EACH STATEMENT EXECUTE FUNCTION wialon_data.notify_new_data();
+CREATE TRIGGER geozone_events_notify AFTER INSERT ON wialon_data.geozone_events
+    FOR EACH STATEMENT EXECUTE FUNCTION wialon_data.notify_new_data();
+CREATE TRIGGER ibutton_events_notify AFTER INSERT ON wialon_data.ibutton_events
+    FOR EACH STATEMENT EXECUTE FUNCTION wialon_data.notify_new_data();
+
+-- Notify the processor daemon when reference data changes, so it reloads its lookup cache
+CREATE OR REPLACE FUNCTION fuel_management.notify_reference_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('fuel_management_reference', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER vehicles_notify AFTER INSERT OR UPDATE OR DELETE ON fuel_management.vehicles
+    FOR EACH STATEMENT EXECUTE FUNCTION fuel_management.notify_reference_change();
+CREATE TRIGGER bowsers_notify AFTER INSERT OR UPDATE OR DELETE ON fuel_management.bowsers
+    FOR EACH STATEMENT EXECUTE FUNCTION fuel_management.notify_reference_change();
+CREATE TRIGGER drivers_notify AFTER INSERT OR UPDATE OR DELETE ON fuel_management.drivers
+    FOR EACH STATEMENT EXECUTE FUNCTION fuel_management.notify_reference_change();
+CREATE TRIGGER geozones_notify AFTER INSERT OR UPDATE OR DELETE ON wialon_data.geozones
+    FOR EACH STATEMENT EXECUTE FUNCTION fuel_management.notify_reference_change();
+
+-- The collector re-upserts unchanged sensors (e.g. after a restart), so only
+-- new sensors and changed metadata notify (INSERT ... ON CONFLICT fires
+-- statement triggers regardless)
+CREATE TRIGGER sensors_insert_notify AFTER INSERT ON wialon_data.sensors
+    FOR EACH ROW EXECUTE FUNCTION fuel_management.notify_reference_change();
+CREATE TRIGGER sensors_update_notify AFTER UPDATE ON wialon_data.sensors
+    FOR EACH ROW
+    WHEN (OLD.unit_id IS DISTINCT FROM NEW.unit_id OR OLD.name IS DISTINCT FROM NEW.name
+          OR OLD.parameter IS DISTINCT FROM NEW.parameter)
+    EXECUTE FUNCTION fuel_management.notify_reference_change();
@@ -379,6 +379,7 @@ class WialonSimulator:
                 (unit_id, unit_name, sensor_id, sensor_name, sensor_type, 
                  value, timestamp, latitude, longitude)
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (unit_id, sensor_id, timestamp) DO NOTHING
             """, (
                 bowser["wialon_id"],
                 bowser["name"],
@@ -397,6 +398,7 @@ class WialonSimulator:
                 (unit_id, unit_name, sensor_id, sensor_name, sensor_type, 
                  value, timestamp, latitude, longitude)
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (unit_id, sensor_id, timestamp) DO NOTHING
             """, (
                 vehicle["wialon_id"],
                 vehicle["name"],
@@ -415,6 +417,7 @@ class WialonSimulator:
                 (unit_id, unit_name, sensor_id, sensor_name, sensor_type, 
                  value, timestamp, latitude, longitude)
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (unit_id, sensor_id, timestamp) DO NOTHING
             """, (
                 vehicle["wialon_id"],
                 vehicle["name"],
@@ -4,6 +4,7 @@ import time
 from datetime import datetime, timedelta
 import os
 import logging
+import threading
 
 app = Flask(__name__)
 
@@ -21,19 +22,29 @@ simulated_data = {
     'session': None
 }
 
-@app.route('/wialon/ajax.html', methods=['GET'])
+# Session event queue served by /avl_evts once the session subscribed to unit
+# messages with core/update_data_flags
+UNIT_LAST_MESSAGE_FLAG = 0x400
+event_state = {'subscribed': False, 'events': []}
+event_condition = threading.Condition()
+
+@app.route('/wialon/ajax.html', methods=['GET', 'POST'])
 def wialon_api():
-    """Mock Wialon API endpoint"""
-    svc = request.args.get('svc')
-    sid = request.args.get('sid')
+    """Mock Wialon API endpoint (parameters as query string or POSTed form)"""
+    svc = request.values.get('svc')
+    sid = request.values.get('sid')
     
     logger.info(f"API Request: {svc}")
     
     # Handle authentication
     if svc == 'token/login':
-        token = request.args.get('token')
+        token = request.values.get('token')
         if token == 'simulated_token' or token == 'test_token':
             simulated_data['session'] = "simulation_session_123456"
+            # A new session starts without event subscriptions
+            with event_condition:
+                event_state['subscribed'] = False
+                event_state['events'] = []
             return jsonify({
                 "eid": simulated_data['session'],
                 "user": {"nm": "Simulation User", "id": 12345}
@@ -42,50 +53,106 @@ def wialon_api():
             return jsonify({"error": 1, "reason": "Invalid token"})
     
     # Check if authenticated for other services
-    if svc != 'token/login' and (not sid or sid != simulated_data['session']):
+    if not sid or sid != simulated_data['session']:
         return jsonify({"error": 1, "reason": "Not authenticated"})
     
-    # Handle different service endpoints
+    params = json.loads(request.values.get('params', '{}'))
+    
+    if svc == 'core/batch':
+        # Run each sub-request and return the results in order; a failing
+        # sub-request yields its error object without failing the others
+        return jsonify([
+            _handle_service(call.get('svc'), call.get('params', {}))
+            for call in params.get('params', [])
+        ])
+    
+    return jsonify(_handle_service(svc, params))
+
+@app.route('/avl_evts', methods=['GET', 'POST'])
+def avl_events():
+    """Mock Wialon session event queue; waits up to 'wait' seconds for events (long poll)"""
+    sid = request.values.get('sid')
+    if not sid or sid != simulated_data['session']:
+        return jsonify({"error": 1, "reason": "Not authenticated"})
+    
+    wait = min(float(request.values.get('wait', 0)), 60)
+    with event_condition:
+        if not event_state['events'] and wait > 0:
+            event_condition.wait(wait)
+        events, event_state['events'] = event_state['events'], []
+    
+    return jsonify({"tm": int(time.time()), "events": events})
+
+@app.route('/simulation/push_messages', methods=['POST'])
+def push_messages_route():
+    """Add new messages for a unit: {"unit_id": ..., "messages": [...]}"""
+    data = request.json or {}
+    push_messages(data.get('unit_id'), data.get('messages', []))
+    return jsonify({"queued": len(data.get('messages', []))})
+
+@app.route('/update_simulated_data', methods=['POST'])
+def update_simulated_data_route():
+    """Replace parts of the simulated data; changed last messages become new messages"""
+    data = request.json or {}
+    previous = simulated_data.get('last_messages', {})
+    new_messages = {
+        unit_id: message for unit_id, message in data.get('last_messages', {}).items()
+        if message.get('t') != previous.get(unit_id, {}).get('t')
+    }
+    
+    update_simulated_data(data)
+    for unit_id, message in new_messages.items():
+        push_messages(int(unit_id), [message])
+    
+    return jsonify({"updated": list(data.keys()), "new_messages": len(new_messages)})
+
+def push_messages(unit_id, messages):
+    """Store new messages of a unit and queue their events for a subscribed session"""
+    if not messages:
+        return
+    
+    unit_messages = simulated_data.setdefault('messages', {}).setdefault(str(unit_id), [])
+    unit_messages.extend(messages)
+    unit_messages.sort(key=lambda msg: msg.get('t', 0))
+    simulated_data.setdefault('last_messages', {})[str(unit_id)] = unit_messages[-1]
+    
+    with event_condition:
+        if event_state['subscribed']:
+            event_state['events'].extend({"i": unit_id, "t": "m", "d": message} for message in messages)
+            event_condition.notify_all()
+
+def _handle_service(svc, params):
+    """Handle one (authenticated) service call and return its result"""
     if svc == 'core/search_items':
-        # Parse parameters
-        params = json.loads(request.args.get('params', '{}'))
         spec = params.get('spec', {})
         items_type = spec.get('itemsType', 'avl_unit')
         
         # Return simulated units
-        return jsonify(simulated_data['units'])
+        return simulated_data['units']
     
     elif svc == 'core/search_item':
-        # Parse parameters
-        params = json.loads(request.args.get('params', '{}'))
         item_id = params.get('id')
         
         # Find the item in our simulated data
         for item in simulated_data['units'].get('items', []):
             if item.get('id') == item_id:
-                return jsonify(item)
+                return item
         
-        return jsonify({"error": 1, "reason": "Item not found"})
+        return {"error": 1, "reason": "Item not found"}
     
     elif svc == 'unit/get_sensors':
-        # Parse parameters
-        params = json.loads(request.args.get('params', '{}'))
         unit_id = params.get('unitId')
         
         # Return simulated sensors for the unit
-        return jsonify(simulated_data['sensors'].get(str(unit_id), {"sensors": []}))
+        return simulated_data['sensors'].get(str(unit_id), {"sensors": []})
     
     elif svc == 'unit/calc_last_message':
-        # Parse parameters
-        params = json.loads(request.args.get('params', '{}'))
         unit_id = params.get('unitId')
         
         # Return simulated last message for the unit
-        return jsonify(simulated_data['last_messages'].get(str(unit_id), {}))
+        return simulated_data['last_messages'].get(str(unit_id), {})
     
     elif svc == 'messages/load_interval':
-        # Parse parameters
-        params = json.loads(request.args.get('params', '{}'))
         unit_id = params.get('itemId')
         time_from = params.get('timeFrom')
         time_to = params.get('timeTo')
@@ -97,19 +164,39 @@ def wialon_api():
             if time_from <= msg.get('t', 0) <= time_to
         ]
         
-        return jsonify({"messages": filtered_messages})
+        return {"messages": filtered_messages}
+    
+    elif svc == 'core/update_data_flags':
+        # Only unit message subscriptions are simulated; mode 0 sets, 1 adds
+        # and 2 removes flags
+        for spec in params.get('spec', []):
+            if spec.get('type') == 'type' and spec.get('data') == 'avl_unit':
+                wants_messages = bool(spec.get('flags', 0) & UNIT_LAST_MESSAGE_FLAG)
+                mode = spec.get('mode', 0)
+                with event_condition:
+                    if mode == 2:
+                        event_state['subscribed'] = event_state['subscribed'] and not wants_messages
+                    elif mode == 1:
+                        event_state['subscribed'] = event_state['subscribed'] or wants_messages
+                    else:
+                        event_state['subscribed'] = wants_messages
+                    if not event_state['subscribed']:
+                        event_state['events'] = []
+        
+        return [
+            {"i": item.get('id'), "d": item, "f": UNIT_LAST_MESSAGE_FLAG if event_state['subscribed'] else 0}
+            for item in simulated_data['units'].get('items', [])
+        ]
     
     elif svc == 'resource/get_zone_data':
-        # Parse parameters
-        params = json.loads(request.args.get('params', '{}'))
         resource_id = params.get('itemId')
         
         # Return simulated geozones
-        return jsonify(simulated_data['geozones'])
+        return simulated_data['geozones']
     
     # Handle other endpoints as needed
     logger.warning(f"Unhandled service: {svc}")
-    return jsonify({"error": 1, "reason": "Service not implemented in mock"})
+    return {"error": 1, "reason": "Service not implemented in mock"}
 
 def load_simulated_data(file_path=None):
     """Load simulated data from a JSON file"""
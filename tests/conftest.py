@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The processing and integration modules import their siblings by name
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ('data-processing', 'wialon_integration'):
+    sys.path.insert(0, os.path.join(ROOT, directory))
@@ -0,0 +1,67 @@
+from event_handlers import EventHandlerRegistry, classify_sensor
+
+class FakeConnection:
+    """Serves wialon_data.sensors rows as (unit_id, sensor_id, name, parameter)"""
+
+    def __init__(self, sensors):
+        self.sensors = sensors
+        self.queries = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, query, params):
+        self.conn.queries += 1
+        keys = set(zip(*params))
+        self.rows = [row for row in self.conn.sensors if (row[0], row[1]) in keys]
+
+    def fetchall(self):
+        return self.rows
+
+def _reading(unit_id, sensor_id, sensor_name):
+    return (1, unit_id, 'Unit', sensor_id, sensor_name, 10.0, None, None, None)
+
+def test_classify_sensor_prefers_parameter():
+    assert classify_sensor('fuel_flow', 'Fuel Level') == 'fuel_flow'
+    assert classify_sensor(None, 'Fuel Level Sensor') == 'fuel_level'
+    assert classify_sensor('', 'Sensor 3') is None
+
+def test_sensor_ids_are_per_unit():
+    # Sensor 1 is a level sensor on one unit and a flow meter on another; the
+    # sensors row of the third unit's sensor 1 belongs to another unit
+    conn = FakeConnection([(100, 1, 'Fuel Level', 'fuel_level'), (200, 1, 'Flow Meter', 'flow_meter')])
+    registry = EventHandlerRegistry()
+    registry.resolve(conn, [_reading(100, 1, 'Sensor 1'), _reading(200, 1, 'Sensor 1'),
+                            _reading(300, 1, 'Fuel Flow')])
+    assert registry.kind_of(100, 1) == 'fuel_level'
+    assert registry.kind_of(200, 1) == 'fuel_flow'
+    assert registry.kind_of(300, 1) == 'fuel_flow'
+    assert conn.queries == 1
+
+def test_dispatch_by_unit_sensor():
+    conn = FakeConnection([(100, 1, 'Fuel Level', 'fuel_level'), (200, 1, 'Flow Meter', 'flow_meter')])
+    registry = EventHandlerRegistry()
+    handled = {}
+    registry.register('fuel_level', lambda conn, batch: handled.setdefault('fuel_level', batch))
+    registry.register('fuel_flow', lambda conn, batch: handled.setdefault('fuel_flow', batch))
+    readings = [_reading(100, 1, 'Sensor 1'), _reading(200, 1, 'Sensor 1')]
+    assert registry.dispatch(conn, readings) == {'fuel_level': 1, 'fuel_flow': 1}
+    assert handled == {'fuel_level': readings[:1], 'fuel_flow': readings[1:]}
+
+def test_unresolved_sensors_expire():
+    # A sensor without a kind is looked up again once it has been configured
+    conn = FakeConnection([(100, 1, 'Sensor 1', '')])
+    registry = EventHandlerRegistry(unresolved_ttl_seconds=0)
+    registry.resolve(conn, [_reading(100, 1, 'Sensor 1')])
+    assert registry.kind_of(100, 1) is None
+
+    conn.sensors = [(100, 1, 'Fuel Level', 'fuel_level')]
+    registry.resolve(conn, [_reading(100, 1, 'Sensor 1')])
+    assert registry.kind_of(100, 1) == 'fuel_level'
+    registry.resolve(conn, [_reading(100, 1, 'Sensor 1')])
+    assert conn.queries == 2
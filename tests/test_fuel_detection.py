@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from fuel_detection import FuelLevelDetector, detect_fuel_events, rolling_median
+
+START = datetime(2024, 1, 1, 6, 0)
+
+def _readings(samples, unit_id=1, sensor_id=40001):
+    """sensor_readings rows for (timestamp, level) samples"""
+    return [
+        (index, unit_id, 'Truck', sensor_id, 'Fuel Level Sensor', level, timestamp, -9.44, 147.18)
+        for index, (timestamp, level) in enumerate(samples)
+    ]
+
+def _simulated_pairs(amounts, level=100.0):
+    """Before/after level pairs around each refuel, as simulation/data_generator.py writes them"""
+    samples = []
+    timestamp = START
+    for amount in amounts:
+        samples.append((timestamp, level))
+        level += amount
+        samples.append((timestamp + timedelta(minutes=7, seconds=30), level))
+        timestamp += timedelta(hours=3)
+    return samples
+
+def _received(events):
+    return [(event[2], round(event[3], 2)) for event in events if event[1] == 'received']
+
+def test_rolling_median_does_not_span_breaks():
+    values = np.array([100.0, 100.0, 100.0, 150.0, 150.0])
+    breaks = np.array([True, False, False, True, False])
+    assert list(rolling_median(values, 5, breaks)) == [100.0, 100.0, 100.0, 150.0, 150.0]
+
+def test_two_reading_refuel():
+    times = np.array([0.0, 300.0])
+    levels = np.array([100.0, 150.0])
+    nan = np.full(2, np.nan)
+    (starts, ends, amounts, closed_at), _ = detect_fuel_events(times, levels, nan, nan)
+    assert list(amounts) == [50.0]
+    assert list(closed_at) == [1]
+
+def test_sparse_before_after_pairs():
+    amounts = [50.0, 50.0, 50.0, 50.0]
+    samples = _simulated_pairs(amounts)
+    events = FuelLevelDetector({}).detect(_readings(samples))
+    assert _received(events) == [(samples[2 * i + 1][0], amount) for i, amount in enumerate(amounts)]
+
+def test_sparse_pairs_across_batches():
+    samples = _simulated_pairs([50.0, 30.0, 75.5])
+    readings = _readings(samples)
+    whole = FuelLevelDetector({}).detect(readings)
+
+    detector = FuelLevelDetector({})
+    streamed = []
+    for reading in readings:
+        streamed.extend(detector.detect([reading]))
+    assert _received(streamed) == _received(whole)
+    assert len(_received(whole)) == 3
+
+def test_dense_series_across_batches():
+    rng = np.random.default_rng(7)
+    samples = []
+    level = 300.0
+    for index in range(2000):
+        if 500 <= index < 506 or 1400 <= index < 1406:
+            level += 40.0
+        elif index % 4 == 0:
+            level -= 0.3
+        samples.append((START + timedelta(seconds=30 * index), level + rng.normal(0, 0.5)))
+    readings = _readings(samples)
+    whole = FuelLevelDetector({}).detect(readings)
+    assert len(_received(whole)) == 2
+
+    for chunk_size in (7, 97, 1000):
+        detector = FuelLevelDetector({})
+        streamed = []
+        for offset in range(0, len(readings), chunk_size):
+            streamed.extend(detector.detect(readings[offset:offset + chunk_size]))
+        assert _received(streamed) == _received(whole)
+
+def _seeded_detector(readings, first_timestamp):
+    """A new detector seeded like FuelDataProcessor does, from the stored readings
+    preceding a sensor's first batch within the detector's context"""
+    detector = FuelLevelDetector({})
+    context = timedelta(seconds=detector.context_seconds())
+    detector.seed((1, 40001), [
+        (row[6], row[5], row[7], row[8]) for row in readings
+        if first_timestamp - context <= row[6] < first_timestamp
+    ])
+    return detector
+
+def test_sparse_refuel_across_detector_instances():
+    readings = _readings([(START, 100.0), (START + timedelta(minutes=5), 150.0)])
+    assert FuelLevelDetector({}).detect(readings[:1]) == []
+
+    detector = _seeded_detector(readings[:1], readings[1][6])
+    assert detector.cold_keys(readings[1:]) == {}
+    assert _received(detector.detect(readings[1:])) == [(readings[1][6], 50.0)]
+
+def test_dense_refuel_across_detector_instances():
+    samples = []
+    level = 200.0
+    for index in range(400):
+        if 200 <= index < 206:
+            level += 40.0
+        samples.append((START + timedelta(seconds=30 * index), level))
+    readings = _readings(samples)
+    whole = _received(FuelLevelDetector({}).detect(readings))
+    assert len(whole) == 1
+
+    # Split in the middle of the refuel, and after it has settled
+    for split in (203, 300):
+        first = FuelLevelDetector({}).detect(readings[:split])
+        cold = FuelLevelDetector({})
+        assert cold.cold_keys(readings[split:]) == {(1, 40001): readings[split][6]}
+        second = _seeded_detector(readings[:split], readings[split][6]).detect(readings[split:])
+        assert _received(first) + _received(second) == whole
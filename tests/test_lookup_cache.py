@@ -0,0 +1,81 @@
+import pytest
+
+pytest.importorskip('geopy')
+
+from lookup_cache import LookupCache
+
+class FakeConnection:
+    """Serves the reference tables LookupCache reads, counting reloads"""
+
+    def __init__(self):
+        self.vehicles = [(1, 40001)]
+        self.drivers = [(7, 'Driver 7', 'IB-7')]
+        self.reloads = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, query, params=None):
+        if 'FROM fuel_management.vehicles' in query:
+            self.conn.reloads += 1
+            self.rows = list(self.conn.vehicles)
+        elif 'FROM fuel_management.drivers' in query:
+            self.rows = list(self.conn.drivers)
+        else:
+            self.rows = []
+
+    def fetchall(self):
+        return self.rows
+
+def test_reload_on_miss_once_per_run():
+    conn = FakeConnection()
+    lookups = LookupCache(ttl_seconds=300)
+    lookups.ensure_fresh(conn)
+    conn.vehicles.append((2, 40002))
+    conn.drivers.append((8, 'Driver 8', 'IB-8'))
+
+    assert lookups.vehicle_id(40002) is None
+    assert lookups.reload_on_miss(conn, ('vehicle_id', 40002))
+    assert lookups.vehicle_id(40002) == 2
+    assert lookups.driver('IB-8') == (8, 'Driver 8')
+
+    # Further misses in the same run do not reload again
+    assert not lookups.reload_on_miss(conn, ('vehicle_id', 40003))
+    assert conn.reloads == 2
+
+    # The next run may reload once more for a new key, without waiting for the TTL
+    lookups.ensure_fresh(conn)
+    assert conn.reloads == 2
+    assert lookups.reload_on_miss(conn, ('vehicle_id', 40004))
+    assert conn.reloads == 3
+
+def test_missed_keys_do_not_reload_until_ttl():
+    conn = FakeConnection()
+    lookups = LookupCache(ttl_seconds=300)
+    lookups.ensure_fresh(conn)
+
+    # An unknown unit reloads once, then stays missed on later runs
+    assert lookups.reload_on_miss(conn, ('vehicle_id', 40009))
+    for _ in range(3):
+        lookups.ensure_fresh(conn)
+        assert not lookups.reload_on_miss(conn, ('vehicle_id', 40009))
+    assert conn.reloads == 2
+
+    # Until the cache is invalidated (or the TTL expires)
+    lookups.invalidate()
+    lookups.ensure_fresh(conn)
+    assert lookups.reload_on_miss(conn, ('vehicle_id', 40009))
+    assert conn.reloads == 4
+
+def test_no_reload_on_miss_with_notify_invalidation():
+    conn = FakeConnection()
+    lookups = LookupCache(ttl_seconds=300)
+    lookups.notify_invalidation = True
+    lookups.ensure_fresh(conn)
+    assert not lookups.reload_on_miss(conn, ('vehicle_id', 40002))
+    assert conn.reloads == 1
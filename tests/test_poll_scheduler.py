@@ -0,0 +1,32 @@
+from poll_scheduler import ACTIVE, DISPENSING, IDLE, UnitPollScheduler
+
+BOWSER_UNIT = 50001
+TRUCK_UNIT = 40001
+SENSORS = {'1': ('Fuel Flow', 'counter', 'flow', None)}
+
+def _message(flow, lat=-9.44, lon=147.18, speed=0):
+    return {'pos': {'y': lat, 'x': lon, 's': speed}, 'p': {'sensors': {'1': flow}}}
+
+def test_empty_polls_step_down_one_level():
+    scheduler = UnitPollScheduler({})
+    assert scheduler.observe(TRUCK_UNIT, [_message(10.0), _message(25.0)], SENSORS) == DISPENSING
+    assert scheduler.observe(TRUCK_UNIT, [], SENSORS) == ACTIVE
+    assert scheduler.observe(TRUCK_UNIT, [], SENSORS) == IDLE
+    assert scheduler.observe(TRUCK_UNIT, [], SENSORS) == IDLE
+
+def test_unobserved_unit_steps_down_to_idle():
+    scheduler = UnitPollScheduler({})
+    assert scheduler.observe(TRUCK_UNIT, [], SENSORS) == IDLE
+
+def test_own_bowser_zone_is_ignored():
+    scheduler = UnitPollScheduler({})
+    scheduler.set_bowser_zones([(BOWSER_UNIT, -9.44, 147.18, 100)])
+    parked = [_message(10.0), _message(10.0)]
+    assert scheduler.observe(BOWSER_UNIT, parked, SENSORS) == IDLE
+    assert scheduler.observe(TRUCK_UNIT, parked, SENSORS) == DISPENSING
+
+def test_outside_bowser_zone():
+    scheduler = UnitPollScheduler({})
+    scheduler.set_bowser_zones([(BOWSER_UNIT, -9.44, 147.18, 100)])
+    moving = [_message(10.0, lat=-9.45, speed=40), _message(10.0, lat=-9.46, speed=40)]
+    assert scheduler.observe(TRUCK_UNIT, moving, SENSORS) == ACTIVE
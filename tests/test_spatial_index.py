@@ -0,0 +1,56 @@
+import random
+
+import pytest
+
+pytest.importorskip('geopy')
+
+from geopy.distance import geodesic
+from spatial_index import BowserZoneIndex
+
+def _linear_scan(zones, lat, lon, default_radius=50):
+    """The geodesic check against every zone that the index replaced"""
+    matches = []
+    for bowser_id, zone_lat, zone_lon, radius in zones:
+        distance = geodesic((lat, lon), (zone_lat, zone_lon)).meters
+        if distance <= (radius or default_radius):
+            matches.append(bowser_id)
+    return set(matches)
+
+def test_matches_linear_scan():
+    rng = random.Random(5)
+    zones = [(f'B{i}', -9.44 + rng.uniform(-0.05, 0.05), 147.18 + rng.uniform(-0.05, 0.05),
+              rng.choice([None, 30, 50, 400, 1500])) for i in range(30)]
+    index = BowserZoneIndex(zones)
+    for _ in range(400):
+        _, zone_lat, zone_lon, _ = rng.choice(zones)
+        lat = zone_lat + rng.uniform(-0.015, 0.015)
+        lon = zone_lon + rng.uniform(-0.015, 0.015)
+        assert set(index.zones_containing(lat, lon)) == _linear_scan(zones, lat, lon)
+
+def test_zone_spanning_cell_boundaries():
+    # Centred on a cell corner, so the zone covers four cells
+    index = BowserZoneIndex([('B1', -9.45, 147.18, 200)])
+    offset = 100 / 111320.0
+    for d_lat in (-offset, offset):
+        for d_lon in (-offset, offset):
+            assert index.zones_containing(-9.45 + d_lat, 147.18 + d_lon) == ['B1']
+
+def test_nearest_first():
+    index = BowserZoneIndex([('far', -9.44, 147.1805, 100), ('near', -9.44, 147.1801, 100)])
+    assert index.zones_containing(-9.44, 147.18) == ['near', 'far']
+
+def test_boundary_uses_geodesic():
+    index = BowserZoneIndex([('B1', -9.44, 147.18, 1000)])
+    for bearing_lat, bearing_lon in ((1, 0), (0, 1)):
+        for meters, inside in ((999.0, True), (1001.0, False)):
+            lat = -9.44 + bearing_lat * 0.02
+            lon = 147.18 + bearing_lon * 0.02
+            # Scale the offset along the bearing to the requested geodesic distance
+            scale = meters / geodesic((-9.44, 147.18), (lat, lon)).meters
+            point = (-9.44 + bearing_lat * 0.02 * scale, 147.18 + bearing_lon * 0.02 * scale)
+            assert (index.zones_containing(*point) == ['B1']) is inside
+
+def test_zones_without_a_center_are_skipped():
+    index = BowserZoneIndex([('B1', None, None, 50)])
+    assert index.zone_count == 0
+    assert index.zones_containing(-9.44, 147.18) == []
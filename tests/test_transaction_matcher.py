@@ -0,0 +1,124 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from transaction_matcher import EventTimeline, match_pending_transactions
+
+START = datetime(2024, 1, 1, 6, 0)
+WINDOW = timedelta(minutes=30)
+THRESHOLD = 5
+
+def _unit_of(entity_id):
+    return 1000 + entity_id
+
+def _greedy_match(transactions, dispensed, received, dispense_window, reception_window, discrepancy_threshold):
+    """The per-transaction scan the matcher replaced: each transaction, in time
+    order, takes the earliest unassigned event in its window"""
+    taken = set()
+
+    def first_free(events, start, end):
+        candidates = [event for event in events
+                      if event[0] not in taken and start <= event[2] <= end]
+        return min(candidates, key=lambda event: (event[2], event[0]), default=None)
+
+    event_assignments = []
+    transaction_updates = []
+    for transaction_id, driver_id, vehicle_id, bowser_id, timestamp in sorted(transactions, key=lambda t: t[4]):
+        dispensation = first_free(dispensed.get(_unit_of(bowser_id), []), timestamp, timestamp + dispense_window)
+        if not dispensation:
+            continue
+        taken.add(dispensation[0])
+        event_assignments.append((dispensation[0], transaction_id))
+
+        reception = first_free(received.get(_unit_of(vehicle_id), []),
+                               dispensation[2], dispensation[2] + reception_window)
+        if not reception:
+            transaction_updates.append((transaction_id, dispensation[1], None, None, None, 'partial'))
+            continue
+        taken.add(reception[0])
+        event_assignments.append((reception[0], transaction_id))
+
+        discrepancy = dispensation[1] - reception[1]
+        percentage = discrepancy / dispensation[1] * 100 if dispensation[1] > 0 else 0
+        status = 'discrepancy' if abs(percentage) > discrepancy_threshold else 'completed'
+        transaction_updates.append((transaction_id, dispensation[1], reception[1], discrepancy, percentage, status))
+    return event_assignments, transaction_updates
+
+def _match(transactions, dispensed, received):
+    event_assignments, transaction_updates, _ = match_pending_transactions(
+        transactions,
+        {unit: EventTimeline(events) for unit, events in dispensed.items()},
+        {unit: EventTimeline(events) for unit, events in received.items()},
+        _unit_of, _unit_of, WINDOW, WINDOW, THRESHOLD
+    )
+    return event_assignments, transaction_updates
+
+def _at(minutes):
+    return START + timedelta(minutes=minutes)
+
+def test_window_edges_are_inclusive():
+    transactions = [('t1', 1, 1, 2, _at(0))]
+    dispensed = {_unit_of(2): [(10, 100.0, _at(-1)), (11, 100.0, _at(0))]}
+    received = {_unit_of(1): [(20, 98.0, _at(30)), (21, 100.0, _at(31))]}
+    event_assignments, transaction_updates = _match(transactions, dispensed, received)
+    assert event_assignments == [(11, 't1'), (20, 't1')]
+    assert transaction_updates[0][-1] == 'completed'
+
+def test_events_past_the_window_are_not_taken():
+    transactions = [('t1', 1, 1, 2, _at(0))]
+    dispensed = {_unit_of(2): [(10, 100.0, _at(-0.5)), (11, 100.0, _at(30.5))]}
+    event_assignments, transaction_updates = _match(transactions, dispensed, {})
+    assert event_assignments == []
+    assert transaction_updates == []
+
+def test_equal_timestamps():
+    # Two transactions on one bowser at the same time share two simultaneous events
+    transactions = [('t1', 1, 1, 2, _at(0)), ('t2', 3, 3, 2, _at(0))]
+    dispensed = {_unit_of(2): [(12, 50.0, _at(5)), (11, 100.0, _at(5))]}
+    received = {_unit_of(1): [(21, 100.0, _at(5))], _unit_of(3): [(22, 40.0, _at(5))]}
+    expected = _greedy_match(transactions, dispensed, received, WINDOW, WINDOW, THRESHOLD)
+    assert _match(transactions, dispensed, received) == expected
+    assert expected[0] == [(11, 't1'), (21, 't1'), (12, 't2'), (22, 't2')]
+
+def test_overlapping_windows_consume_in_order():
+    # Each later transaction's window covers the events the earlier ones took
+    transactions = [(f't{i}', 1, 1, 2, _at(i * 5)) for i in range(4)]
+    dispensed = {_unit_of(2): [(10 + i, 100.0, _at(20 + i)) for i in range(3)]}
+    received = {_unit_of(1): [(20 + i, 100.0, _at(21 + i)) for i in range(3)]}
+    event_assignments, transaction_updates = _match(transactions, dispensed, received)
+    assert [update[0] for update in transaction_updates] == ['t0', 't1', 't2']
+    assert (event_assignments, transaction_updates) == \
+        _greedy_match(transactions, dispensed, received, WINDOW, WINDOW, THRESHOLD)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_greedy_scan(seed):
+    rng = random.Random(seed)
+    # Coarse timestamps make windows overlap and times collide
+    transactions = [(f't{i}', 1, rng.randint(1, 4), rng.randint(5, 6), _at(rng.randrange(0, 240, 5)))
+                    for i in range(rng.randint(1, 40))]
+    event_ids = iter(range(1, 10000))
+    dispensed = {}
+    for _ in range(rng.randint(0, 50)):
+        dispensed.setdefault(_unit_of(rng.randint(5, 6)), []).append(
+            (next(event_ids), float(rng.randint(0, 200)), _at(rng.randrange(-30, 300, 5))))
+    received = {}
+    for _ in range(rng.randint(0, 50)):
+        received.setdefault(_unit_of(rng.randint(1, 4)), []).append(
+            (next(event_ids), float(rng.randint(0, 200)), _at(rng.randrange(-30, 330, 5))))
+    assert _match(transactions, dispensed, received) == \
+        _greedy_match(transactions, dispensed, received, WINDOW, WINDOW, THRESHOLD)
+
+def test_timeout_only_for_unmatched():
+    transactions = [('t1', 1, 1, 2, _at(0)), ('t2', 1, 1, 2, _at(10))]
+    dispensed = {_unit_of(2): [(10, 100.0, _at(5))]}
+    _, transaction_updates, _ = match_pending_transactions(
+        transactions, {unit: EventTimeline(events) for unit, events in dispensed.items()}, {},
+        _unit_of, _unit_of, WINDOW, WINDOW, THRESHOLD, timeout=timedelta(hours=1), now=_at(120)
+    )
+    assert transaction_updates == [
+        ('t1', 100.0, None, None, None, 'partial'),
+        ('t2', None, None, None, None, 'timed_out'),
+    ]
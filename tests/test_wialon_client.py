@@ -0,0 +1,54 @@
+import pytest
+
+pytest.importorskip('requests')
+
+from wialon_client import WialonAPIClient
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # The client logs to a file in the working directory
+    monkeypatch.chdir(tmp_path)
+    return WialonAPIClient({'token': 'test', 'batch_size': 3})
+
+def _answer_batches(client, monkeypatch, answer):
+    """Replace _call_api with answer(chunk_number, sub_requests), recording the chunks"""
+    chunks = []
+
+    def call_api(service, params=None, post=False):
+        assert service == 'core/batch' and post
+        chunks.append(params['params'])
+        return answer(len(chunks) - 1, params['params'])
+
+    monkeypatch.setattr(client, '_call_api', call_api)
+    return chunks
+
+def _calls(count):
+    return [('core/search_item', {'id': unit_id}) for unit_id in range(count)]
+
+def _echo(chunk_number, sub_requests):
+    return [{'item': request['params']['id']} for request in sub_requests]
+
+@pytest.mark.parametrize('count', [0, 1, 3, 7])
+def test_chunks_keep_call_order(client, monkeypatch, count):
+    chunks = _answer_batches(client, monkeypatch, _echo)
+    results = client.call_batch(_calls(count))
+    assert [len(chunk) for chunk in chunks] == [3] * (count // 3) + ([count % 3] if count % 3 else [])
+    assert results == [{'item': unit_id} for unit_id in range(count)]
+
+def test_failed_sub_request_is_none(client, monkeypatch):
+    def answer(chunk_number, sub_requests):
+        results = _echo(chunk_number, sub_requests)
+        if chunk_number == 1:
+            results[0] = {'error': 7}
+        return results
+
+    _answer_batches(client, monkeypatch, answer)
+    assert client.call_batch(_calls(5)) == [{'item': 0}, {'item': 1}, {'item': 2}, None, {'item': 4}]
+
+@pytest.mark.parametrize('failure', [None, {'error': 1}, [{'item': 0}]])
+def test_failed_batch_is_none(client, monkeypatch, failure):
+    def answer(chunk_number, sub_requests):
+        return failure if chunk_number == 0 else _echo(chunk_number, sub_requests)
+
+    _answer_batches(client, monkeypatch, answer)
+    assert client.call_batch(_calls(5)) == [None, None, None, {'item': 3}, {'item': 4}]
@@ -8,11 +8,17 @@ WIALON_CONFIG = {
     'production': {
         'base_url': 'https://hst-api.wialon.com',
         'token': 'your_wialon_token_here',  # Replace with your actual token
+        'connect_timeout': 5,   # Seconds to establish a connection
+        'read_timeout': 60,     # Seconds to wait for a response
+        'pool_maxsize': 10,     # Keep-alive connections per host
     },
     # For development and testing with mock server
     'development': {
         'base_url': 'http://localhost:8080',
         'token': 'test_token',
+        'connect_timeout': 5,
+        'read_timeout': 30,
+        'pool_maxsize': 10,
     }
 }
 
@@ -40,11 +46,25 @@ COLLECTOR_CONFIG = {
     'production': {
         'enable_hourly_polling': True,
         'poll_interval_minutes': 60,  # 1 hour
+        'enable_adaptive_polling': True,  # Per-unit intervals from recent activity
+        'poll_interval_dispensing_seconds': 60,
+        'poll_interval_active_seconds': 300,
+        'poll_interval_idle_seconds': 3600,
+        'poll_budget_calls_per_minute': 600,  # Wialon API calls across all units
+        'enable_streaming': False,  # Real-time messages through avl_evts long-polling
+        'stream_flush_seconds': 2,
     },
     # For development
     'development': {
         'enable_hourly_polling': True,
         'poll_interval_minutes': 15,  # 15 minutes for faster testing
+        'enable_adaptive_polling': True,
+        'poll_interval_dispensing_seconds': 30,
+        'poll_interval_active_seconds': 120,
+        'poll_interval_idle_seconds': 900,
+        'poll_budget_calls_per_minute': 600,
+        'enable_streaming': True,
+        'stream_flush_seconds': 2,
     }
 }
 
@@ -54,6 +74,5 @@ def get_config(environment='development'):
     return {
         'wialon': WIALON_CONFIG.get(environment, WIALON_CONFIG['development']),
         'database': DATABASE_CONFIG.get(environment, DATABASE_CONFIG['development']),
-        'enable_hourly_polling': COLLECTOR_CONFIG.get(environment, COLLECTOR_CONFIG['development'])['enable_hourly_polling'],
-        'poll_interval_minutes': COLLECTOR_CONFIG.get(environment, COLLECTOR_CONFIG['development'])['poll_interval_minutes'],
+        **COLLECTOR_CONFIG.get(environment, COLLECTOR_CONFIG['development']),
     }
\ No newline at end of file
@@ -2,11 +2,17 @@ import schedule
 import time
 import threading
 import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 from datetime import datetime, timedelta
 import psycopg2
+from psycopg2.extras import execute_values
 import json
 from wialon_client import WialonAPIClient
+from poll_scheduler import UnitPollScheduler, DISPENSING, ACTIVE, IDLE
+
+# Data types fetched by adaptive polls
+ADAPTIVE_POLL_DATA_TYPES = ['messages', 'sensors']
 
 class WialonDataCollector:
     def __init__(self, config):
@@ -15,9 +21,35 @@ class WialonDataCollector:
         self.db_config = config.get('database', {})
         self.hourly_poll_enabled = config.get('enable_hourly_polling', True)
         self.poll_interval = config.get('poll_interval_minutes', 60)
+        # Adaptive polling replaces the fixed interval poll with per-unit intervals
+        self.adaptive_polling_enabled = config.get('enable_adaptive_polling', False)
+        self.adaptive_tick_seconds = config.get('adaptive_tick_seconds', 30)
+        self.unit_refresh_interval = config.get('unit_refresh_minutes', 60) * 60
+        self.poll_scheduler = UnitPollScheduler(config) if self.adaptive_polling_enabled else None
+        self.units_refreshed_at = None
+        # Streaming receives new messages from the Wialon event queue as they arrive
+        self.streaming_enabled = config.get('enable_streaming', False)
+        self.stream_wait_seconds = config.get('stream_wait_seconds', 25)
+        self.stream_batch_size = config.get('stream_batch_size', 500)
+        self.stream_flush_seconds = config.get('stream_flush_seconds', 2)
+        self.stream_idle_seconds = config.get('stream_idle_seconds', 1)
+        self.stream_reconnect_seconds = config.get('stream_reconnect_seconds', 5)
+        # Concurrent core/batch requests per collection; the client's pool_maxsize
+        # should be at least this so every fetch thread keeps its connection alive
+        self.collection_concurrency = config.get('collection_concurrency', 8)
+        # Sensor readings are buffered and written in multi-row inserts of this size
+        self.insert_chunk_size = config.get('insert_chunk_size', 5000)
+        # Readings dropped as already stored, in the last collection and overall
+        self.last_duplicate_readings = 0
+        self.total_duplicate_readings = 0
         self.last_poll_time = None
+        # unit_id -> {sensor_id (str): (name, type, parameter, formula)}, as last stored
+        self.sensor_cache = {}
         self.polling_lock = threading.Lock()
         self.on_demand_queue = queue.Queue()
+        # The on-demand collection in progress; new requests it covers attach to it
+        self.on_demand_lock = threading.Lock()
+        self.on_demand_run = None
         self.logger = self._setup_logger()
     
     def _setup_logger(self):
@@ -42,15 +74,24 @@ class WialonDataCollector:
     def start(self):
         """Start the data collection services"""
         # Initialize scheduled polling if enabled
-        if self.hourly_poll_enabled:
+        if self.adaptive_polling_enabled:
+            # Check for units due for polling every tick
+            schedule.every(self.adaptive_tick_seconds).seconds.do(self.adaptive_poll)
+        elif self.hourly_poll_enabled:
             # Schedule the job to run at the specified interval
             minutes = self.poll_interval
             schedule.every(minutes).minutes.do(self.scheduled_poll)
-            
+        
+        if self.adaptive_polling_enabled or self.hourly_poll_enabled:
             # Start the scheduler in a background thread
             scheduler_thread = threading.Thread(target=self._run_scheduler, daemon=True)
             scheduler_thread.start()
         
+        # Start the event stream if enabled
+        if self.streaming_enabled:
+            stream_thread = threading.Thread(target=self._run_stream, daemon=True)
+            stream_thread.start()
+        
         # Start the on-demand request processor
         on_demand_thread = threading.Thread(target=self._process_on_demand_requests, daemon=True)
         on_demand_thread.start()
@@ -63,18 +104,143 @@ class WialonDataCollector:
             schedule.run_pending()
             time.sleep(1)
     
+    def _run_stream(self):
+        """Receive new unit messages from the Wialon event queue and store them in micro-batches"""
+        while True:
+            try:
+                session_id = self.wialon_client.subscribe_unit_messages()
+                if not session_id:
+                    self.logger.error("Failed to subscribe to Wialon unit events")
+                else:
+                    self.logger.info("Subscribed to Wialon unit events")
+                    # Events are queued from the subscription on, so first catch up on
+                    # what arrived before it; streamed messages then advance the
+                    # collection cursors without jumping over a gap
+                    current_time = datetime.now()
+                    with self.polling_lock:
+                        caught_up = self._collect_data(
+                            current_time - timedelta(minutes=self.poll_interval), current_time,
+                            data_types=['messages']
+                        )
+                    if caught_up:
+                        self._consume_events(session_id)
+                    else:
+                        self.logger.error("Catch-up collection before streaming failed")
+            except Exception as e:
+                self.logger.error(f"Error in event stream: {str(e)}")
+            
+            time.sleep(self.stream_reconnect_seconds)
+    
+    def _consume_events(self, session_id):
+        """Long-poll the events of the subscribed session and store new messages in
+        batches of up to stream_batch_size, at most stream_flush_seconds after the
+        first one arrived; return when the session is lost or replaced"""
+        conn = self._get_db_connection()
+        buffer = []
+        first_buffered = None
+        try:
+            while True:
+                # Only wait briefly while messages are buffered, so they are flushed on time
+                wait = self.stream_flush_seconds if buffer else self.stream_wait_seconds
+                started = time.monotonic()
+                events = self.wialon_client.get_events(wait, session_id)
+                if events is None:
+                    self.logger.warning("Wialon event stream interrupted, subscribing again")
+                    return
+                
+                for event in events:
+                    # 'm' events carry a new message of unit 'i'
+                    if event.get('t') == 'm' and event.get('d'):
+                        buffer.append((event.get('i'), event['d']))
+                if buffer and first_buffered is None:
+                    first_buffered = time.monotonic()
+                
+                if self.wialon_client.session_id != session_id:
+                    # Polling logged in again; the new session has no subscription
+                    self.logger.warning("Wialon session changed, subscribing again")
+                    return
+                
+                if buffer and (len(buffer) >= self.stream_batch_size or
+                               time.monotonic() - first_buffered >= self.stream_flush_seconds):
+                    self._store_stream_messages(conn, buffer)
+                    buffer = []
+                    first_buffered = None
+                elif not events:
+                    # Servers that answer at once instead of long-polling are not hammered
+                    time.sleep(max(0, self.stream_idle_seconds - (time.monotonic() - started)))
+        finally:
+            if buffer:
+                try:
+                    self._store_stream_messages(conn, buffer)
+                except psycopg2.Error as e:
+                    self.logger.error(f"Error storing streamed messages: {str(e)}")
+            conn.close()
+    
+    def _store_stream_messages(self, conn, events):
+        """Store a micro-batch of streamed (unit_id, message) pairs and advance the
+        collection cursors of their units"""
+        messages_by_unit = {}
+        for unit_id, message in events:
+            messages_by_unit.setdefault(unit_id, []).append(message)
+        
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT unit_id, name FROM wialon_data.units
+                WHERE unit_id = ANY(%s)
+            """, (list(messages_by_unit.keys()),))
+            unit_names = dict(cursor.fetchall())
+            
+            readings = []
+            last_message_times = {}
+            for unit_id, messages in messages_by_unit.items():
+                messages.sort(key=lambda message: message.get('t', 0))
+                unit_sensors = self._get_unit_sensors(cursor, unit_id)
+                self._process_messages(conn, cursor, unit_id, unit_names.get(unit_id, f"Unit {unit_id}"),
+                                       messages, unit_sensors, readings, collection_method='stream')
+                # Cursors can only be kept for units already stored by a collection
+                if unit_id in unit_names:
+                    last_message_times[unit_id] = datetime.fromtimestamp(messages[-1].get('t', 0))
+            
+            inserted, duplicates = self._write_sensor_readings(cursor, readings)
+            self._advance_collection_cursors(cursor, last_message_times)
+            conn.commit()
+            
+            self.total_duplicate_readings += duplicates
+            self.logger.info(
+                f"Streamed {len(events)} messages from {len(messages_by_unit)} units: "
+                f"{inserted} readings stored, {duplicates} duplicates dropped"
+            )
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    
     def _process_on_demand_requests(self):
         """Process on-demand data retrieval requests"""
         while True:
             try:
                 # Get request from queue with timeout
-                request = self.on_demand_queue.get(timeout=5)
+                requests = [self.on_demand_queue.get(timeout=5)]
+                
+                # Everything queued meanwhile is served by the same collection run
+                while True:
+                    try:
+                        requests.append(self.on_demand_queue.get_nowait())
+                    except queue.Empty:
+                        break
                 
-                # Process the request
-                self._fulfill_on_demand_request(request)
+                run = self._merge_on_demand_requests(requests)
+                with self.on_demand_lock:
+                    self.on_demand_run = run
+                
+                # Process the merged request
+                self._fulfill_on_demand_request(run)
                 
                 # Mark as done
-                self.on_demand_queue.task_done()
+                for _ in requests:
+                    self.on_demand_queue.task_done()
             except queue.Empty:
                 # No requests, just continue waiting
                 pass
@@ -103,24 +269,135 @@ class WialonDataCollector:
             except Exception as e:
                 self.logger.error(f"Error in scheduled poll: {str(e)}")
     
+    def adaptive_poll(self):
+        """Poll the units that are due according to their recent activity"""
+        with self.polling_lock:
+            try:
+                if self.units_refreshed_at is None or \
+                        time.monotonic() - self.units_refreshed_at >= self.unit_refresh_interval:
+                    self._refresh_poll_units()
+                
+                calls_per_unit = self._calls_per_unit(ADAPTIVE_POLL_DATA_TYPES)
+                due = self.poll_scheduler.due_units(self.adaptive_tick_seconds, calls_per_unit)
+                if not due:
+                    return
+                
+                # Units without a collection cursor start one idle interval back
+                current_time = datetime.now()
+                start_time = current_time - timedelta(seconds=self.poll_scheduler.intervals[IDLE])
+                success = self._collect_data(start_time, current_time, due, ADAPTIVE_POLL_DATA_TYPES)
+                self.poll_scheduler.mark_polled(due)
+                
+                counts, calls_per_minute = self.poll_scheduler.summary(calls_per_unit)
+                self.logger.info(
+                    f"Adaptive poll of {len(due)} units {'completed' if success else 'failed'}; "
+                    f"{counts[DISPENSING]} dispensing, {counts[ACTIVE]} active, {counts[IDLE]} idle units, "
+                    f"about {calls_per_minute:.0f} API calls per minute"
+                )
+            except Exception as e:
+                self.logger.error(f"Error in adaptive poll: {str(e)}")
+    
+    def _refresh_poll_units(self):
+        """Reload the unit list and the bowser geozones used by the adaptive poll scheduler"""
+        units_data = self.wialon_client.get_units()
+        if not units_data or "items" not in units_data:
+            self.logger.error("Failed to retrieve units data for adaptive polling")
+            return
+        
+        self.poll_scheduler.sync_units([unit["id"] for unit in units_data["items"]])
+        
+        conn = self._get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT b.wialon_unit_id, g.center_latitude, g.center_longitude, g.radius
+                FROM fuel_management.bowsers b
+                JOIN wialon_data.geozones g ON g.geozone_id = b.geozone_id
+                WHERE b.active = TRUE AND g.active = TRUE
+                AND g.type = 1 AND g.radius IS NOT NULL
+            """)
+            self.poll_scheduler.set_bowser_zones(cursor.fetchall())
+        finally:
+            conn.close()
+        
+        self.units_refreshed_at = time.monotonic()
+    
     def request_on_demand_data(self, unit_ids=None, data_types=None, callback=None):
-        """Request immediate data retrieval for specific units/data"""
+        """Request immediate data retrieval for specific units/data.
+        
+        A request covered by the collection already in progress is attached to
+        it; otherwise it is queued, and all requests queued while that
+        collection runs are merged into the next one.
+        """
         request = {
             'unit_ids': unit_ids,  # List of unit IDs or None for all
             'data_types': data_types,  # List of data types or None for all
             'timestamp': datetime.now(),
-            'callback': callback  # Optional callback function
+            'callbacks': [callback] if callback else []  # Optional callback functions
         }
         
-        self.on_demand_queue.put(request)
+        with self.on_demand_lock:
+            run = self.on_demand_run
+            if run is not None and self._covers(run, unit_ids, data_types):
+                run['callbacks'].extend(request['callbacks'])
+                self.logger.info(f"On-demand data request attached to the run from {run['timestamp']}")
+                return run['timestamp']
+            
+            self.on_demand_queue.put(request)
         self.logger.info(f"On-demand data request queued: {request['timestamp']}")
         
         return request['timestamp']  # Return request ID for reference
     
+    def _merge_on_demand_requests(self, requests):
+        """Merge requests into one covering the union of their units and data types"""
+        if any(request['unit_ids'] is None for request in requests):
+            unit_ids = None
+        else:
+            unit_ids = sorted({unit_id for request in requests for unit_id in request['unit_ids']})
+        
+        if any(request['data_types'] is None for request in requests):
+            data_types = None
+        else:
+            data_types = sorted({data_type for request in requests for data_type in request['data_types']})
+        
+        return {
+            'unit_ids': unit_ids,
+            'data_types': data_types,
+            'timestamp': requests[0]['timestamp'],
+            'callbacks': [callback for request in requests for callback in request['callbacks']],
+            'merged': len(requests)
+        }
+    
+    def _covers(self, run, unit_ids, data_types):
+        """Check whether a run collects every unit and data type of a request"""
+        if run['unit_ids'] is not None and (unit_ids is None or not set(unit_ids) <= set(run['unit_ids'])):
+            return False
+        if run['data_types'] is not None and (data_types is None or not set(data_types) <= set(run['data_types'])):
+            return False
+        return True
+    
+    def _finish_on_demand_run(self, run):
+        """Detach the run so no more requests attach to it; return its callbacks"""
+        with self.on_demand_lock:
+            if self.on_demand_run is run:
+                self.on_demand_run = None
+            return list(run['callbacks'])
+    
+    def _notify_on_demand_callbacks(self, callbacks, success, start_time, end_time):
+        """Call every waiting callback with the result of one collection run"""
+        for callback in callbacks:
+            try:
+                callback(success, start_time, end_time)
+            except Exception as e:
+                self.logger.error(f"Error in on-demand callback: {str(e)}")
+    
     def _fulfill_on_demand_request(self, request):
         """Process an on-demand data request"""
         try:
-            self.logger.info(f"Processing on-demand request from {request['timestamp']}")
+            self.logger.info(
+                f"Processing on-demand request from {request['timestamp']} "
+                f"({request.get('merged', 1)} requests merged)"
+            )
             
             # Get the most recent data for requested units
             unit_ids = request['unit_ids']
@@ -139,15 +416,14 @@ class WialonDataCollector:
             # Collect the data
             success = self._collect_data(start_time, end_time, unit_ids, data_types)
             
-            # Call the callback if provided
-            if request['callback']:
-                request['callback'](success, start_time, end_time)
+            # Call the callbacks of every request served by this run
+            callbacks = self._finish_on_demand_run(request)
+            self._notify_on_demand_callbacks(callbacks, success, start_time, end_time)
             
-            self.logger.info(f"On-demand request completed: {success}")
+            self.logger.info(f"On-demand request completed: {success} ({len(callbacks)} callbacks)")
         except Exception as e:
             self.logger.error(f"Error fulfilling on-demand request: {str(e)}")
-            if request['callback']:
-                request['callback'](False, None, None)
+            self._notify_on_demand_callbacks(self._finish_on_demand_run(request), False, None, None)
     
     def _collect_data(self, start_time, end_time, unit_ids=None, data_types=None):
         """Collect data from Wialon for the specified time period"""
@@ -176,13 +452,61 @@ class WialonDataCollector:
             conn = self._get_db_connection()
             cursor = conn.cursor()
             
+            inserted = 0
+            duplicates = 0
+            insert_seconds = 0.0
+            failed_units = []
             try:
-                # Process each unit
-                for unit_id in unit_ids:
-                    self._collect_unit_data(conn, cursor, unit_id, start_time, end_time, data_types)
-                
+                # Units with a cursor only need messages after their last collected one
+                from_times = {
+                    unit_id: last_message_time + timedelta(seconds=1)
+                    for unit_id, last_message_time in self._load_collection_cursors(cursor, unit_ids).items()
+                }
                 conn.commit()
-                return True
+                
+                # Units are fetched concurrently; this thread is the only writer and
+                # stores and commits each group of units as soon as it arrives
+                for bundles in self._fetch_unit_bundles(unit_ids, start_time, end_time, data_types, from_times):
+                    readings = []
+                    sensor_updates = {}
+                    last_message_times = {}
+                    try:
+                        for unit_id, bundle in bundles.items():
+                            last_message_time = self._store_unit_data(
+                                conn, cursor, unit_id, bundle, data_types, readings, sensor_updates
+                            )
+                            if last_message_time is not None:
+                                last_message_times[unit_id] = last_message_time
+                        
+                        started = time.perf_counter()
+                        group_inserted, group_duplicates = self._write_sensor_readings(cursor, readings)
+                        insert_seconds += time.perf_counter() - started
+                        
+                        self._advance_collection_cursors(cursor, last_message_times)
+                        conn.commit()
+                        inserted += group_inserted
+                        duplicates += group_duplicates
+                    except psycopg2.Error as e:
+                        # The group's cursors are not advanced, so the next poll fetches it again
+                        conn.rollback()
+                        failed_units.extend(bundles.keys())
+                        self.logger.error(f"Database error storing units {list(bundles.keys())}: {str(e)}")
+                        continue
+                    
+                    # Only cache sensor lists once they are stored
+                    self.sensor_cache.update(sensor_updates)
+                
+                self.last_duplicate_readings = duplicates
+                self.total_duplicate_readings += duplicates
+                if inserted or duplicates:
+                    rate = inserted / insert_seconds if insert_seconds > 0 else float(inserted)
+                    self.logger.info(
+                        f"Inserted {inserted} sensor readings in {insert_seconds:.2f} s ({rate:.0f} rows/s), "
+                        f"dropped {duplicates} duplicates"
+                    )
+                if failed_units:
+                    self.logger.error(f"Data collection failed for {len(failed_units)} of {len(unit_ids)} units")
+                return not failed_units
             except Exception as e:
                 conn.rollback()
                 self.logger.error(f"Database error in data collection: {str(e)}")
@@ -195,13 +519,57 @@ class WialonDataCollector:
             self.logger.error(f"Error in data collection: {str(e)}")
             return False
     
-    def _collect_unit_data(self, conn, cursor, unit_id, start_time, end_time, data_types):
-        """Collect data for a specific unit"""
-        # Get unit details
-        unit_data = self.wialon_client.get_unit_data(unit_id)
+    def _load_collection_cursors(self, cursor, unit_ids):
+        """Get the last collected message time of each unit that has one"""
+        cursor.execute("""
+            SELECT unit_id, last_message_time FROM wialon_data.collection_cursors
+            WHERE unit_id = ANY(%s)
+        """, (list(unit_ids),))
+        return dict(cursor.fetchall())
+    
+    def _advance_collection_cursors(self, cursor, last_message_times):
+        """Move unit cursors forward to the last message stored for each unit"""
+        if not last_message_times:
+            return
+        
+        execute_values(cursor, """
+            INSERT INTO wialon_data.collection_cursors AS c
+            (unit_id, last_message_time, updated_at)
+            VALUES %s
+            ON CONFLICT (unit_id) DO UPDATE
+            SET last_message_time = GREATEST(c.last_message_time, EXCLUDED.last_message_time),
+                updated_at = EXCLUDED.updated_at
+        """, [(unit_id, last_message_time, datetime.now())
+              for unit_id, last_message_time in last_message_times.items()])
+    
+    def _calls_per_unit(self, data_types):
+        """Get the number of Wialon API calls needed to collect one unit"""
+        return 1 + ('sensors' in data_types) + ('messages' in data_types)
+    
+    def _fetch_unit_bundles(self, unit_ids, start_time, end_time, data_types, from_times=None):
+        """Fetch unit data in groups of one core/batch request each, running up to
+        collection_concurrency requests at a time; yield each group's bundles as
+        it completes. from_times maps units to their own message interval start."""
+        group_size = max(1, self.wialon_client.batch_size // self._calls_per_unit(data_types))
+        groups = [unit_ids[i:i + group_size] for i in range(0, len(unit_ids), group_size)]
+        
+        with ThreadPoolExecutor(max_workers=self.collection_concurrency) as executor:
+            futures = [
+                executor.submit(self.wialon_client.get_units_bundle, group, start_time, end_time, data_types, from_times)
+                for group in groups
+            ]
+            for future in as_completed(futures):
+                yield future.result()
+    
+    def _store_unit_data(self, conn, cursor, unit_id, bundle, data_types, readings, sensor_updates):
+        """Store the unit details and sensors fetched for a unit and add the
+        sensor readings of its messages to readings; changed sensor lists are
+        added to sensor_updates. Returns the time of the unit's last message,
+        or None if no messages were collected."""
+        unit_data = bundle.get('unit')
         if not unit_data:
             self.logger.warning(f"Could not get data for unit {unit_id}")
-            return
+            return None
         
         unit_name = unit_data.get('nm', f"Unit {unit_id}")
         
@@ -215,32 +583,51 @@ class WialonDataCollector:
                 updated_at = EXCLUDED.updated_at
         """, (unit_id, unit_name, datetime.now()))
         
-        # Collect sensors if needed
+        # Store sensors if collected (before messages, which use them)
+        unit_sensors = None
         if 'sensors' in data_types:
-            sensors_data = self.wialon_client.get_unit_sensors(unit_id)
+            sensors_data = bundle.get('sensors')
             if sensors_data and 'sensors' in sensors_data:
-                self._process_sensors(conn, cursor, unit_id, sensors_data['sensors'])
+                unit_sensors = self._process_sensors(conn, cursor, unit_id, sensors_data['sensors'])
+                if unit_sensors != self.sensor_cache.get(unit_id):
+                    sensor_updates[unit_id] = unit_sensors
+            elif sensors_data is None:
+                self.logger.warning(f"Could not get sensors for unit {unit_id}")
         
-        # Collect messages with sensor data if needed
+        # Store messages with sensor data if collected
         if 'messages' in data_types:
-            messages = self.wialon_client.get_messages(
-                unit_id, 
-                start_time, 
-                end_time,
-                sensors=True
-            )
-            
+            messages = bundle.get('messages')
             if messages and 'messages' in messages:
-                self._process_messages(conn, cursor, unit_id, unit_name, messages['messages'])
+                if unit_sensors is None:
+                    unit_sensors = self._get_unit_sensors(cursor, unit_id)
+                self._process_messages(conn, cursor, unit_id, unit_name, messages['messages'],
+                                       unit_sensors, readings)
+                if self.poll_scheduler is not None:
+                    self.poll_scheduler.observe(unit_id, messages['messages'], unit_sensors)
+                if messages['messages']:
+                    return datetime.fromtimestamp(max(message.get('t', 0) for message in messages['messages']))
+            elif messages is None:
+                self.logger.warning(f"Could not get messages for unit {unit_id}")
+        
+        return None
     
     def _process_sensors(self, conn, cursor, unit_id, sensors):
-        """Process and store sensor data"""
+        """Store a unit's sensor list if it changed since it was last stored;
+        return it as a {sensor_id: (name, type, parameter, formula)} dictionary"""
+        unit_sensors = {}
+        for sensor in sensors:
+            sensor_id = sensor.get('id')
+            unit_sensors[str(sensor_id)] = (
+                sensor.get('n', f"Sensor {sensor_id}"), sensor.get('t', 0),
+                sensor.get('p', ''), sensor.get('f', '')
+            )
+        
+        if unit_sensors == self.sensor_cache.get(unit_id):
+            return unit_sensors
+        
         for sensor in sensors:
             sensor_id = sensor.get('id')
-            sensor_name = sensor.get('n', f"Sensor {sensor_id}")
-            sensor_type = sensor.get('t', 0)
-            parameter = sensor.get('p', '')
-            formula = sensor.get('f', '')
+            sensor_name, sensor_type, parameter, formula = unit_sensors[str(sensor_id)]
             
             try:
                 cursor.execute("""
@@ -260,10 +647,34 @@ class WialonDataCollector:
                 ))
             except Exception as e:
                 self.logger.error(f"Error storing sensor {sensor_id}: {str(e)}")
+        
+        return unit_sensors
     
-    def _process_messages(self, conn, cursor, unit_id, unit_name, messages):
-        """Process and store message data with sensor readings"""
-        # Implementation placeholder
+    def _get_unit_sensors(self, cursor, unit_id):
+        """Get a unit's sensor dictionary from the cache, loading it from the database once.
+        
+        A unit without stored sensors is not cached, so its sensors are picked
+        up as soon as they are stored.
+        """
+        unit_sensors = self.sensor_cache.get(unit_id)
+        if unit_sensors is None:
+            cursor.execute("""
+                SELECT sensor_id, name, type, parameter, formula FROM wialon_data.sensors
+                WHERE unit_id = %s
+            """, (unit_id,))
+            unit_sensors = {
+                str(sensor_id): (name, sensor_type, parameter, formula)
+                for sensor_id, name, sensor_type, parameter, formula in cursor.fetchall()
+            }
+            if unit_sensors:
+                self.sensor_cache[unit_id] = unit_sensors
+        return unit_sensors
+    
+    def _process_messages(self, conn, cursor, unit_id, unit_name, messages, unit_sensors, readings,
+                          collection_method=None):
+        """Build sensor reading rows from message data and add them to readings,
+        naming each reading from the unit's sensor dictionary. collection_method
+        overrides the scheduled/on-demand method of polled messages."""
         self.logger.debug(f"Processing {len(messages)} messages for unit {unit_id}")
         
         for message in messages:
@@ -271,37 +682,44 @@ class WialonDataCollector:
             lat = message.get('pos', {}).get('y')
             lon = message.get('pos', {}).get('x')
             speed = message.get('pos', {}).get('s', 0)
+            method = collection_method or (
+                'on_demand' if self.last_poll_time and timestamp > self.last_poll_time else 'scheduled'
+            )
             
             # Process sensor readings in the message
             if 'p' in message and 'sensors' in message['p']:
                 for sensor_id, value in message['p']['sensors'].items():
-                    # Get sensor information
-                    cursor.execute("""
-                        SELECT name, type FROM wialon_data.sensors
-                        WHERE sensor_id = %s
-                    """, (sensor_id,))
-                    
-                    sensor_info = cursor.fetchone()
+                    sensor_info = unit_sensors.get(str(sensor_id))
                     if sensor_info:
-                        sensor_name, sensor_type = sensor_info
+                        sensor_name, sensor_type = sensor_info[0], sensor_info[1]
                     else:
                         sensor_name, sensor_type = f"Sensor {sensor_id}", 0
                     
-                    # Store the sensor reading
-                    try:
-                        cursor.execute("""
-                            INSERT INTO wialon_data.sensor_readings
-                            (unit_id, unit_name, sensor_id, sensor_name, sensor_type,
-                             value, timestamp, latitude, longitude, speed,
-                             collection_method)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        """, (
-                            unit_id, unit_name, sensor_id, sensor_name, sensor_type,
-                            value, timestamp, lat, lon, speed,
-                            'on_demand' if self.last_poll_time and timestamp > self.last_poll_time else 'scheduled'
-                        ))
-                    except Exception as e:
-                        self.logger.error(f"Error storing sensor reading: {str(e)}")
+                    readings.append((
+                        unit_id, unit_name, sensor_id, sensor_name, sensor_type,
+                        value, timestamp, lat, lon, speed, method
+                    ))
+    
+    def _write_sensor_readings(self, cursor, readings):
+        """Insert buffered sensor readings in chunks of insert_chunk_size rows and
+        clear the buffer. Readings already stored are skipped; returns
+        (inserted, duplicates)."""
+        count = len(readings)
+        if not count:
+            return 0, 0
+        
+        stored = execute_values(cursor, """
+            INSERT INTO wialon_data.sensor_readings
+            (unit_id, unit_name, sensor_id, sensor_name, sensor_type,
+             value, timestamp, latitude, longitude, speed,
+             collection_method)
+            VALUES %s
+            ON CONFLICT (unit_id, sensor_id, timestamp) DO NOTHING
+            RETURNING 1
+        """, readings, page_size=self.insert_chunk_size, fetch=True)
+        
+        readings.clear()
+        return len(stored), count - len(stored)
 
 if __name__ == "__main__":
     # Example configuration
@@ -317,7 +735,13 @@ if __name__ == "__main__":
             'password': 'your_password'
         },
         'enable_hourly_polling': True,
-        'poll_interval_minutes': 15  # Poll every 15 minutes for testing
+        'poll_interval_minutes': 15,  # Poll every 15 minutes for testing
+        'collection_concurrency': 8,
+        'insert_chunk_size': 5000,
+        'enable_adaptive_polling': True,
+        'poll_budget_calls_per_minute': 600,
+        'enable_streaming': True,  # Real-time messages from the mock's /avl_evts
+        'stream_flush_seconds': 2
     }
     
     # Create and start the collector
@@ -0,0 +1,172 @@
+import logging
+import math
+import threading
+import time
+
+# Activity levels, busiest first
+DISPENSING = 'dispensing'  # Fuel flowing, or standing in a bowser geozone
+ACTIVE = 'active'          # Moving or ignition on
+IDLE = 'idle'              # Parked, or no messages over the last polls
+
+LEVELS = (DISPENSING, ACTIVE, IDLE)
+
+class UnitPollScheduler:
+    def __init__(self, config, logger=None):
+        """Initialize the adaptive per-unit poll scheduler"""
+        self.logger = logger or logging.getLogger('wialon_data_collector')
+        idle_default = config.get('poll_interval_minutes', 60) * 60
+        self.intervals = {
+            DISPENSING: config.get('poll_interval_dispensing_seconds', 60),
+            ACTIVE: config.get('poll_interval_active_seconds', 300),
+            IDLE: config.get('poll_interval_idle_seconds', idle_default),
+        }
+        # Wialon API calls allowed per minute across all units; 0 disables the budget
+        self.budget_calls_per_minute = config.get('poll_budget_calls_per_minute', 600)
+        self.moving_speed = config.get('moving_speed_kmh', 5)
+        self.flow_threshold = config.get('fuel_flow_threshold_liters', 0.5)
+        
+        self._lock = threading.Lock()
+        self._activity = {}     # unit_id -> activity level
+        self._last_polled = {}  # unit_id -> monotonic time of the last poll, None if never
+        self._bowser_zones = []  # (bowser unit_id, latitude, longitude, radius_meters) of bowser geozones
+    
+    def sync_units(self, unit_ids):
+        """Track the given units; new units are due at once, missing ones are dropped"""
+        with self._lock:
+            current = set(unit_ids)
+            for unit_id in list(self._last_polled):
+                if unit_id not in current:
+                    self._last_polled.pop(unit_id)
+                    self._activity.pop(unit_id, None)
+            for unit_id in unit_ids:
+                self._last_polled.setdefault(unit_id, None)
+    
+    def set_bowser_zones(self, zones):
+        """Set the circular bowser geozones as (bowser unit_id, latitude, longitude, radius_meters)"""
+        with self._lock:
+            self._bowser_zones = list(zones)
+    
+    def interval(self, unit_id):
+        """Get a unit's poll interval in seconds; unobserved units count as active"""
+        return self.intervals[self._activity.get(unit_id, ACTIVE)]
+    
+    def due_units(self, tick_seconds, calls_per_unit, now=None):
+        """Get the units due for polling, most overdue first, within the call budget.
+        
+        A unit's urgency is the time since its last poll divided by its
+        interval, so busy units are not starved by a backlog of idle ones and
+        vice versa. At most budget_calls_per_minute * tick_seconds / 60 calls
+        are planned per tick; units over the budget stay due for the next tick.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            due = []
+            for unit_id, last_polled in self._last_polled.items():
+                if last_polled is None:
+                    due.append((math.inf, unit_id))
+                    continue
+                urgency = (now - last_polled) / self.interval(unit_id)
+                if urgency >= 1:
+                    due.append((urgency, unit_id))
+        
+        due.sort(key=lambda item: item[0], reverse=True)
+        if self.budget_calls_per_minute:
+            limit = max(1, int(self.budget_calls_per_minute * tick_seconds / 60 / calls_per_unit))
+            due = due[:limit]
+        return [unit_id for _, unit_id in due]
+    
+    def mark_polled(self, unit_ids, now=None):
+        """Record that units were polled"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for unit_id in unit_ids:
+                if unit_id in self._last_polled:
+                    self._last_polled[unit_id] = now
+    
+    def observe(self, unit_id, messages, unit_sensors):
+        """Set a unit's activity level from the messages collected for it.
+        
+        unit_sensors is the unit's {sensor_id: (name, type, parameter, formula)}
+        dictionary, used to find its ignition and fuel flow sensors. A poll
+        without messages lowers the level by one step only, so a dispensing
+        unit that misses a single poll is not dropped straight to idle.
+        """
+        with self._lock:
+            previous = self._activity.get(unit_id)
+        if messages:
+            activity = self.classify(messages, unit_sensors, unit_id)
+        else:
+            activity = LEVELS[min(LEVELS.index(previous or ACTIVE) + 1, len(LEVELS) - 1)]
+        with self._lock:
+            self._activity[unit_id] = activity
+        if previous != activity:
+            self.logger.debug(f"Unit {unit_id} is now {activity}, polled every {self.intervals[activity]} s")
+        return activity
+    
+    def classify(self, messages, unit_sensors, unit_id=None):
+        """Get the activity level shown by a unit's messages, sorted by time"""
+        if not messages:
+            return IDLE
+        
+        flow_sensors = set()
+        ignition_sensors = set()
+        for sensor_id, (name, _, parameter, _) in unit_sensors.items():
+            text = f"{name or ''} {parameter or ''}".lower()
+            if 'flow' in text:
+                flow_sensors.add(sensor_id)
+            elif 'ignition' in text:
+                ignition_sensors.add(sensor_id)
+        
+        first_flow = {}
+        last_flow = {}
+        moving = ignition_on = False
+        for message in messages:
+            if (message.get('pos') or {}).get('s', 0) > self.moving_speed:
+                moving = True
+            for sensor_id, value in ((message.get('p') or {}).get('sensors') or {}).items():
+                sensor_id = str(sensor_id)
+                if value is None:
+                    continue
+                if sensor_id in flow_sensors:
+                    first_flow.setdefault(sensor_id, value)
+                    last_flow[sensor_id] = value
+                elif sensor_id in ignition_sensors and value > 0:
+                    ignition_on = True
+        
+        if any(last_flow[sensor_id] - first_flow[sensor_id] > self.flow_threshold for sensor_id in last_flow):
+            return DISPENSING
+        
+        position = messages[-1].get('pos') or {}
+        if self._in_bowser_zone(position.get('y'), position.get('x'), unit_id):
+            return DISPENSING
+        
+        if moving or ignition_on:
+            return ACTIVE
+        return IDLE
+    
+    def _in_bowser_zone(self, lat, lon, unit_id=None):
+        """Check whether a position lies within a bowser geozone other than the unit's own"""
+        if lat is None or lon is None:
+            return False
+        with self._lock:
+            zones = self._bowser_zones
+        for bowser_unit_id, zone_lat, zone_lon, radius in zones:
+            # A bowser parked at its own base is not dispensing to anyone
+            if unit_id is not None and bowser_unit_id == unit_id:
+                continue
+            # Equirectangular distance is accurate enough at geozone scale
+            d_lat = math.radians(lat - zone_lat)
+            d_lon = math.radians(lon - zone_lon) * math.cos(math.radians(zone_lat))
+            if math.hypot(d_lat, d_lon) * 6371000 <= radius:
+                return True
+        return False
+    
+    def summary(self, calls_per_unit):
+        """Get the unit count per activity level and the expected calls per minute"""
+        with self._lock:
+            counts = {DISPENSING: 0, ACTIVE: 0, IDLE: 0}
+            calls_per_minute = 0.0
+            for unit_id in self._last_polled:
+                counts[self._activity.get(unit_id, ACTIVE)] += 1
+                calls_per_minute += calls_per_unit * 60.0 / self.interval(unit_id)
+        return counts, calls_per_minute
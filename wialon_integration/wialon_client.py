@@ -1,16 +1,63 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import logging
+import threading
 import time
 from datetime import datetime, timedelta
 
+# core/update_data_flags unit flags: base properties and last message
+UNIT_BASE_FLAG = 0x1
+UNIT_LAST_MESSAGE_FLAG = 0x400
+
 class WialonAPIClient:
     def __init__(self, config):
         """Initialize the Wialon API client"""
         self.base_url = config.get('base_url', "https://hst-api.wialon.com")
         self.token = config.get('token')
         self.session_id = None
+        # The client is shared by concurrent fetch threads; only one of them logs in
+        self._login_lock = threading.Lock()
         self.logger = self._setup_logger()
+        # (connect, read) timeouts in seconds, so a hung endpoint cannot block the
+        # collector forever; message loads for long intervals can take a while
+        self.timeout = (config.get('connect_timeout', 5), config.get('read_timeout', 60))
+        self.http = self._create_http_session(config)
+        # Sub-requests packed into one core/batch call
+        self.batch_size = config.get('batch_size', 50)
+    
+    def _create_http_session(self, config):
+        """Create a pooled keep-alive HTTP session for all API calls"""
+        session = requests.Session()
+        # pool_maxsize bounds the connections kept alive per host and should be at
+        # least the number of threads sharing the client
+        adapter = HTTPAdapter(
+            pool_connections=config.get('pool_connections', 4),
+            pool_maxsize=config.get('pool_maxsize', 10),
+            max_retries=config.get('max_retries', 0)
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        })
+        return session
+    
+    def close(self):
+        """Close the pooled HTTP connections"""
+        self.http.close()
+    
+    def _send(self, params, post=False):
+        """Send a request to the Wialon ajax endpoint on the pooled session.
+        
+        Large requests (e.g. core/batch) are POSTed as a form, since their
+        parameters can exceed the URL length limits of GET.
+        """
+        url = f"{self.base_url}/wialon/ajax.html"
+        if post:
+            return self.http.post(url, data=params, timeout=self.timeout)
+        return self.http.get(url, params=params, timeout=self.timeout)
     
     def _setup_logger(self):
         """Set up logging for the API client"""
@@ -30,7 +77,7 @@ class WialonAPIClient:
         }
         
         try:
-            response = requests.get(f"{self.base_url}/wialon/ajax.html", params=params)
+            response = self._send(params)
             response.raise_for_status()
             data = response.json()
             
@@ -41,15 +88,19 @@ class WialonAPIClient:
             else:
                 self.logger.error(f"Failed to authenticate: {data}")
                 return False
+        except requests.exceptions.Timeout as e:
+            self.logger.error(f"Timed out during authentication: {str(e)}")
+            return False
         except Exception as e:
             self.logger.error(f"Exception during authentication: {str(e)}")
             return False
     
-    def _call_api(self, service, params=None):
+    def _call_api(self, service, params=None, post=False):
         """Make a call to Wialon API"""
         if not self.session_id:
-            if not self.login():
-                return None
+            with self._login_lock:
+                if not self.session_id and not self.login():
+                    return None
         
         api_params = {
             "svc": service,
@@ -60,7 +111,7 @@ class WialonAPIClient:
             api_params["params"] = json.dumps(params)
         
         try:
-            response = requests.get(f"{self.base_url}/wialon/ajax.html", params=api_params)
+            response = self._send(api_params, post)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.HTTPError as e:
@@ -68,14 +119,143 @@ class WialonAPIClient:
             if response.status_code == 401 or "Authorization failed" in response.text:
                 self.session_id = None
                 self.logger.warning("Session expired, attempting to re-authenticate...")
-                return self._call_api(service, params)
+                return self._call_api(service, params, post)
             else:
                 self.logger.error(f"HTTP error in API call: {str(e)}")
                 return None
+        except requests.exceptions.Timeout as e:
+            self.logger.error(f"Timed out in API call {service}: {str(e)}")
+            return None
         except Exception as e:
             self.logger.error(f"Exception in API call: {str(e)}")
             return None
     
+    def call_batch(self, calls):
+        """Make many API calls through core/batch, batch_size sub-requests at a time.
+        
+        calls is a list of (service, params). Returns a list with one result per
+        call, in order; a call whose sub-request failed, or whose whole batch
+        failed, gets None so the caller can skip or retry just that call.
+        """
+        results = [None] * len(calls)
+        failed = 0
+        
+        for offset in range(0, len(calls), self.batch_size):
+            chunk = calls[offset:offset + self.batch_size]
+            response = self._call_api("core/batch", {
+                "params": [{"svc": service, "params": params or {}} for service, params in chunk],
+                "flags": 0
+            }, post=True)
+            
+            if not isinstance(response, list) or len(response) != len(chunk):
+                self.logger.error(f"Batch of {len(chunk)} calls failed: {str(response)[:200]}")
+                failed += len(chunk)
+                continue
+            
+            for index, ((service, params), result) in enumerate(zip(chunk, response)):
+                if isinstance(result, dict) and 'error' in result:
+                    self.logger.warning(f"Batched call {service} {params} failed: {result}")
+                    failed += 1
+                else:
+                    results[offset + index] = result
+        
+        if failed:
+            self.logger.warning(f"{failed} of {len(calls)} batched calls failed")
+        return results
+    
+    def update_data_flags(self, spec):
+        """Set which items and data the session receives events for"""
+        return self._call_api("core/update_data_flags", {"spec": spec})
+    
+    def subscribe_unit_messages(self):
+        """Subscribe the session to the new messages of all units.
+        
+        Returns the ID of the subscribed session, or None if subscribing
+        failed or the session was replaced meanwhile.
+        """
+        if not self.session_id:
+            with self._login_lock:
+                if not self.session_id and not self.login():
+                    return None
+        session_id = self.session_id
+        
+        result = self.update_data_flags([{
+            "type": "type",
+            "data": "avl_unit",
+            "flags": UNIT_BASE_FLAG | UNIT_LAST_MESSAGE_FLAG,
+            "mode": 0
+        }])
+        if not isinstance(result, list) or self.session_id != session_id:
+            return None
+        return session_id
+    
+    def get_events(self, wait=0, session_id=None):
+        """Poll a session's event queue (avl_evts), waiting up to wait seconds for events.
+        
+        session_id defaults to the current session. Returns the list of events,
+        or None if the call failed or the session is no longer valid; the
+        caller then has to subscribe again, since the subscription belongs to
+        the session.
+        """
+        session_id = session_id or self.session_id
+        if not session_id:
+            return None
+        
+        params = {"sid": session_id}
+        if wait:
+            params["wait"] = wait
+        
+        try:
+            # avl_evts is served next to, not through, the ajax endpoint
+            response = self.http.get(
+                f"{self.base_url}/avl_evts", params=params,
+                timeout=(self.timeout[0], self.timeout[1] + wait)
+            )
+            response.raise_for_status()
+            data = response.json()
+        except requests.exceptions.Timeout as e:
+            self.logger.error(f"Timed out polling events: {str(e)}")
+            return None
+        except Exception as e:
+            self.logger.error(f"Exception polling events: {str(e)}")
+            return None
+        
+        if "error" in data:
+            self.logger.warning(f"Event polling failed, session reset: {data}")
+            # Leave a session that already replaced the polled one alone
+            if self.session_id == session_id:
+                self.session_id = None
+            return None
+        
+        return data.get("events", [])
+    
+    def get_units_bundle(self, unit_ids, from_time, to_time, data_types=('messages', 'sensors'), from_times=None):
+        """Get unit details, sensors and messages for many units with batched calls.
+        
+        Returns {unit_id: {'unit': ..., 'sensors': ..., 'messages': ...}} where
+        an entry is None if its call failed; 'sensors' and 'messages' are only
+        fetched when listed in data_types. from_times optionally maps unit IDs
+        to their own message interval start, overriding from_time.
+        """
+        from_times = from_times or {}
+        calls = []
+        keys = []
+        for unit_id in unit_ids:
+            calls.append(("core/search_item", self._unit_data_params(unit_id)))
+            keys.append((unit_id, 'unit'))
+            if 'sensors' in data_types:
+                calls.append(("unit/get_sensors", self._unit_sensors_params(unit_id)))
+                keys.append((unit_id, 'sensors'))
+            if 'messages' in data_types:
+                unit_from_time = from_times.get(unit_id, from_time)
+                calls.append(("messages/load_interval", self._messages_params(unit_id, unit_from_time, to_time, True)))
+                keys.append((unit_id, 'messages'))
+        
+        bundles = {unit_id: {} for unit_id in unit_ids}
+        for (unit_id, kind), result in zip(keys, self.call_batch(calls)):
+            bundles[unit_id][kind] = result
+        return bundles
+    
     def get_units(self):
         """Get all units (trucks and bowsers)"""
         params = {
@@ -93,22 +273,26 @@ class WialonAPIClient:
         
         return self._call_api("core/search_items", params)
     
-    def get_unit_data(self, unit_id):
-        """Get detailed information about a specific unit"""
-        params = {
+    def _unit_data_params(self, unit_id):
+        """Parameters of core/search_item for a unit"""
+        return {
             "id": unit_id,
             "flags": 1
         }
-        
-        return self._call_api("core/search_item", params)
     
-    def get_unit_sensors(self, unit_id):
-        """Get sensors for a specific unit"""
-        params = {
+    def get_unit_data(self, unit_id):
+        """Get detailed information about a specific unit"""
+        return self._call_api("core/search_item", self._unit_data_params(unit_id))
+    
+    def _unit_sensors_params(self, unit_id):
+        """Parameters of unit/get_sensors for a unit"""
+        return {
             "unitId": unit_id
         }
-        
-        return self._call_api("unit/get_sensors", params)
+    
+    def get_unit_sensors(self, unit_id):
+        """Get sensors for a specific unit"""
+        return self._call_api("unit/get_sensors", self._unit_sensors_params(unit_id))
     
     def get_unit_position(self, unit_id):
         """Get the current position of a unit"""
@@ -127,8 +311,8 @@ class WialonAPIClient:
         
         return self._call_api("unit/calc_last_message", params)
     
-    def get_messages(self, unit_id, from_time, to_time, sensors=None):
-        """Get messages for a specific time period with sensor data"""
+    def _messages_params(self, unit_id, from_time, to_time, sensors=None):
+        """Parameters of messages/load_interval for a unit and time period"""
         params = {
             "itemId": unit_id,
             "timeFrom": int(from_time.timestamp()),
@@ -141,7 +325,11 @@ class WialonAPIClient:
         if sensors:
             params["sensors"] = sensors
         
-        return self._call_api("messages/load_interval", params)
+        return params
+    
+    def get_messages(self, unit_id, from_time, to_time, sensors=None):
+        """Get messages for a specific time period with sensor data"""
+        return self._call_api("messages/load_interval", self._messages_params(unit_id, from_time, to_time, sensors))
     
     def get_geozones(self, resource_id):
         """Get geozones from a resource"""